@@ -36,12 +36,14 @@ myDir = os.path.normpath(".pylsl")
 import sys
 
 sys.path.append(myDir)
-from pylsl import StreamInfo
-from pylsl import StreamOutlet
-import serial
+# pylsl is loaded by create_outlet() in prex_acquisition.py
 import subprocess
+from prex_acquisition import (LegReader, Poller, LinkOpener, Discovery, RawCapture, create_outlet,
+                              create_monitor_outlet, AcquisitionEngine, frame_command, default_baud, bauds,
+                              max_sample_rate, exo_legs, device_title, sends_to, parse_devices, monitored_types,
+                              create_loss_outlet, create_clock_outlet, default_schema)
 
-# Library Note: pybluez is only loaded if Bluetooth is chosen later on
+# Library Note: pybluez is only loaded if Bluetooth is chosen later on, pyserial only if Wire is chosen
 
 # if a library is misplaced (outside of your typical python library), you can use code the below to import it
 # import os.path
@@ -63,13 +65,6 @@ import subprocess
 # Unity Plotting Application
 # plotting_subprocess = subprocess.Popen(os.path.normpath("./backend_plotting/Static Grip Device.exe"))
 
-# ============================ important string info ==================================================================
-# important characters for interfacing with GUI
-prompt_char = "^"
-trial_start_char = "$"
-trial_stop_char = "@"
-end_string = '\n'
-
 # ============================ globals ================================================================================
 
 global control_type  # type of control (torque control, impedance control, etc.)
@@ -911,111 +906,321 @@ def construct_pot_string(leg):
     return settsStrP
 
 
-# ======================= establish communication (Bluetooth or Serial) connections ====================================
+# ======================= establish communication (Bluetooth, Serial or Wi-Fi) connections ==============================
 global comType
-global ser
-global ser1
-global client_socket
-global client_socket1
-global size
 
 
-def connect_to_exo(comType, address1, address2):
+def connect_to_exo(comType, address1, address2, baud1=default_baud, baud2=default_baud, others=()):
     """This function establishes a connection with the exo, either over bluetooth or over a wire by connecting to
     the serial port of a Teensy. comType = 'Ser'  # set to either 'BLE' or 'Ser' (bluetooth or serial (wire via usb))
-    This function is called by the 'Wire' and 'Bluetooth' buttons on the GUI."""
+    or 'Net' (a serial-to-Wi-Fi bridge, over TCP or UDP, see open_network() in prex_acquisition.py).
+    This function is called by the 'Wire', 'Bluetooth' and 'Wi-Fi' buttons on the GUI. baud1/baud2 = left/right leg baud rate
+    (Wire only, chosen in the Wire setup window). others = [(name, address), ...] of other devices to read along with
+    the legs ('Other devices' in the setup windows, see 'devices' in prex_acquisition.py).
+
+    All the devices are connected at once, in the background (LinkOpener in prex_acquisition.py): the GUI doesn't
+    freeze while a bluetooth module takes its time, and poll_receive() shows each device as it connects, then starts
+    the readers (connected()). If use_engine is True ('Separate acquisition process' in the setup windows), the
+    connections are made by the acquisition process instead (see AcquisitionEngine in prex_acquisition.py).
+    If the 'Telemetry' choice isn't 'Text', both legs are asked for binary frames, COBS or delta packets once
+    connected.
+    If use_realtime is True ('Real-time mode' in the setup windows), the serial ports and the thread reading them get
+    the real-time settings (Linux, see 'real-time mode' in prex_acquisition.py). If use_capture is True ('Capture raw
+    bytes'), every byte received is also written to a file per device (see 'raw byte capture')."""
+    global opener
 
     print("syncing...")
-    if comType == 'Ser':
-        global ser
-        global ser1
-
-        ser = serial.Serial(address1, 115200, timeout=0, bytesize=8, stopbits=1, parity='N')  # left leg
-        # ser.write(b'-99')
-        print("Left leg Connected ")
-        main.SERCONBOX['text'] = "Connection Confirmation:\nLeft Leg Connected!"
-        ser1 = serial.Serial(address2, 115200, timeout=0, bytesize=8, stopbits=1, parity='N')  # right leg
-        # ser1.write(b'-99')
-        main.SERCONBOX['text'] = "Connection Confirmation:\nLeft Leg Connected!\nRight Leg Connected!"
-        print("Right leg Connected!")
-
-    elif comType == 'BLE':
-        import bluetooth
-        # mac address from GUI
-        serverMACAddress = address1
-        serverMACAddress1 = address2
-
-        global client_socket
-        global client_socket1
-        global size
-
-        client_socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)  # left leg
-        client_socket1 = bluetooth.BluetoothSocket(bluetooth.RFCOMM)  # right leg
-        size = 1  # set to 1. This way, only 1 byte is received at a time. Otherwise end character will be found too
-        # late and print incorrectly.
-        time2Receive = 3  # 3 seconds, time until Bluetooth .connect() stops trying to connect
-
-        # connect to sockets
-        client_socket.connect((serverMACAddress, 1))  # establish connection
-        client_socket.settimeout(time2Receive)  # increase timeout for connection to be established
-        client_socket.setblocking(
-            0)  # make socket non-blocking; otherwise, if receives 0 bytes, will stall whole program
-        print("Left leg Connected ")
-        main.BLECONBOX['text'] = "Connection Confirmation:\nLeft Leg Connected!"
-        client_socket1.connect((serverMACAddress1, 1))
-        client_socket1.settimeout(time2Receive)
-        client_socket1.setblocking(0)
-        print("Right leg Connected ")
-        main.BLECONBOX['text'] = "Connection Confirmation:\nLeft Leg Connected!\nRight Leg Connected!"
+    stop_readers()  # from a previous connection
+    show_connection_status("Connecting...", clear=True)
+    if use_engine:
+        start_engine(comType, address1, address2, baud1, baud2, others)
+        connected()
+    else:
+        addresses = {'L': address1, 'R': address2}
+        addresses.update(others)
+        opener = LinkOpener(comType, addresses, {'L': baud1, 'R': baud2}, realtime=use_realtime)
+
+
+def check_connecting():
+    """Called by poll_receive() while the devices are being connected: shows each one as it connects (or doesn't),
+    and starts the readers once they're all done. Both legs have to connect, the other devices are optional."""
+    global opener
+    for name, error in opener.poll():
+        if error is None:
+            show_connection_status(device_title(name) + " Connected!")
+        else:
+            show_connection_status(device_title(name) + ": couldn't connect (" + error + ")")
+    if not opener.done():
+        return
+    links = opener.links
+    reopen = opener.reopen
+    opener = None
+    if not all(leg in links for leg in exo_legs):
+        for link, _, _ in links.values():
+            link.close()
+        show_connection_status("Not connected, check the legs and connect again")
+        return
+    start_readers(links, reopen)
+    connected()
+
+
+def connected():
+    """Once the readers are running: the other devices start streaming, and the legs are asked for their channels and
+    the telemetry chosen."""
+    release_devices()
+    negotiate_telemetry()
 
 
 # ================================ setup LabStreamingLayer (LSL) streams ==============================================
 """Lab Streaming Layer is an open source project that handles, amongst other things, networking & time-synchronization 
 of measurement time series. Two streams are created in this project; a right leg and a left leg stream. Each stream 
-contains 8 pieces of data, including things such as time, angle, and torque. Data are pushed to these streams in 
-receive_ser_data_and_send2LSL() and receive_BLE_data_and_send2LSL().
+contains the channels its leg describes when connecting (8 pieces of data by default), including things such as time,
+angle, and torque (see create_outlet() and 'channel schema' in prex_acquisition.py). Data are pushed to these
+streams in the LegReader threads, started by connect_to_exo(). Each leg also gets a marker stream of the samples
+missing from its data (see 'sample loss' in prex_acquisition.py), and a stream of how its clock lines up with the
+host's (see 'sample timestamps').
+
+The outlets are created the first time they're needed, and only in the process that does the receiving: with the
+separate acquisition process, that process creates its own.
 """
-# == Right Leg LSL ===
-info_RL = StreamInfo('RightLeg', 'Exoskeleton', 8, 100, 'float32', 'YourComp')  # creates 8 channel LSL stream
+outlets = {}  # 'L' = left leg outlet, 'R' = right leg outlet
+outlet_schemas = {}  # the ChannelSchema each outlet was made for
+
+
+def get_outlet(leg):
+    """The leg's outlet for a new reader, which reads the default schema until the Teensy describes its channels: one
+    made for another schema (before reconnecting to a Teensy that doesn't answer) is made again."""
+    if outlet_schemas.get(leg) != default_schema(leg):
+        outlets[leg] = create_outlet(leg)  # creates the default 8 channel LSL stream and outlet
+        outlet_schemas[leg] = default_schema(leg)
+    return outlets[leg]
+
+
+def new_outlet(leg, rate, decimation, schema):
+    """Makes the leg's outlet again once the Teensy says which channels it sends (see negotiate_telemetry()) or what
+    rate it sends at (see fit_rate()), so the stream's info has what is really sent. Called from the leg's reader,
+    between trials."""
+    outlets[leg] = create_outlet(leg, rate, decimation, schema)
+    outlet_schemas[leg] = schema
+    return outlets[leg]
+
+
+monitor_outlets = {}  # LSL outlets of the link monitor (bluetooth only), see 'link monitor' in prex_acquisition.py
+
+
+def get_monitor_outlet(leg):
+    if leg not in monitor_outlets:
+        monitor_outlets[leg] = create_monitor_outlet(leg)
+    return monitor_outlets[leg]
+
 
-# append some meta-data
-channels = info_RL.desc().append_child("channels")
-for c in ["TimeRL", "AngleRL", "TorqueRL", "FSR RL", "CurrentRL", "FSM StateRL", "Torque SetpointRL",
-          "Position SetpointRL"]:
-    channels.append_child("channel") \
-        .append_child_value("label", c)
+loss_outlets = {}  # LSL marker outlets of the samples missing from each device's stream
 
-outlet_RL = StreamOutlet(info_RL)  # creates outlet for right leg
 
-# == Left Leg LSL ===
-info_LL = StreamInfo('LeftLeg', 'Exoskeleton', 8, 100, 'float32', 'YourComp')  # creates 8 channel LSL stream
+def get_loss_outlet(leg):
+    if leg not in loss_outlets:
+        loss_outlets[leg] = create_loss_outlet(leg)
+    return loss_outlets[leg]
 
-# append some meta-data
-channels = info_LL.desc().append_child("channels")
-for c in ["TimeLL", "AngleLL", "TorqueLL", "FSR LL", "CurrentLL", "FSM StateLL", "Torque SetpointLL",
-          "Position SetpointLL"]:
-    channels.append_child("channel") \
-        .append_child_value("label", c)
 
-outlet_LL = StreamOutlet(info_LL)  # creates outlet for left leg
+clock_outlets = {}  # LSL outlets of each device's clock offset and drift
+
+
+def get_clock_outlet(leg):
+    if leg not in clock_outlets:
+        clock_outlets[leg] = create_clock_outlet(leg)
+    return clock_outlets[leg]
+
 
 # =================================== Globals for receiving/saving data ===============================================
-# these variables break out of the receiving data loops when the appropriate buttons are selected
-# These might seem excessive, but they stand for the different ways the receiving protocol needs to finish:
-# 1) When communication from Arduino is over,
+# The receiving itself is done by one LegReader thread per leg (see prex_acquisition.py), started by connect_to_exo().
+# The GUI only checks on the threads every poll_interval ms (poll_receive()), so data keeps being received and saved
+# while the GUI is busy, moved or resized.
+# receive_mode says what the GUI is waiting for. It is finished:
+# 1) When communication from Arduino is over (prompt character from both legs),
 # 2) When a trial is starting/stopping (data saved versus not saved), and
 # 3) When the 'stop' button is selected.
 
-received_data_L = ""  # data received from left leg Teensy
-received_data_R = ""  # data received from right leg Teensy
+readers = {}  # LegReader of each device (or the acquisition process's EngineLegs), 'L' = left leg, 'R' = right leg
+poller = None  # Poller thread reading the devices
+opener = None  # LinkOpener, while connect_to_exo() is connecting
+discovery = None  # Discovery thread, while a setup window looks for the legs
+discovery_fields = []  # the leg address fields' text when the Discovery started (see show_discovery())
+engine = None  # AcquisitionEngine, if the legs are read by a separate process
+use_engine = False  # set by the 'Separate acquisition process' checkbox when connecting
+use_realtime = False  # set by the 'Real-time mode' checkbox when connecting
+use_capture = False  # set by the 'Capture raw bytes' checkbox when connecting
+capture = None  # RawCapture the readers write the bytes they receive to, if use_capture
+telemetry = 'Text'  # set by the 'Telemetry' choice when connecting, one of telemetry_wires
+telemetry_wires = {'Text': ('ascii', False),  # (LegReader.wire, checksum) for each 'Telemetry' choice
+                   'Binary frames': ('binary', False),
+                   'COBS frames': ('cobs', False),
+                   'COBS frames + CRC': ('cobs', True),
+                   'Delta packets': ('delta', False),
+                   'Delta packets + CRC': ('delta', True)}
+negotiating = False  # waiting for the legs to answer negotiate_telemetry()
+probing = False  # waiting for the legs to finish probe_link()
+fitting = False  # waiting for the legs to answer fit_rate()
 buttons_state = "on"  # GUI buttons state to define interaction b/t Application and receive_data.
-L_state = 'rec'  # 'receiving', for conditionals, so one leg's data can be received even when the other is finished
-R_state = 'rec'  # 'receiving'
-switch2Save = False  # variable to switch from receive_serial_data to receive_serial_dataAndSend2LSL. Ends receive_serial_data
-trial_start_L = False  # variable to indicate start of a trial from left leg
-trial_start_R = False  # variable to indicate start of a trial from right leg
-trial_stop_L = False  # variable to indicate stop of a trial from left leg
-trial_stop_R = False  # variable to indicate stop of a trial from right leg
+receive_mode = None  # 'menu' (receive_data), 'save' (receive_and_save_data) or None (not waiting on the legs)
+poll_interval = 20  # ms between each poll_receive()
+lines_per_poll = 200  # max lines printed per leg per poll_receive(), so printing can't freeze the GUI
+shown_stats = {}  # link stats of each device last shown by show_link_monitor()
+shown_counts = {}  # trial counts of each device last shown by show_link_counts()
+
+
+def start_readers(links, reopen=None):
+    """Starts reading every device: links = {name: (port or socket, read, write)} as opened by open_link(). One
+    Poller thread reads all of them (see 'one poller for every device' in prex_acquisition.py). reopen(name) opens a
+    device again, for the readers to reconnect a lost link."""
+    global readers
+    global poller
+    global capture
+    readers = {}
+    poller = Poller(realtime=use_realtime)
+    capture = RawCapture(links) if use_capture else None
+    for name, (link, read, write) in links.items():
+        readers[name] = LegReader(name, read, write, get_outlet(name), link=link,
+                                  reopen=(lambda name=name: reopen(name)) if reopen else None)
+        readers[name].capture = capture
+        readers[name].new_outlet = lambda rate, decimation, schema, name=name: new_outlet(name, rate, decimation,
+                                                                                          schema)
+        if comType in monitored_types:  # records how the wireless link keeps up (see show_link_monitor())
+            readers[name].monitor_outlet = get_monitor_outlet(name)
+        readers[name].loss_outlet = get_loss_outlet(name)
+        readers[name].clock_outlet = get_clock_outlet(name)
+        poller.add(readers[name], link)
+    poller.start()
+
+
+def start_engine(comType, address1, address2, baud1=default_baud, baud2=default_baud, others=()):
+    """Starts the acquisition process, which connects to both legs (and the other devices) and does all the receiving
+    and saving."""
+    global engine
+    global readers
+    engine = AcquisitionEngine(comType, address1, address2, baud1, baud2, others, use_realtime, use_capture)
+    readers = engine.legs
+    show_connection_status("Connecting (acquisition process)...")
+
+
+def negotiate_telemetry():
+    """Asks both legs to describe their channels (see 'channel schema' in prex_acquisition.py), and for binary telemetry
+    frames, COBS or delta packets instead of text lines if chosen (see 'binary telemetry frames', 'COBS framed link'
+    and 'delta packets'). Legs that don't answer stay on the default 8 channels and on text; poll_receive() shows which
+    is which."""
+    global negotiating
+    negotiating = True
+    wire, checksum = telemetry_wires[telemetry]
+    for reader in readers.values():
+        reader.negotiate(wire, checksum)
+
+
+def probe_link():
+    """Has both legs stream a test pattern for a few seconds (see 'link speed probe' in prex_acquisition.py).
+    poll_receive() shows the bytes/s, lines/s and loss of each leg, and the highest sample rate the link can take with
+    the telemetry chosen, then has the legs send no more than that (fit_rate()). Called by the 'Probe Link' button in
+    the setup windows."""
+    global probing
+    if not readers:
+        show_connection_status("Connect first, then probe the link")
+        return
+    if receive_mode == 'save':  # the sample rate stays the same for the whole trial
+        show_connection_status("Stop the trial first, then probe the link")
+        return
+    probing = True
+    show_connection_status("Probing the link...")
+    for reader in readers.values():
+        reader.probe()
+
+
+def fit_rate():
+    """Asks every probed device to send no more samples/s than the slowest probed link can take (see 'sample rate
+    (decimation)' in prex_acquisition.py), so both legs are decimated alike. The Teensys send every n-th sample from
+    the next trial on; poll_receive() shows what each one will send."""
+    global fitting
+    probed = {leg: reader for leg, reader in readers.items() if reader.probe_result is not None}
+    if not probed:
+        return
+    max_rate = min(max_sample_rate(reader.probe_result['bytes/s'], reader.wire, reader.checksum,
+                                   schema=reader.schema) for reader in probed.values())
+    fitting = True
+    for reader in probed.values():
+        reader.fit_rate(max(max_rate, 1))
+
+
+def stop_readers():
+    """Stops the readers, or the acquisition process, of the previous connection."""
+    global engine
+    global readers
+    global poller
+    global opener
+    global capture
+    if opener is not None:  # still connecting
+        opener.cancel()
+        opener = None
+    for reader in readers.values():
+        reader.stop()
+    if poller is not None:
+        poller.stop()
+    if capture is not None:
+        capture.close()
+        capture = None
+    readers = {}
+    engine = None
+    poller = None
+
+
+def show_connection_status(message, clear=False, box_type=None):
+    """Prints message, and adds it to the connection box of the setup window (Wire, Bluetooth or Wi-Fi, comType unless
+    box_type says which); clear starts the box over."""
+    print(message)
+    try:
+        box = getattr(main, {'Ser': 'SERCONBOX', 'Net': 'NETCONBOX'}.get(box_type or comType, 'BLECONBOX'))
+        box['text'] = ("Connection Confirmation:" if clear else box['text']) + "\n" + message
+    except (AttributeError, NameError, tk.TclError):  # setup window has been closed (or was never opened)
+        pass
+
+
+def leg_fields(box_type):
+    """The setup window's left and right leg address fields (raises AttributeError if the window was never opened)."""
+    return (main.LCOMPORT, main.RCOMPORT) if box_type == 'Ser' else (main.LMACADDRESS, main.RMACADDRESS)
+
+
+def start_discovery(box_type):
+    """Looks for the legs in the background (serial ports for box_type = 'Ser', RN-42 modules for 'BLE'); poll_receive()
+    lists the addresses found (show_discovery()). Called when a setup window opens, and by its 'Scan' button."""
+    global discovery
+    global discovery_fields
+    try:  # what the address fields held when the scan started, see show_discovery()
+        discovery_fields = [field.get() for field in leg_fields(box_type)]
+    except (AttributeError, tk.TclError):
+        discovery_fields = []
+    discovery = Discovery(box_type)
+    discovery.start()
+    show_connection_status({'Ser': "Looking for serial ports...",
+                            'BLE': "Looking for bluetooth modules (00:06:66:...)..."}[box_type], box_type=box_type)
+
+
+def show_discovery():
+    """Lists what Discovery found in the setup window's connection box. The first two only go into the left and right
+    leg fields if those were empty when the scan started and still are: a configured or typed address is never
+    replaced by a guess (the left/right order of what's found is one, check it before connecting)."""
+    global discovery
+    box_type = discovery.comType
+    found = discovery.found
+    if discovery.error is not None:
+        show_connection_status("Couldn't look for the legs: " + discovery.error, box_type=box_type)
+    elif not found:
+        show_connection_status("Nothing found", box_type=box_type)
+    for address, description in found:
+        show_connection_status("Found " + address + " " + description, box_type=box_type)
+    discovery = None
+    try:
+        for field, before, (address, _) in zip(leg_fields(box_type), discovery_fields, found):
+            if before == "" and field.get() == "":  # empty, and not edited during the scan
+                field.insert(END, address)
+    except (AttributeError, tk.TclError):  # setup window has been closed
+        pass
 
 
 # ================== Universal communication functions (BLE or Ser) ===========================
@@ -1025,54 +1230,215 @@ https://github.com/NIHFAB/PREX-GUI-FAB/wiki , 3b. Function to Send Data over Blu
 """
 
 def receive_data():
-    """Universal function to received data, either from bluetooth or wire."""
-    global comType
+    """Universal function to received data, either from bluetooth or wire.
 
-    if comType == 'Ser':  # from wire
-        receive_serial_data()
-    elif comType == 'BLE':  # from bluetooth
-        receive_ble_data()
+    Menu communication is over when '^\n' has been received from both legs. Until then, every line received is
+    printed to the consoles by poll_receive()."""
+    global buttons_state
+    buttons_state = "on"
+    global receive_mode
+    receive_mode = 'menu'
+    for reader in readers.values():
+        reader.arm('menu')
 
 
 def send_data(data, prefix='Y', parse='Y',
               leg='B'):  # no parse for immediate commands, like stop, walking, standby, etc.
     """Universal function to send data, either to Bluetooth or wire.
-    'Parse' adds a prefix of data length to the communication."""
-    global comType
+    'Parse' adds a prefix of data length to the communication.
+
+    Each leg's reader does the sending (LegReader.send()), so it goes out the right way for the link: over the port or
+    socket, through the acquisition process, or as a COBS packet."""
     # leg denotes with leg to send to; L = left, R = right, B = both
-    if comType == 'Ser':
-        if parse == 'Y':  # send length of data before data, and parse with ~ and >
-            data = str(len(data)) + '~' + data + '>'
-        dataB = bytes(data, encoding='utf-8')  # converts strings to binary
-        if leg == 'B':
-            ser.write(dataB)  # left
-            ser1.write(dataB)  # right
-        elif leg == 'L':  # L and R used for calibrating potentiometers
-            ser.write(dataB)
-        elif leg == 'R':
-            ser1.write(dataB)
-
-    elif (comType == 'BLE'):  # and (prefix == 'Y'):
-        if parse == 'Y':
-            data = str(len(data)) + '~' + data + '>'
-        # dataP = ">" + data  # prefixes data with '>', as Arduino expects
-        if leg == 'B':
-            client_socket.send(data)  # left
-            client_socket1.send(data)  # right
-        elif leg == 'L':  # L and R used for calibrating potentiometers
-            client_socket.send(data)
-        elif leg == 'R':
-            client_socket1.send(data)
+    if parse == 'Y':  # send length of data before data, and parse with ~ and >
+        data = frame_command(data)
+
+    for name, reader in readers.items():
+        if sends_to(leg, name):  # L and R used for calibrating potentiometers
+            reader.send(data)
 
 
 def receive_and_save_data():
-    """Universal function for receiving and saving data, either over bluetooth or wire."""
-    global comType
+    """Universal function for receiving and saving data, either over bluetooth or wire.
+
+    Each line received is converted to floats and pushed to LSL by the leg's reader thread. The trial is over when
+    '@' has been received from both legs (or a line couldn't be pushed to LSL), or '^\n' has been received."""
+    print("receive_and_save_data is running... I promise...")
+    global buttons_state
+    buttons_state = "on"
+    global receive_mode
+    receive_mode = 'save'
+
+    main.p1.LeftConsole.insert(INSERT,
+                               'Trial is running... press "Finish Trial" to end\n')  # insert text to scrolled text widget
+    main.p1.RightConsole.insert(INSERT,
+                                'Trial is running... press "Finish Trial" to end\n')  # insert text to scrolled text widget
 
-    if comType == 'Ser':
-        receive_ser_data_and_send2LSL()
-    elif comType == 'BLE':
-        receive_ble_data_and_send2LSL()
+    for reader in readers.values():
+        reader.arm('save')
+
+
+def poll_receive():
+    """Runs every poll_interval ms on the Tkinter event loop (main.after()). Prints the lines the reader threads have
+    received, and ends receive_data()/receive_and_save_data() once the legs say so."""
+    global receive_mode
+    global negotiating
+    global probing
+    global fitting
+
+    if engine is not None:
+        for message in engine.poll():
+            show_connection_status(message)
+
+    if opener is not None:
+        check_connecting()
+
+    if discovery is not None and discovery.done:
+        show_discovery()
+
+    show_link_monitor()
+    show_link_counts()
+
+    if negotiating and readers and all(reader.negotiated for reader in readers.values()):
+        negotiating = False
+        release_devices()
+        for leg, reader in readers.items():
+            show_connection_status(device_title(leg) + ": " +
+                                   {'ascii': "text telemetry", 'binary': "binary telemetry",
+                                    'cobs': "COBS packets" + (" + CRC" if reader.checksum else ""),
+                                    'delta': "delta packets" + (" + CRC" if reader.checksum else "")}[reader.wire] +
+                                   ", %d channels" % reader.schema.n)
+
+    if probing and readers and all(reader.probed for reader in readers.values()):
+        probing = False
+        release_devices()
+        for leg, reader in readers.items():
+            result = reader.probe_result
+            if result is None:
+                message = "no test pattern received"
+            else:
+                message = "%.0f bytes/s, %.0f lines/s, %.1f%% lost, up to %d samples/s" % (
+                    result['bytes/s'], result['lines/s'], result['loss %'],
+                    max_sample_rate(result['bytes/s'], reader.wire, reader.checksum, schema=reader.schema))
+            show_connection_status(device_title(leg) + ": " + message)
+        fit_rate()
+
+    if fitting and all(reader.rate_set for reader in readers.values() if reader.probe_result is not None):
+        fitting = False
+        release_devices()
+        for leg, reader in readers.items():
+            if reader.probe_result is not None:
+                show_connection_status(device_title(leg) + ": " + (
+                    "every sample" if reader.decimation == 1 else "1 of every %d samples" % reader.decimation) + (
+                    "" if reader.sample_rate is None else ", %g samples/s" % reader.sample_rate))
+
+    for leg, reader in readers.items():
+        lines = reader.get_lines(lines_per_poll)
+        if lines and leg in exo_legs:  # the other devices have no console, their lines are only saved
+            print_to_console(leg, "".join(lines))
+
+    if receive_mode is not None and all(leg in readers for leg in exo_legs):
+        left = readers['L']
+        right = readers['R']
+        finished = False
+        # === conditionals to end receiving: prompt character, trial start/stop, or change in button state ====
+        if buttons_state == "off":  # button is turned to 'off' by stop button
+            finished = True
+        elif receive_mode == 'menu' and left.trial_start and right.trial_start:
+            start_trial()
+            finished = True
+        elif receive_mode == 'save' and left.trial_stop and right.trial_stop:
+            print("Made it to trail stop evaluations")
+            finished = True
+        elif left.fin and right.fin:  # 'finished'
+            finished = True
+
+        if finished:
+            for reader in readers.values():
+                reader.hold()  # anything received from now on waits in the reader until the next receive___()
+            release_devices()
+            print({'menu': "receive_data", 'save': "receive_and_save_data"}[receive_mode] + " finished")
+            receive_mode = None
+            show_latest_samples()
+        elif receive_mode == 'save':
+            show_latest_samples()
+
+    main.after(poll_interval, poll_receive)
+
+
+def show_link_monitor():
+    """Shows each device's link stats (LegReader.link_stats(), updated every second) in the Bluetooth or Wi-Fi setup
+    window, to see whether the wireless link keeps up before a trial is started."""
+    global shown_stats
+    if not readers or comType not in monitored_types:  # (comType is only set once connecting)
+        return
+    stats = {leg: reader.link_stats() for leg, reader in readers.items()}
+    if all(stats[leg] is shown_stats.get(leg) for leg in stats):
+        return
+    shown_stats = stats
+    text = "Link monitor:"
+    for leg, leg_stats in stats.items():
+        if leg_stats:
+            text += "\n%s: %.1f kB/s, %.0f lines/s, jitter %.1f ms, %.0f%% empty reads, backlog %d B, lag %.0f ms, " \
+                    "%.1f%% lost" % (device_title(leg), leg_stats['bytes/s'] / 1000, leg_stats['lines/s'],
+                                     leg_stats['jitter ms'], leg_stats['empty reads %'], leg_stats['backlog'],
+                                     leg_stats['lag ms'], leg_stats['loss %'])
+    try:
+        (main.NETMONITOR if comType == 'Net' else main.BLEMONITOR)['text'] = text
+    except (AttributeError, tk.TclError):  # setup window has been closed (or was never opened)
+        pass
+
+
+def release_devices():
+    """The other devices (not the legs) never hold: between trials their lines are taken out of their buffers and
+    thrown away, so the data of one trial doesn't pile up in front of the next one."""
+    for name, reader in readers.items():
+        if name not in exo_legs:
+            reader.arm('menu')
+
+
+def show_latest_samples():
+    """While a trial is being saved, shows the share of each leg's samples missing so far in the console titles, and
+    with the acquisition process the number of samples saved and the newest angle and torque too. Those samples are
+    read straight out of the shared memory ring."""
+    for leg, frame, title in (('L', main.p1.leftconsoleframe, "Left Leg Output"),
+                              ('R', main.p1.rightconsoleframe, "Right Leg Output")):
+        if receive_mode != 'save' or leg not in readers:
+            frame['text'] = title
+            continue
+        loss = readers[leg].counts().get('loss %', 0.0)
+        sample = engine.latest(leg) if engine is not None else None
+        if sample is None:
+            frame['text'] = "%s (%.2f%% lost)" % (title, loss)
+        else:
+            frame['text'] = "%s (%d samples, %.2f%% lost, angle %.1f, torque %.2f)" % (title, engine.count(leg), loss,
+                                                                                     sample[1], sample[2])
+
+
+def show_link_counts():
+    """Once a trial has ended, however it was stopped, prints what happened on each leg's link during it (its
+    reader's trial_counts: lines the GUI fell behind on, malformed lines quarantined, the most bytes waiting to be
+    parsed, samples missing, the drift of the leg's clock, and with COBS packets: packets received, dropped and
+    resynced, and with delta packets how many times smaller they were than sample packets) to the consoles."""
+    for leg, reader in readers.items():
+        counts = reader.trial_counts
+        if counts is shown_counts.get(leg):  # not a new trial
+            continue
+        shown_counts[leg] = counts
+        if counts:
+            print_to_console(leg, "Link: " + ", ".join("%s %s" % (name, n) for name, n in counts.items()) + "\n")
+
+
+def print_to_console(leg, text):
+    """Sends text to it's respective location: the console of the leg it came from, on the page being shown."""
+    if page == "trialpage":
+        console = main.p1.LeftConsole if leg == 'L' else main.p1.RightConsole
+    elif page == "testpage":
+        console = main.p2.LeftConsole if leg == 'L' else main.p2.RightConsole
+    else:
+        return
+    console.insert(INSERT, text)  # insert text to scrolled text widget
+    console.see("end")  # autoscroll to bottom
 
 
 def start_trial():
@@ -1091,447 +1457,6 @@ def start_trial():
 #     main.p1.RightConsole.see("end")  # autoscroll to bottom
 
 
-# ================= Serial communication functions ==================================
-"""For an overview of how the following receive____() functions parse and save data, visit
-https://github.com/NIHFAB/PREX-GUI-FAB/wiki , 2. Receive and Parse Data (Python) and 3. Save Data
-"""
-
-def receive_serial_data():
-    """INPUT: None (uses received_data_L and received_data_R, but these are globals)
-    OUTPUT: Prints received serial data to console, and to tkinter GUI
-
-    Menu communication is over when '^\n' has been received. That's what all these conditionals are checking for.
-    A line is over when '\n' has been received. This function waits until '^\n' has been received: otherwise,
-    it reads data indefinitely."""
-
-    global ser
-    global ser1
-
-    global received_data_L
-    global received_data_R
-    global L_state
-    L_state = 'rec'  # reset these every time 'receive_data' is called
-    global R_state
-    R_state = 'rec'
-    global buttons_state  # to know button states for app object (GUI state)
-    buttons_state = "on"
-    global switch2Save
-    switch2Save = False
-    global trial_start_L
-    trial_start_L = False
-    global trial_start_R
-    trial_start_R = False
-    global page
-
-    while (L_state == 'rec' or R_state == 'rec') and buttons_state == 'on' and (switch2Save == False):
-        # L & R states are changed by finding end communication characters; buttons_state is changed by 'stop' button
-        main.update()
-        # === receiving & decoding of data ====
-        data_L = ser.read(1)  # limits buffer size to 1 byte: controls data flow since whatever
-        data_L = data_L.decode('utf-8')  # decodes characters according to utf-8
-        received_data_L = received_data_L + data_L  # adds up characters until newline character is received
-
-        data_R = ser1.read(1)
-        data_R = data_R.decode('utf-8')
-        received_data_R = received_data_R + data_R
-
-        # == checks for end_string (end communication) and prints ====
-        if end_string in received_data_L and L_state != 'fin':
-            # send text to it's respective locations
-            if page == "trialpage":
-                main.p1.LeftConsole.insert(INSERT, received_data_L)  # insert text to scrolled text widget
-                main.p1.LeftConsole.see("end")  # autoscroll to bottom
-            elif page == "testpage":
-                main.p2.LeftConsole.insert(INSERT, received_data_L)  # insert text to scrolled text widget
-                main.p2.LeftConsole.see("end")  # autoscroll to bottom
-
-            if prompt_char in received_data_L and end_string in received_data_L:  # these lines stopped ability to input
-                L_state = 'fin'
-            if trial_start_char in received_data_L:
-                trial_start_L = True
-            received_data_L = ""
-            main.update()
-
-        if end_string in received_data_R and R_state != 'fin':
-            if page == "trialpage":
-                main.p1.RightConsole.insert(INSERT, received_data_R)  # insert text to scrolled text widget
-                main.p1.RightConsole.see("end")  # autoscroll to bottom
-            elif page == "testpage":
-                main.p2.RightConsole.insert(INSERT, received_data_R)  # insert text to scrolled text widget
-                main.p2.RightConsole.see("end")  # autoscroll to bottom
-
-            if prompt_char in received_data_R and end_string in received_data_R:  # set to 'or' in case one teensy gets
-                R_state = 'fin'  # 'finished'                                    # multiple bytes ahead of the other
-            if trial_start_char in received_data_R:
-                trial_start_R = True
-            received_data_R = ""
-            main.update()
-
-        # === conditionals to end loop: conditions are prompt character or change in button state or start trial ====
-        # checks to see if the prompt character is in communication to end bluetooth sending communication
-        if (trial_start_L == True) and (trial_start_R == True):
-            start_trial()
-            break
-        if L_state == 'fin' and R_state == 'fin':  # 'finished'
-            main.update()
-            break
-
-        main.update()  # updates
-
-
-def receive_ser_data_and_send2LSL():
-    """INPUT: None (uses received_data_L and received_data_R, but these are globals)
-    OUTPUT: Sends received serial data to LSL to be saved.
-
-    Menu communication is over when '^\n' has been received. That's what all these conditionals are checking for.
-    A line is over when '\n' has been received. This function waits until '^\n' has been received: otherwise,
-    it reads data indefinitely."""
-
-    print("receive_serial_dataAndSend2LSL is running... I promise...")
-
-    global ser
-    global ser1
-
-    global received_data_L
-    global received_data_R
-    global L_state
-    L_state = 'rec'  # reset these every time 'receive_data' is called
-    global R_state
-    R_state = 'rec'
-    global buttons_state  # to know button states for main object (GUI state)
-    buttons_state = "on"
-    global trial_stop_L
-    trial_stop_L = False
-    global trial_stop_R
-    trial_stop_R = False
-
-    # counter = 1  # for clocking how fast the GUI works
-
-    main.p1.LeftConsole.insert(INSERT,
-                               'Trial is running... press "Finish Trial" to end\n')  # insert text to scrolled text widget
-    main.p1.RightConsole.insert(INSERT,
-                                'Trial is running... press "Finish Trial" to end\n')  # insert text to scrolled text widget
-
-    while (L_state == 'rec' or R_state == 'rec') and buttons_state == 'on':
-        # L & R states are changed by finding end communication characters; buttons_state is changed by 'stop' button
-        # === receiving & decoding of data ====
-        data_L = ser.read(1)  # limits buffer size to 1 byte: controls data flow since whatever
-        data_L = data_L.decode('utf-8')  # decodes characters according to utf-8
-        received_data_L = received_data_L + data_L  # adds up characters until newline character is received
-
-        data_R = ser1.read(1)
-        data_R = data_R.decode('utf-8')
-        received_data_R = received_data_R + data_R
-
-        # outlet_GUI.push_sample([counter])
-        # counter += 1
-
-        # === checks for end_string (end communication) and prints ====
-        if end_string in received_data_L and L_state != 'fin':
-            # send text to it's respective locations
-            # main.p1.LeftConsole.insert(INSERT, received_data_L)  # insert text to scrolled text widget
-            # main.p1.LeftConsole.see("end")  # autoscroll to bottom. This line takes ridiculously long to execute
-
-            # splits lines into the 8 different data types being received
-            data2SaveLL = received_data_L.split("\t")
-
-            try:  # pushes samples to LSL
-                data2SaveLL_Floats = [float(i) for i in data2SaveLL]  # converts a list of strings to floats
-                outlet_LL.push_sample(data2SaveLL_Floats)
-            except Exception:  # value error when '@' symbol is received
-                # global trial_stop_L
-                trial_stop_L = True
-                print("Ending trial, couldn't push to LSL...")
-                data2SaveLL = ''
-
-            if prompt_char in received_data_L and end_string in received_data_L:
-                L_state = 'fin'
-            if trial_stop_char in received_data_L and end_string in received_data_L:
-                trial_stop_L = True
-
-            received_data_L = ""
-            main.update()
-
-        if end_string in received_data_R and R_state != 'fin':
-            # main.p1.RightConsole.insert(INSERT, received_data_R)  # insert text to scrolled text widget
-            # main.p1.RightConsole.see("end")  # autoscroll to bottom. This line takes ridiculously long to execute
-
-            # splits lines into the 8 different data types being received
-            data2SaveRL = received_data_R.split("\t")  # parses data by tab character
-            try:
-                data2SaveRL_Floats = [float(i) for i in data2SaveRL]  # converts strings to floats
-                outlet_RL.push_sample(data2SaveRL_Floats)
-            except Exception:
-                # global trial_stop_R
-                trial_stop_R = True
-                print("Ending trial, couldn't push to LSL...")
-                data2SaveRL = ''
-
-            if prompt_char in received_data_R and end_string in received_data_R:  # set to 'or' in case one teensy gets
-                R_state = 'fin'  # 'finished'                                    # multiple bytes ahead of the other
-            if trial_stop_char in received_data_R and end_string in received_data_R:
-                trial_stop_R = True  # checks for '@' during trial to finish trial
-
-            received_data_R = ""
-            main.update()
-
-        # === conditionals to end loop: conditions are prompt character or change in button state ====
-        # checks to see if the prompt character is in communication to end bluetooth sending communication or if
-        # trial stop character is in communication
-        if (trial_stop_L == True) and (trial_stop_R == True):
-            main.update()
-            received_data_R = ""
-            received_data_L = ""
-            print("Made it to trail stop evaluations")
-            # stop_trial()
-            break
-        if L_state == 'fin' and R_state == 'fin':  # 'finished'
-            main.update()
-            print("Ended on this state change")
-            break
-        # checks to see if buttons have been turned off
-        if buttons_state == "off":  # button is turned to 'off' by stop button
-            main.update()
-            print("Ended cause of comma?")
-            break
-
-    print("receive_serial_dataAndSend2LSL finished")
-
-
-# ======================= Bluetooth communication functions ===========================================================
-def receive_ble_data():
-    """INPUT: None (uses received_data_L and received_data_R, but these are globals)
-    OUTPUT: Prints received bluetooth data to console, and to tkinter GUI
-
-    Menu communication is over when '^\n' has been received. That's what all these conditionals are checking for.
-    A line is over when '\n' has been received. This function waits until '^\n' has been received: otherwise,
-    it reads data indefinitely."""
-
-    global client_socket
-    global client_socket1
-
-    global received_data_L
-    global received_data_R
-    global L_state
-    L_state = 'rec'  # reset these every time 'receive_data' is called
-    global R_state
-    R_state = 'rec'
-    global buttons_state  # to know button states for main object (GUI state)
-    buttons_state = "on"
-    global switch2Save
-    switch2Save = False
-    global trial_start_L
-    trial_start_L = False
-    global trial_start_R
-    trial_start_R = False
-
-    global size
-
-    while (L_state == 'rec' or R_state == 'rec') and buttons_state == 'on' and (
-            switch2Save == False):
-        # L & R states are changed by finding end communication characters; buttons_state is changed by 'stop' button
-        main.update()
-        # === receiving & decoding of data ====
-        try:  # this statement should pass the .recv() call if .recv() receives 0 bytes. Google for more info.
-            data_L = client_socket.recv(size)  # limits buffer size to 1 byte: controls data flow since whatever
-            # bluetooth protocol doesn't package data like Arduino sends it
-            data_L = data_L.decode('utf-8')  # decodes characters according to utf-8
-            received_data_L = received_data_L + data_L  # adds up characters until newline character is received
-
-        except OSError as err:
-            # print("OS Error: {0}".format(err))
-            pass
-
-        try:  # this statement should pass the .recv() call if it receives 0 bytes
-            data_R = client_socket1.recv(size)
-            data_R = data_R.decode('utf-8')
-            received_data_R = received_data_R + data_R
-
-        except OSError as err:
-            # print("OS Error: {0}".format(err))
-            pass
-
-        # === checks for end_string (end communication) and prints ====
-        if end_string in received_data_L and L_state != 'fin':
-            # send text to it's respective locations
-            if page == "trialpage":
-                main.p1.LeftConsole.insert(INSERT, received_data_L)  # insert text to scrolled text widget
-                main.p1.LeftConsole.see("end")  # autoscroll to bottom
-            elif page == "testpage":
-                main.p2.LeftConsole.insert(INSERT, received_data_L)  # insert text to scrolled text widget
-                main.p2.LeftConsole.see("end")  # autoscroll to bottom
-
-            if prompt_char in received_data_L and end_string in received_data_L:
-                L_state = 'fin'
-            if trial_start_char in received_data_L:
-                trial_start_L = True
-            received_data_L = ""
-            main.update()
-
-        if end_string in received_data_R and R_state != 'fin':
-            if page == "trialpage":
-                main.p1.RightConsole.insert(INSERT, received_data_R)  # insert text to scrolled text widget
-                main.p1.RightConsole.see("end")  # autoscroll to bottom
-            elif page == "testpage":
-                main.p2.RightConsole.insert(INSERT, received_data_R)  # insert text to scrolled text widget
-                main.p2.RightConsole.see("end")  # autoscroll to bottom
-
-            if prompt_char in received_data_R and end_string in received_data_R:  # set to 'or' in case one teensy gets
-                R_state = 'fin'  # 'finished'                                    # multiple bytes ahead of the other
-            # if prompt character is received, terminates receive_data()
-            if trial_start_char in received_data_R:
-                trial_start_R = True
-            received_data_R = ""
-            main.update()
-
-        # === conditionals to end loop: conditions are prompt character or change in button state or start trial ====
-        # checks to see if the prompt character is in communication to end bluetooth sending communication
-        if (trial_start_L == True) and (trial_start_R == True):
-            start_trial()
-            print("ReceiveBLE broke on trial_start variables")
-            break
-        if L_state == 'fin' and R_state == 'fin':  # 'finished'
-            print("receiveBLE broke on state variables")
-            main.update()
-            break
-        # checks to see if buttons have been turned off
-        if buttons_state == "off":  # button is turned to 'off' by stop button
-            print("ReceiveBLE btroke on button_state")
-            main.update()
-            break
-
-        main.update()
-    print("receive_ble_data finished")
-
-
-def receive_ble_data_and_send2LSL():
-    """INPUT: None (uses received_data_L and received_data_R, but these are globals)
-    OUTPUT: Sends received data to LSL to be saved.
-
-    Menu communication is over when '^\n' has been received. That's what all these conditionals are checking for.
-    A line is over when '\n' has been received. This function waits until '^\n' has been received: otherwise,
-    it reads data indefinitely."""
-
-    print("receive_ble_data_and_send2LSL is running... I promise...")
-
-    global client_socket
-    global client_socket1
-
-    global received_data_L
-    global received_data_R
-    global L_state
-    L_state = 'rec'  # reset these every time 'receive_data' is called
-    global R_state
-    R_state = 'rec'
-    global buttons_state  # to know button states for main object (GUI state)
-    buttons_state = "on"
-    global trial_stop_L
-    trial_stop_L = False
-    global trial_stop_R
-    trial_stop_R = False
-
-    global size
-
-    # counter = 1  # for clocking how fast the GUI collects data, uncomment to use
-
-    main.p1.LeftConsole.insert(INSERT,
-                               'Trial is running... press "Finish Trial" to end\n')  # insert text to scrolled text widget
-    main.p1.RightConsole.insert(INSERT,
-                                'Trial is running... press "Finish Trial" to end\n')  # insert text to scrolled text widget
-
-    while (L_state == 'rec' or R_state == 'rec') and buttons_state == 'on':
-        # L & R states are changed by finding end communication characters; buttons_state is changed by 'stop' button
-        main.update()
-
-        # === receiving & decoding of data ====
-        try:  # this statement should pass the .recv() call if .recv() receives 0 bytes. Google for more info.
-            data_L = client_socket.recv(size)  # limits buffer size to 1 byte: controls data flow since whatever
-            data_L = data_L.decode('utf-8')  # decodes characters according to utf-8
-            received_data_L = received_data_L + data_L  # adds up characters until newline character is received
-
-        except OSError as err:
-            # print("OS Error: {0}".format(err))
-            pass
-
-        try:  # this statement should pass the .recv() call if it receives 0 bytes
-            data_R = client_socket1.recv(size)
-            data_R = data_R.decode('utf-8')
-            received_data_R = received_data_R + data_R
-
-        except OSError as err:
-            # print("OS Error: {0}".format(err))
-            pass
-
-        # outlet_GUI.push_sample([counter])  # for clocking how fast the GUI collects data, uncomment to use
-        # counter += 1  # uncomment to for clocking how fast GUI collects data
-
-        # === checks for end_string (end communication) and prints ====
-        if end_string in received_data_L and L_state != 'fin':
-            # send text to it's respective locations
-            # main.p1.LeftConsole.insert(INSERT, received_data_L)  # insert text to scrolled text widget
-            # main.p1.LeftConsole.see("end")  # autoscroll to bottom. This line takes ridiculously long to execute
-            main.update()
-
-            # splits lines into the 8 different data types being received
-            data2SaveLL = received_data_L.split("\t")
-
-            try:  # pushes samples to LSL
-                data2SaveLL_Floats = [float(i) for i in data2SaveLL]  # converts a list of strings to floats
-                outlet_LL.push_sample(data2SaveLL_Floats)
-            except ValueError:
-                # global trial_stop_L
-                trial_stop_L = True
-                print("Ending trial...")
-
-            if prompt_char in received_data_L and end_string in received_data_L:
-                L_state = 'fin'
-
-            received_data_L = ""  # resets received_data_L for next pass
-
-        if end_string in received_data_R and R_state != 'fin':
-            # main.p1.RightConsole.insert(INSERT, received_data_R)  # insert text to scrolled text widget
-            # main.p1.RightConsole.see("end")  # autoscroll to bottom. This line takes ridiculously long to execute
-            main.update()
-
-            # splits lines into the 8 different data types being received
-            data2SaveRL = received_data_R.split("\t")  # parses data by tab character
-            try:
-                data2SaveRL_Floats = [float(i) for i in data2SaveRL]  # converts strings to floats
-                outlet_RL.push_sample(data2SaveRL_Floats)
-            except ValueError:
-                # global trial_stop_R
-                trial_stop_R = True
-                print("Ending trial...")
-
-            if prompt_char in received_data_R and end_string in received_data_R:  # set to 'or' in case one teensy gets
-                R_state = 'fin'  # 'finished'                                    # multiple bytes ahead of the other
-
-            received_data_R = ""
-
-        main.update()
-
-        # === conditionals to end loop: conditions are prompt character or change in button state ===
-        # checks to see if the prompt character is in communication to end bluetooth sending communication or if
-        # trial stop character is in communication
-        if (trial_stop_L == True) and (trial_stop_R == True):
-            main.update()
-            received_data_R = ""
-            received_data_L = ""
-            print("Made it to trail stop evaluations")
-            stop_trial()
-            break
-        if L_state == 'fin' and R_state == 'fin':  # 'finished'
-            main.update()
-            print("Ended on this state change")
-            break
-        # checks to see if buttons have been turned off
-        if buttons_state == "off":  # button is turned to 'off' by stop button
-            main.update()
-            print("Ended cause of comma?")
-            break
-
-    print("receive_ble_data_and_send2LSL finished")
-
 # ======================= GUI code (Tkinter) ========================================================================
 """For an overview of the funcitonal purpose of the widgets and how they interact with the rest of the code, visit
 https://github.com/NIHFAB/PREX-GUI-FAB/wiki , 1. User Text Entry, 2. User Control to Send Text, and
@@ -1586,8 +1511,7 @@ class LandingPage(Page):
                         "This page is where you set trial parameters,\nsuch as which controller you want to use and desired "
                         "state machine. \n\nImportant Notes: \n1) On the 'Prelim' page, testing the Adaptive Controller pulls "
                         "parameters from the 'Trial' page to save space. \n2) The gains set for any controller during "
-                        "preliminary testing will be retained during the trial.\n3) DO NOT move/grab the GUI when data is "
-                        "being collected. This will pause the data from being saved.")
+                        "preliminary testing will be retained during the trial.")
         # Instructions = "Test text"
         self.INSTRUCTIONS = tk.Label(self.landingframe, text=Instructions, justify=LEFT)
         self.INSTRUCTIONS.config(font=
@@ -3076,7 +3000,7 @@ class MainMenuPage(Page):
         # Send 'H' which the Arduino
         # detects as turning the light on
         global buttons_state
-        buttons_state = "off"  # ends previous receive_serial_data
+        buttons_state = "off"  # ends previous receive_data
         buttons_state = "on"
         receive_data()
 
@@ -3792,7 +3716,7 @@ class TestingPage(Page):
         # Send 'H' which the Arduino
         # detects as turning the light on
         global buttons_state
-        buttons_state = "off"  # ends previous receive_serial_data
+        buttons_state = "off"  # ends previous receive_data
         buttons_state = "on"
         receive_data()
 
@@ -4510,6 +4434,8 @@ class MainView(tk.Frame):  # MainMenuPage,
                             overrelief="raised")
         self.b9 = tk.Button(buttonframe, text="Wire", command=self.create_ser_window, relief="groove",
                             overrelief="raised")
+        self.b10 = tk.Button(buttonframe, text="Wi-Fi", command=self.create_net_window, relief="groove",
+                             overrelief="raised")
 
         self.lab1 = tk.Label(buttonframe, text="Connection Type: ")
         self.logoimage = PhotoImage(file="./graphics/nih_logo_3.gif")  # NIH logo in the bottom righthand corner
@@ -4522,6 +4448,7 @@ class MainView(tk.Frame):  # MainMenuPage,
         self.lablogo.pack(side=RIGHT)
         self.b8.pack(side=RIGHT)
         self.b9.pack(side=RIGHT)
+        self.b10.pack(side=RIGHT)
         self.lab1.pack(side=RIGHT)
 
         self.p7.show()
@@ -4569,10 +4496,23 @@ class MainView(tk.Frame):  # MainMenuPage,
     def connectBLE(self):
         global comType
         comType = 'BLE'
+        global use_engine
+        use_engine = self.BLEENGINE.get() == 1
+        global use_realtime
+        use_realtime = self.BLEREALTIME.get() == 1
+        global use_capture
+        use_capture = self.BLECAPTURE.get() == 1
+        global telemetry
+        telemetry = self.BLETELEMETRY.get()
 
         add1 = str(self.LMACADDRESS.get())  # address 1
         add2 = str(self.RMACADDRESS.get())
-        connect_to_exo(comType, add1, add2)
+        try:
+            others = parse_devices(self.BLEOTHERS.get())
+        except ValueError as err:
+            show_connection_status("Other devices: " + str(err))
+            return
+        connect_to_exo(comType, add1, add2, others=others)
 
     def create_ble_window(self):  # creates subwindow with mac addresses, facilitates initial connection to Arduino
         bluetooth_menu = tk.Toplevel(self)
@@ -4582,7 +4522,7 @@ class MainView(tk.Frame):  # MainMenuPage,
         self.bt_lbl = tk.Label(self.bt_menu_frame, text="Bluetooth Setup Window")
         self.bt_lbl.config(font=
                            ('TKDefaultFont', 9, 'bold'))
-        self.bt_lbl.grid(row=0, column=0, columnspan=2, padx=10, pady=5)
+        self.bt_lbl.grid(row=0, column=0, columnspan=3, padx=10, pady=5)
 
         self.LMACADDRESS = tk.Entry(self.bt_menu_frame, width=20)
         self.LMACADDRESS.grid(row=1, column=1)
@@ -4591,9 +4531,14 @@ class MainView(tk.Frame):  # MainMenuPage,
         self.RMACADDRESS.grid(row=2, column=1)
 
         self.BLECONBOX = tk.Label(self.bt_menu_frame, width=40, height=10)
-        self.BLECONBOX.grid(row=4, column=0, columnspan=2)
+        self.BLECONBOX.grid(row=6, column=0, columnspan=3)
         self.BLECONBOX['text'] = "Connection Confirmation:"
 
+        # how each device's bluetooth link keeps up, once connected (see show_link_monitor())
+        self.BLEMONITOR = tk.Label(self.bt_menu_frame, width=90, justify=LEFT)
+        self.BLEMONITOR.grid(row=7, column=0, columnspan=3)
+        self.BLEMONITOR['text'] = "Link monitor:"
+
         # testing mac addresses
         # serverMACAddress = '00:06:66:FB:AD:2B'  # left leg
         # serverMACAddress1 = '00:06:66:FB:AD:C7'  # right leg
@@ -4617,16 +4562,66 @@ class MainView(tk.Frame):  # MainMenuPage,
         right_mac_lbl = tk.Label(self.bt_menu_frame, text="Right Mac Address")
         right_mac_lbl.grid(row=2, column=0)
 
+        # other devices read along with the legs, e.g. HIP=00:06:66:xx:xx:xx (see parse_devices())
+        other_ble_lbl = tk.Label(self.bt_menu_frame, text="Other devices")
+        other_ble_lbl.grid(row=3, column=0)
+        self.BLEOTHERS = tk.Entry(self.bt_menu_frame, width=20)
+        self.BLEOTHERS.grid(row=3, column=1)
+
+        # writes every byte received to a file per device, for debugging (see RawCapture in prex_acquisition.py)
+        self.BLECAPTURE = tk.IntVar(value=0)
+        self.BLE_CAPTURE_BOX = tk.Checkbutton(self.bt_menu_frame, text="Capture raw bytes", variable=self.BLECAPTURE)
+        self.BLE_CAPTURE_BOX.grid(row=3, column=2)
+
+        # runs the receiving/saving in its own process (see AcquisitionEngine in prex_acquisition.py)
+        self.BLEENGINE = tk.IntVar(value=0)
+        self.BLE_ENGINE_BOX = tk.Checkbutton(self.bt_menu_frame, text="Separate acquisition process",
+                                             variable=self.BLEENGINE)
+        self.BLE_ENGINE_BOX.grid(row=4, column=0)
+
+        # asks the legs for binary frames, COBS or delta packets instead of text lines (see negotiate_telemetry())
+        self.BLETELEMETRY = tk.StringVar(self)
+        self.BLETELEMETRY.set("Text")
+        self.BLE_TELEMETRY_MENU = OptionMenu(self.bt_menu_frame, self.BLETELEMETRY, *telemetry_wires)
+        self.BLE_TELEMETRY_MENU.grid(row=4, column=1)
+
+        # real-time priority, a core of its own and locked memory for the receiving (Linux, see set_realtime())
+        self.BLEREALTIME = tk.IntVar(value=0)
+        self.BLE_REALTIME_BOX = tk.Checkbutton(self.bt_menu_frame, text="Real-time mode", variable=self.BLEREALTIME)
+        self.BLE_REALTIME_BOX.grid(row=4, column=2)
+
         self.CONNECT_BLE = tk.Button(self.bt_menu_frame, text="Connect Bluetooth", command=self.connectBLE)
-        self.CONNECT_BLE.grid(row=3, column=0, columnspan=2, pady=10)
+        self.CONNECT_BLE.grid(row=5, column=0, pady=10)
+
+        # measures what each leg's link really carries, once connected (see probe_link())
+        self.PROBE_BLE = tk.Button(self.bt_menu_frame, text="Probe Link", command=probe_link)
+        self.PROBE_BLE.grid(row=5, column=1, pady=10)
+
+        # looks for the legs' bluetooth modules, also done when this window opens (see start_discovery())
+        self.SCAN_BLE = tk.Button(self.bt_menu_frame, text="Scan", command=lambda: start_discovery('BLE'))
+        self.SCAN_BLE.grid(row=5, column=2, pady=10)
+        start_discovery('BLE')
 
     def connectSER(self):
         global comType
         comType = 'Ser'
+        global use_engine
+        use_engine = self.SERENGINE.get() == 1
+        global use_realtime
+        use_realtime = self.SERREALTIME.get() == 1
+        global use_capture
+        use_capture = self.SERCAPTURE.get() == 1
+        global telemetry
+        telemetry = self.SERTELEMETRY.get()
 
         add1 = str(self.LCOMPORT.get())  # address 1
         add2 = str(self.RCOMPORT.get())
-        connect_to_exo(comType, add1, add2)
+        try:
+            others = parse_devices(self.SEROTHERS.get())
+        except ValueError as err:
+            show_connection_status("Other devices: " + str(err))
+            return
+        connect_to_exo(comType, add1, add2, int(self.LBAUD.get()), int(self.RBAUD.get()), others)
 
     def create_ser_window(self):  # creates subwindow with USB ports, facilitates initial connection to Arduino
         serial_menu = tk.Toplevel(self)
@@ -4636,7 +4631,7 @@ class MainView(tk.Frame):  # MainMenuPage,
         self.ser_lbl = tk.Label(self.ser_menu_frame, text="Serial Setup Window")
         self.ser_lbl.config(font=
                             ('TKDefaultFont', 9, 'bold'))
-        self.ser_lbl.grid(row=0, column=0, columnspan=2, padx=10, pady=5)
+        self.ser_lbl.grid(row=0, column=0, columnspan=3, padx=10, pady=5)
 
         self.LCOMPORT = tk.Entry(self.ser_menu_frame, width=20)
         self.LCOMPORT.grid(row=1, column=1)
@@ -4645,7 +4640,7 @@ class MainView(tk.Frame):  # MainMenuPage,
         self.RCOMPORT.grid(row=2, column=1)
 
         self.SERCONBOX = tk.Label(self.ser_menu_frame, width=40, height=10)
-        self.SERCONBOX.grid(row=4, column=0, columnspan=2)
+        self.SERCONBOX.grid(row=6, column=0, columnspan=3)
         self.SERCONBOX['text'] = "Connection Confirmation:"
 
         # testing mac addresses
@@ -4665,14 +4660,155 @@ class MainView(tk.Frame):  # MainMenuPage,
         right_com_lbl = tk.Label(self.ser_menu_frame, text="Right Com Port")
         right_com_lbl.grid(row=2, column=0)
 
+        # other devices read along with the legs, e.g. HIP=COM7, IMU=COM8 (see parse_devices())
+        other_com_lbl = tk.Label(self.ser_menu_frame, text="Other devices")
+        other_com_lbl.grid(row=3, column=0)
+        self.SEROTHERS = tk.Entry(self.ser_menu_frame, width=20)
+        self.SEROTHERS.grid(row=3, column=1)
+
+        # writes every byte received to a file per device, for debugging (see RawCapture in prex_acquisition.py)
+        self.SERCAPTURE = tk.IntVar(value=0)
+        self.SER_CAPTURE_BOX = tk.Checkbutton(self.ser_menu_frame, text="Capture raw bytes", variable=self.SERCAPTURE)
+        self.SER_CAPTURE_BOX.grid(row=3, column=2)
+
+        # baud rate of each leg (ignored by the Teensy's own USB serial, used through a USB-UART adapter)
+        self.LBAUD = tk.StringVar(self)
+        self.LBAUD.set(str(default_baud))
+        self.LBAUDMENU = OptionMenu(self.ser_menu_frame, self.LBAUD, *[str(baud) for baud in bauds])
+        self.LBAUDMENU.grid(row=1, column=2)
+
+        self.RBAUD = tk.StringVar(self)
+        self.RBAUD.set(str(default_baud))
+        self.RBAUDMENU = OptionMenu(self.ser_menu_frame, self.RBAUD, *[str(baud) for baud in bauds])
+        self.RBAUDMENU.grid(row=2, column=2)
+
+        # runs the receiving/saving in its own process (see AcquisitionEngine in prex_acquisition.py)
+        self.SERENGINE = tk.IntVar(value=0)
+        self.SER_ENGINE_BOX = tk.Checkbutton(self.ser_menu_frame, text="Separate acquisition process",
+                                             variable=self.SERENGINE)
+        self.SER_ENGINE_BOX.grid(row=4, column=0)
+
+        # asks the legs for binary frames, COBS or delta packets instead of text lines (see negotiate_telemetry())
+        self.SERTELEMETRY = tk.StringVar(self)
+        self.SERTELEMETRY.set("Text")
+        self.SER_TELEMETRY_MENU = OptionMenu(self.ser_menu_frame, self.SERTELEMETRY, *telemetry_wires)
+        self.SER_TELEMETRY_MENU.grid(row=4, column=1)
+
+        # real-time priority, a core of its own, locked memory and low latency ports for the receiving (Linux, see
+        # set_realtime())
+        self.SERREALTIME = tk.IntVar(value=0)
+        self.SER_REALTIME_BOX = tk.Checkbutton(self.ser_menu_frame, text="Real-time mode", variable=self.SERREALTIME)
+        self.SER_REALTIME_BOX.grid(row=4, column=2)
+
         self.CONNECT_SER = tk.Button(self.ser_menu_frame, text="Connect Serial", command=self.connectSER)
-        self.CONNECT_SER.grid(row=3, column=0, columnspan=2, pady=10)
+        self.CONNECT_SER.grid(row=5, column=0, pady=10)
 
+        # measures what each leg's link really carries, once connected (see probe_link())
+        self.PROBE_SER = tk.Button(self.ser_menu_frame, text="Probe Link", command=probe_link)
+        self.PROBE_SER.grid(row=5, column=1, pady=10)
 
-root = tk.Tk()
-root.wm_geometry("1330x750")  # overall size of the GUI
-# can't exceed 1336x768 for HP Elitebook 850, 15.6 inch computer
+        # looks for the legs' serial ports, also done when this window opens (see start_discovery())
+        self.SCAN_SER = tk.Button(self.ser_menu_frame, text="Scan", command=lambda: start_discovery('Ser'))
+        self.SCAN_SER.grid(row=5, column=2, pady=10)
+        start_discovery('Ser')
 
-main = MainView(master=root)  # instantiates MainView, which instantiates all pages and widgets
-main.pack(side="top", fill="both", expand=True)
-root.mainloop()  # constantly updates main to look for user interaction and display things on the GUI
+    def connectNET(self):
+        global comType
+        comType = 'Net'
+        global use_engine
+        use_engine = self.NETENGINE.get() == 1
+        global use_realtime
+        use_realtime = self.NETREALTIME.get() == 1
+        global use_capture
+        use_capture = self.NETCAPTURE.get() == 1
+        global telemetry
+        telemetry = self.NETTELEMETRY.get()
+
+        add1 = str(self.LNETADDRESS.get())  # address 1
+        add2 = str(self.RNETADDRESS.get())
+        try:
+            others = parse_devices(self.NETOTHERS.get())
+        except ValueError as err:
+            show_connection_status("Other devices: " + str(err))
+            return
+        connect_to_exo(comType, add1, add2, others=others)
+
+    def create_net_window(self):  # creates subwindow with the Wi-Fi bridges' addresses, facilitates initial connection
+        network_menu = tk.Toplevel(self)
+        self.net_menu_frame = tk.Frame(network_menu)
+        self.net_menu_frame.pack(side=TOP, padx=20, pady=20)
+        self.net_lbl = tk.Label(self.net_menu_frame, text="Wi-Fi Setup Window")
+        self.net_lbl.config(font=
+                            ('TKDefaultFont', 9, 'bold'))
+        self.net_lbl.grid(row=0, column=0, columnspan=3, padx=10, pady=5)
+
+        # host:port of each leg's serial-to-Wi-Fi bridge, udp://host:port for UDP (see open_network())
+        self.LNETADDRESS = tk.Entry(self.net_menu_frame, width=20)
+        self.LNETADDRESS.grid(row=1, column=1)
+
+        self.RNETADDRESS = tk.Entry(self.net_menu_frame, width=20)
+        self.RNETADDRESS.grid(row=2, column=1)
+
+        self.NETCONBOX = tk.Label(self.net_menu_frame, width=40, height=10)
+        self.NETCONBOX.grid(row=6, column=0, columnspan=3)
+        self.NETCONBOX['text'] = "Connection Confirmation:"
+
+        # how each device's Wi-Fi link keeps up, once connected (see show_link_monitor())
+        self.NETMONITOR = tk.Label(self.net_menu_frame, width=90, justify=LEFT)
+        self.NETMONITOR.grid(row=7, column=0, columnspan=3)
+        self.NETMONITOR['text'] = "Link monitor:"
+
+        self.LNETADDRESS.insert(END, '192.168.4.1:23')
+        self.RNETADDRESS.insert(END, '192.168.4.2:23')
+
+        left_net_lbl = tk.Label(self.net_menu_frame, text="Left Address")
+        left_net_lbl.grid(row=1, column=0)
+
+        right_net_lbl = tk.Label(self.net_menu_frame, text="Right Address")
+        right_net_lbl.grid(row=2, column=0)
+
+        # other devices read along with the legs, e.g. HIP=192.168.4.3:23 (see parse_devices())
+        other_net_lbl = tk.Label(self.net_menu_frame, text="Other devices")
+        other_net_lbl.grid(row=3, column=0)
+        self.NETOTHERS = tk.Entry(self.net_menu_frame, width=20)
+        self.NETOTHERS.grid(row=3, column=1)
+
+        # writes every byte received to a file per device, for debugging (see RawCapture in prex_acquisition.py)
+        self.NETCAPTURE = tk.IntVar(value=0)
+        self.NET_CAPTURE_BOX = tk.Checkbutton(self.net_menu_frame, text="Capture raw bytes", variable=self.NETCAPTURE)
+        self.NET_CAPTURE_BOX.grid(row=3, column=2)
+
+        # runs the receiving/saving in its own process (see AcquisitionEngine in prex_acquisition.py)
+        self.NETENGINE = tk.IntVar(value=0)
+        self.NET_ENGINE_BOX = tk.Checkbutton(self.net_menu_frame, text="Separate acquisition process",
+                                             variable=self.NETENGINE)
+        self.NET_ENGINE_BOX.grid(row=4, column=0)
+
+        # asks the legs for binary frames, COBS or delta packets instead of text lines (see negotiate_telemetry())
+        self.NETTELEMETRY = tk.StringVar(self)
+        self.NETTELEMETRY.set("Text")
+        self.NET_TELEMETRY_MENU = OptionMenu(self.net_menu_frame, self.NETTELEMETRY, *telemetry_wires)
+        self.NET_TELEMETRY_MENU.grid(row=4, column=1)
+
+        # real-time priority, a core of its own and locked memory for the receiving (Linux, see set_realtime())
+        self.NETREALTIME = tk.IntVar(value=0)
+        self.NET_REALTIME_BOX = tk.Checkbutton(self.net_menu_frame, text="Real-time mode", variable=self.NETREALTIME)
+        self.NET_REALTIME_BOX.grid(row=4, column=2)
+
+        self.CONNECT_NET = tk.Button(self.net_menu_frame, text="Connect Wi-Fi", command=self.connectNET)
+        self.CONNECT_NET.grid(row=5, column=0, pady=10)
+
+        # measures what each leg's link really carries, once connected (see probe_link())
+        self.PROBE_NET = tk.Button(self.net_menu_frame, text="Probe Link", command=probe_link)
+        self.PROBE_NET.grid(row=5, column=1, pady=10)
+
+
+if __name__ == "__main__":  # the acquisition process imports this file too (on Windows), it mustn't open the GUI
+    root = tk.Tk()
+    root.wm_geometry("1330x750")  # overall size of the GUI
+    # can't exceed 1336x768 for HP Elitebook 850, 15.6 inch computer
+
+    main = MainView(master=root)  # instantiates MainView, which instantiates all pages and widgets
+    main.pack(side="top", fill="both", expand=True)
+    main.after(poll_interval, poll_receive)  # checks on the reader threads (receiving data) from now on
+    root.mainloop()  # constantly updates main to look for user interaction and display things on the GUI
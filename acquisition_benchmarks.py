@@ -0,0 +1,838 @@
+"""
+Benchmarks for the receiving side of the NIH P-Rex GUI (see prex_acquisition.py).
+
+These do not need an exoskeleton: a pseudo-terminal (pty) stands in for the Teensy's USB serial port, and fake
+telemetry lines (8 tab separated values, like the walking data) are written into it as fast as the OS allows.
+Linux/macOS only, because of the pty.
+
+Usage:
+    python acquisition_benchmarks.py serial      # bytes/s of the old 1-byte reads versus the bulk reads
+    python acquisition_benchmarks.py lines       # line assembly: searching for '\\n' from the front versus resuming
+    python acquisition_benchmarks.py idle        # CPU use and wake-up latency of the old busy polling versus waiting
+    python acquisition_benchmarks.py binary      # samples/s decoded from text lines versus binary frames
+    python acquisition_benchmarks.py parse       # text lines/s parsed one by one versus a buffer at a time (numpy)
+    python acquisition_benchmarks.py resync      # samples kept from a corrupted link: binary frames versus COBS packets
+    python acquisition_benchmarks.py quarantine  # samples saved from a corrupted text link: ending the trial or not
+    python acquisition_benchmarks.py loss        # samples left out versus counted missing from the Time channel
+    python acquisition_benchmarks.py delta       # bytes/sample and samples/s decoded: sample packets versus delta packets
+    python acquisition_benchmarks.py schema      # samples/s decoded with 8, 13 and mixed type channels (#SCHEMA line)
+    python acquisition_benchmarks.py devices     # CPU per device as devices are added: a thread each versus one Poller
+    python acquisition_benchmarks.py fair        # latency of a slow leg next to a bursting one: parse it all versus share
+    python acquisition_benchmarks.py jitter      # times between samples with the CPU busy: real-time mode off versus on
+    python acquisition_benchmarks.py capture     # lines/s received with and without the raw byte capture
+    python acquisition_benchmarks.py timestamps  # timestamps with a busy interpreter: when pushed versus Time channel
+    python acquisition_benchmarks.py drift       # timestamp error, drifting device clock: quickest read so far versus a fit
+    python acquisition_benchmarks.py network     # Wi-Fi bridge links (simulated on localhost): TCP versus UDP, Nagle
+"""
+
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import serial
+
+from prex_acquisition import read_available, LineBuffer, FrameBuffer, CobsBuffer, SimulatedExo, LegReader, Poller, \
+    serial_wait, poll_wait, drain_budget, set_realtime, RawCapture, lsl_clock, bytes_per_sample, SimulatedBridge, \
+    open_link, open_network, read_socket, frame_command, recv_size, net_recv_size, parse_lines, prompt_char, \
+    DeviceClock, device_time_scale, ChannelSchema, sim_channels
+
+telemetry_line = b"123456\t12.34\t-1.234\t512\t0.75\t2\t5.00\t30.00\n"  # TimeLL, AngleLL, TorqueLL, FSR, ...
+
+
+# ============================ fake device ============================================================================
+def open_fake_port(timeout=0):
+    """Returns (master_fd, port): the master side of a pty, and a serial.Serial opened on the slave side the same
+    way connect_to_exo() opens the real ports (timeout=0 is the old way, serial_wait the new one)."""
+    master, slave = os.openpty()
+    import tty
+    tty.setraw(slave)  # no echo / newline translation, like a real USB serial device
+    port = serial.Serial(os.ttyname(slave), 115200, timeout=timeout, bytesize=8, stopbits=1, parity='N')
+    os.close(slave)
+    return master, port
+
+
+def write_lines(master, n_lines):
+    """Writes n_lines telemetry lines into the pty as fast as possible (runs in its own thread)."""
+    chunk = telemetry_line * 64
+    for _ in range(n_lines // 64):
+        os.write(master, chunk)
+
+
+# ============================ receive paths ==========================================================================
+def old_serial_receive(port, n_lines):
+    """The original receive_ser_data_and_send2LSL() reading code: 1 byte per read, str concatenation."""
+    received_data = ""
+    lines = 0
+    while lines < n_lines:
+        data = port.read(1)
+        data = data.decode('utf-8')
+        received_data = received_data + data
+        if '\n' in received_data:
+            received_data.split("\t")
+            received_data = ""
+            lines += 1
+
+
+def new_serial_receive(port, n_lines):
+    """The bulk read path: drain everything waiting into a LineBuffer, then split off complete lines."""
+    buffer = LineBuffer()
+    lines = 0
+    while lines < n_lines:
+        buffer.feed(read_available(port))
+        while True:
+            line = buffer.next_line()
+            if line is None:
+                break
+            line.split("\t")
+            lines += 1
+
+
+def time_receive(receive, n_lines, timeout):
+    master, port = open_fake_port(timeout)
+    writer = threading.Thread(target=write_lines, args=(master, n_lines), daemon=True)
+    start = time.perf_counter()
+    writer.start()
+    receive(port, n_lines)
+    elapsed = time.perf_counter() - start
+    writer.join()
+    port.close()
+    os.close(master)
+    return n_lines * len(telemetry_line) / elapsed
+
+
+def bench_serial():
+    n_lines = 64 * 400
+    old = time_receive(old_serial_receive, n_lines, 0)
+    new = time_receive(new_serial_receive, n_lines, serial_wait)
+    print("serial receive over pty, %d lines of %d bytes" % (n_lines, len(telemetry_line)))
+    print("  1-byte reads: %12.0f bytes/s" % old)
+    print("  bulk reads:   %12.0f bytes/s  (%.1fx)" % (new, new / old))
+
+
+# ============================ line assembly ============================================================================
+class OldLineBuffer(LineBuffer):
+    """LineBuffer as it was: the search for '\\n' starts from the front of the buffer every time."""
+    def next_line(self):
+        end = self.buffer.find(b'\n')
+        if end < 0:
+            return None
+        line = self.buffer[:end + 1]
+        del self.buffer[:end + 1]
+        return line.decode('utf-8', errors='replace')
+
+
+def time_lines(buffer_type, data, chunk):
+    """Feeds data in reads of 'chunk' bytes, taking every complete line after each read. OUTPUT: MB/s"""
+    buffer = buffer_type()
+    start = time.perf_counter()
+    for i in range(0, len(data), chunk):
+        buffer.feed(data[i:i + chunk])
+        while buffer.next_line() is not None:
+            pass
+    return len(data) / (time.perf_counter() - start) / 1e6
+
+
+def bench_lines():
+    long_line = b"\t".join([b"12.34"] * 2000) + b"\n"  # e.g. a long menu or settings dump
+    print("                                         MB/s: searching from the front   from where it got to")
+    for name, data, chunk in (("telemetry lines, 64 kB reads", telemetry_line * 400000, 65536),
+                              ("12 kB lines, 64 byte reads", long_line * 200, 64),
+                              ("1 MB without a newline, 64 byte reads", b"\xA5" * (1 << 20), 64)):
+        old = time_lines(OldLineBuffer, data, chunk)
+        new = time_lines(LineBuffer, data, chunk)
+        print("  %-38s %32.1f %22.1f" % (name, old, new))
+
+
+# ============================ idle CPU and wake-up latency =============================================================
+def old_wait_for_line(port, buffer):
+    """The original loops: read(1) on a timeout=0 port over and over until a line is complete."""
+    received_data = ""
+    while '\n' not in received_data:
+        received_data = received_data + port.read(1).decode('utf-8')
+    return received_data
+
+
+def new_wait_for_line(port, buffer):
+    """The LegReader loop: read_available() sleeps in the OS until data arrives (or serial_wait passes)."""
+    while True:
+        line = buffer.next_line()
+        if line is not None:
+            return line
+        buffer.feed(read_available(port))
+
+
+def time_idle(wait_for_line, timeout, n_lines=50, gap=0.02):
+    """Writes one line every 'gap' seconds, so the port is idle most of the time. OUTPUT: CPU use (% of one core)
+    and the delays between writing each line and the reader having it (seconds)."""
+    master, port = open_fake_port(timeout)
+    sent = []
+
+    def writer():
+        for _ in range(n_lines):
+            time.sleep(gap)
+            sent.append(time.perf_counter())
+            os.write(master, telemetry_line)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    buffer = LineBuffer()
+    delays = []
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    thread.start()
+    for i in range(n_lines):
+        wait_for_line(port, buffer)
+        delays.append(time.perf_counter() - sent[i])
+    cpu = 100 * (time.process_time() - start_cpu) / (time.perf_counter() - start_wall)
+    thread.join()
+    port.close()
+    os.close(master)
+    delays.sort()
+    return cpu, delays
+
+
+def bench_idle():
+    print("idle port, one line every 20 ms (50 lines)")
+    print("                   CPU (% of a core)   median latency   max latency")
+    for name, wait_for_line, timeout in (("busy polling", old_wait_for_line, 0),
+                                         ("waiting", new_wait_for_line, serial_wait)):
+        cpu, delays = time_idle(wait_for_line, timeout)
+        print("  %-14s %12.1f %17.3f ms %12.3f ms" % (name, cpu, 1000 * delays[len(delays) // 2],
+                                                       1000 * delays[-1]))
+
+
+# ============================ text versus binary telemetry =============================================================
+def bench_binary():
+    n = 100000
+    sim = SimulatedExo()
+    samples = sim.samples(n)
+    text = sim.encode(samples)
+    sim.wire = 'binary'
+    frames = sim.encode(samples)
+
+    buffer = LineBuffer()
+    start = time.perf_counter()
+    buffer.feed(text)
+    while True:
+        line = buffer.next_line()
+        if line is None:
+            break
+        [float(i) for i in line.split("\t")]
+    text_rate = n / (time.perf_counter() - start)
+
+    buffer = FrameBuffer()
+    start = time.perf_counter()
+    buffer.feed(frames)
+    decoded = buffer.next_frames()
+    binary_rate = n / (time.perf_counter() - start)
+    assert len(decoded) == n
+
+    print("decoding %d samples of 8 channels" % n)
+    print("  text:   %6.1f bytes/sample %12.0f samples/s" % (len(text) / n, text_rate))
+    print("  binary: %6.1f bytes/sample %12.0f samples/s" % (len(frames) / n, binary_rate))
+
+
+# ============================ text lines: one by one versus a buffer at a time ==========================================
+def time_parse(batch, data, chunk, reader=False):
+    """Feeds data in reads of 'chunk' bytes, parsing the complete lines after each read: one by one (split + float,
+    as handle_save_line() did) or with parse_lines(). reader = True goes through a LegReader in the save mode instead,
+    pushing to a CountingOutlet with timestamps. OUTPUT: lines/s"""
+    buffer = LineBuffer()
+    leg = LegReader('L', None, None, CountingOutlet())
+    leg.arm('save')
+    lines = 0
+    start = time.perf_counter()
+    for i in range(0, len(data), chunk):
+        if reader:
+            leg.feed(data[i:i + chunk])
+            if batch:
+                leg.handle_lines()
+            else:
+                while True:
+                    line = leg.buffer.next_line()
+                    if line is None:
+                        break
+                    leg.handle_save_line(line)
+            continue
+        buffer.feed(data[i:i + chunk])
+        if batch:
+            view = buffer.next_lines_view()
+            if view is not None:
+                lines += len(parse_lines(view)[0])
+        else:
+            while True:
+                line = buffer.next_line()
+                if line is None:
+                    break
+                [float(value) for value in line.split("\t")]
+                lines += 1
+    elapsed = time.perf_counter() - start
+    return (leg.outlet.samples if reader else lines) / elapsed
+
+
+def bench_parse():
+    data = telemetry_line * 200000
+    print("parsing %d telemetry lines                      lines/s: one by one   a buffer at a time" % 200000)
+    for name, chunk, reader in (("4 kB reads", 4096, False), ("64 kB reads", 65536, False),
+                                ("4 kB reads, LegReader pushing", 4096, True),
+                                ("64 kB reads, LegReader pushing", 65536, True)):
+        print("  %-44s %20.0f %20.0f" % (name, time_parse(False, data, chunk, reader),
+                                         time_parse(True, data, chunk, reader)))
+
+
+# ============================ damaged link: binary frames versus COBS packets ==========================================
+def bench_resync():
+    n = 100000
+    print("decoding %d samples with bits flipped at random (kept / wrong values kept / samples/s)" % n)
+    for corrupt in (1e-5, 1e-4, 1e-3):
+        print("  %g of the bytes damaged" % corrupt)
+        for name, wire, checksum in (("binary frames", 'binary', False), ("COBS", 'cobs', False),
+                                     ("COBS + CRC", 'cobs', True), ("delta + CRC", 'delta', True)):
+            sim = SimulatedExo(corrupt=corrupt)
+            sim.wire = wire
+            sim.checksum = checksum
+            samples = sim.samples(n)
+            data = sim.damage(sim.encode(samples))
+            buffer = FrameBuffer() if wire == 'binary' else CobsBuffer(checksum=checksum)
+            start = time.perf_counter()
+            buffer.feed(data)
+            decoded = []
+            while True:  # like LegReader.handle_lines(): frames, or else the (garbage) text line in front of them
+                frames = buffer.next_frames()
+                if frames is not None:
+                    decoded.append(frames)
+                elif buffer.next_line() is None:
+                    break
+            decoded = np.vstack(decoded)
+            rate = n / (time.perf_counter() - start)
+            # a sample is wrong if it isn't one of the samples sent (the time channel says which one it should be);
+            # delta packets send the values rounded to 0.01
+            index = np.clip(np.round(decoded[:, 0] * sim.rate / 1000).astype(np.int64), 0, n - 1)
+            close = np.abs(decoded - samples[index]) <= (0.006 if wire == 'delta' else 0)
+            wrong = np.count_nonzero(~close.all(axis=1) & ~np.isnan(decoded).all(axis=1))
+            print("    %-14s %7d %7d %12.0f" % (name, len(decoded), wrong, rate))
+
+
+# ============================ damaged text lines: ending the trial versus quarantine ===================================
+class OldStopLegReader(LegReader):
+    """LegReader as it was: a line that can't be turned into floats ends the trial."""
+    def handle_save_line(self, line):
+        try:
+            sample = [float(i) for i in line.split("\t")]
+            self.outlet.push_sample(sample)
+        except Exception:
+            self.trial_stop = True
+        if prompt_char in line:
+            self.fin = True
+            self.mode = 'hold'
+
+
+def time_quarantine(reader_type, data, chunk=4096):
+    """Feeds data to a LegReader in the save mode in reads of 'chunk' bytes, until the trial ends (like the GUI
+    stopping it when trial_stop is set) or the data runs out. OUTPUT: (samples pushed, lines quarantined)"""
+    leg = reader_type('L', None, None, CountingOutlet())
+    leg.arm('save')
+    for i in range(0, len(data), chunk):
+        leg.receive(data[i:i + chunk])
+        if leg.trial_stop:
+            break
+    return leg.outlet.samples, leg.quarantined
+
+
+def bench_quarantine():
+    n = 100000
+    print("a %d sample trial over a text link with bits flipped at random (samples pushed / lines quarantined)" % n)
+    print("                        trial ends on a bad line        bad lines quarantined")
+    for corrupt in (1e-6, 1e-5, 1e-4, 1e-3):
+        sim = SimulatedExo(corrupt=corrupt)
+        data = sim.damage(sim.encode(sim.samples(n)))
+        old, _ = time_quarantine(OldStopLegReader, data)
+        new, quarantined = time_quarantine(LegReader, data)
+        print("  %-8g of the bytes %13d %28d / %d" % (corrupt, old, new, quarantined))
+
+
+# ============================ sample loss from the Time channel ========================================================
+def bench_loss():
+    n = 100000
+    rng = np.random.default_rng(0)
+    print("a %d sample trial with samples left out at random, through a LegReader (text lines, 4 kB reads)" % n)
+    print("                        samples left out   counted missing   gaps marked   lines/s")
+    for name, dropped in (("none", 0.0), ("1 in 1000", 0.001), ("1 in 100", 0.01), ("1 in 10", 0.1)):
+        sim = SimulatedExo()
+        samples = sim.samples(n)
+        keep = rng.random(n) >= dropped
+        keep[:2] = True  # the first sample isn't missing, it's the start
+        data = sim.encode(samples[keep])
+        leg = LegReader('L', None, None, CountingOutlet())
+        leg.loss_outlet = CountingOutlet()
+        leg.arm('save')
+        start = time.perf_counter()
+        for i in range(0, len(data), 4096):
+            leg.receive(data[i:i + 4096])
+        rate = leg.outlet.samples / (time.perf_counter() - start)
+        print("  %-18s %17d %17d %13d %9.0f" % (name, n - np.count_nonzero(keep), leg.loss.missing,
+                                                leg.loss_outlet.samples, rate))
+
+
+# ============================ sample packets versus delta packets ======================================================
+def bench_delta(link_rate=11520):
+    n = 100000
+    sim = SimulatedExo()
+    smooth = sim.samples(n)
+    noisy = smooth + np.round(np.random.default_rng(0).normal(0, 0.05, smooth.shape), 2).astype(np.float32)
+    noisy[:, 0] = smooth[:, 0]  # sensor noise, the time channel as it was
+    print("decoding %d samples of 8 channels (text: SimulatedExo's samples); samples/s that fit in %d bytes/s"
+          % (n, link_rate))
+    print("                          bytes/sample   smaller   decoded samples/s   fit in the link")
+    for name, wire, samples in (("text", 'ascii', smooth), ("sample packets", 'cobs', smooth),
+                                ("delta packets", 'delta', smooth), ("delta, noisy sensors", 'delta', noisy)):
+        sim.wire = wire
+        data = sim.encode(samples)
+        buffer = LineBuffer() if wire == 'ascii' else CobsBuffer()
+        start = time.perf_counter()
+        buffer.feed(data)
+        if wire == 'ascii':
+            while True:
+                line = buffer.next_line()
+                if line is None:
+                    break
+                [float(i) for i in line.split("\t")]
+        else:
+            decoded = buffer.next_frames()
+            assert len(decoded) == n and np.abs(decoded - samples).max() < 0.006
+        rate = n / (time.perf_counter() - start)
+        size = len(data) / n
+        print("  %-22s %12.1f %8.1fx %19.0f %17d" % (name, size, bytes_per_sample['cobs'] / size, rate,
+                                                     0.8 * link_rate / size))
+
+
+# ============================ channel schema: wider samples, mixed types ================================================
+wide_channels = ["Hip Angle", "Hip Torque", "Knee Angle", "Knee Torque", "Step Count"]  # 5 more, after sim_channels
+wide_types = ['f8', 'f4', 'f4', 'u2', 'f4', 'u1', 'f4', 'f4', 'i2', 'i2', 'i2', 'i2', 'u4']
+
+
+def bench_schema():
+    n = 100000
+    print("decoding %d samples with the layout from the device's #SCHEMA line (SimulatedExo's samples)" % n)
+    print("  channels                 wire      bytes/sample   decoded samples/s")
+    for name, schema in (("8 x float32 (default)", None),
+                         ("13 x float32", ChannelSchema(sim_channels + wide_channels)),
+                         ("13, mixed types", ChannelSchema(sim_channels + wide_channels, wide_types))):
+        sim = SimulatedExo(schema=schema)
+        samples = sim.samples(n)
+        for wire in ('ascii', 'binary', 'cobs', 'delta'):
+            sim.wire = wire
+            data = sim.encode(samples)
+            buffer = {'ascii': LineBuffer, 'binary': FrameBuffer}.get(wire, CobsBuffer)(schema=sim.schema)
+            start = time.perf_counter()
+            buffer.feed(data)
+            if wire == 'ascii':
+                decoded = parse_lines(buffer.next_lines_view(), sim.schema.n)[0]
+                buffer.release()
+            else:
+                decoded = buffer.next_frames()
+            rate = n / (time.perf_counter() - start)
+            assert decoded.shape == (n, sim.schema.n) and np.abs(decoded - samples).max() < 0.006
+            print("  %-24s %-8s %14.1f %19.0f" % (name, wire, len(data) / n, rate))
+
+
+# ============================ many devices: a thread each versus one poller =============================================
+class CountingOutlet:
+    """Stands in for a StreamOutlet, counting the samples pushed."""
+    def __init__(self):
+        self.samples = 0
+
+    def push_sample(self, sample, timestamp=0.0):
+        self.samples += 1
+
+    def push_chunk(self, samples, timestamp=0.0):
+        self.samples += len(samples)
+
+
+def time_devices(n_devices, use_poller, seconds=2.0, rate=1000):
+    """Every device gets 'rate' lines/s (in 10 ms bursts, like the Teensy's USB packets). OUTPUT: CPU use (% of one
+    core) and the fraction of the lines that were pushed."""
+    fakes = [open_fake_port(serial_wait) for _ in range(n_devices)]
+    readers = []
+    poller = Poller()
+    for i, (master, port) in enumerate(fakes):
+        reader = LegReader(str(i), (lambda port: lambda: read_available(port))(port), port.write, CountingOutlet())
+        reader.arm('save')
+        readers.append(reader)
+        if use_poller:
+            poller.add(reader, port)
+        else:
+            reader.start()
+    if use_poller:
+        poller.start()
+
+    burst = telemetry_line * (rate // 100)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    for tick in range(int(seconds * 100)):
+        for master, _ in fakes:
+            os.write(master, burst)
+        time.sleep(max(0.0, start_wall + (tick + 1) / 100 - time.perf_counter()))
+    time.sleep(0.1)  # the last lines
+    cpu = 100 * (time.process_time() - start_cpu) / (time.perf_counter() - start_wall)
+    pushed = sum(reader.outlet.samples for reader in readers) / (n_devices * int(seconds * 100) * (rate // 100))
+
+    poller.stop()
+    for reader in readers:
+        reader.stop()
+    time.sleep(2 * serial_wait)
+    for master, port in fakes:
+        port.close()
+        os.close(master)
+    return cpu, pushed
+
+
+def bench_devices():
+    print("devices sending 1000 lines/s each (CPU includes writing the fake data)")
+    print("  devices   thread each: CPU %  pushed      one Poller: CPU %  pushed")
+    for n_devices in (1, 2, 8, 32):
+        threads = time_devices(n_devices, False)
+        polled = time_devices(n_devices, True)
+        print("  %7d %18.1f %7.1f%% %18.1f %7.1f%%" % (n_devices, threads[0], 100 * threads[1], polled[0],
+                                                       100 * polled[1]))
+
+
+# ============================ a flooding leg next to a slow one ===========================================================
+class TimingOutlet(CountingOutlet):
+    """Counts the samples pushed, and notes when each one was (by 'clock') and the timestamp it was pushed with."""
+    def __init__(self, clock=time.perf_counter):
+        CountingOutlet.__init__(self)
+        self.clock = clock
+        self.times = []
+        self.stamps = []
+
+    def push_sample(self, sample, timestamp=0.0):
+        CountingOutlet.push_sample(self, sample)
+        self.times.append(self.clock())
+        self.stamps.append(timestamp)
+
+    def push_chunk(self, samples, timestamp=0.0):
+        CountingOutlet.push_chunk(self, samples)
+        self.times.extend([self.clock()] * len(samples))
+        self.stamps.extend(timestamp if isinstance(timestamp, list) else [timestamp] * len(samples))
+
+
+def time_fair(budget, seconds=2.0, gap=0.01, burst=128 * 1024, burst_gap=0.05):
+    """One leg sends 'burst' bytes every 'burst_gap' seconds (catching up after a stall, say), the other a line every
+    'gap' seconds. The bursts go over a socket pair, because a pty only holds a few kB. OUTPUT: the slow leg's delays
+    between writing each line and pushing it (seconds), and the fraction of the bursting leg's lines pushed."""
+    flood_send, flood_receive = socket.socketpair()
+    flood_receive.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * burst)
+    slow_master, slow_port = open_fake_port(serial_wait)
+    poller = Poller(budget)
+    readers = []
+    for name, link, read in (('L', flood_receive, lambda: flood_receive.recv(1 << 20)),
+                             ('R', slow_port, lambda: read_available(slow_port))):
+        reader = LegReader(name, read, None, TimingOutlet())
+        reader.arm('save')
+        readers.append(reader)
+        poller.add(reader, link)
+    poller.start()
+
+    chunk = telemetry_line * (burst // len(telemetry_line))
+    sent = []
+    start = time.perf_counter()
+    for tick in range(int(seconds / gap)):
+        time.sleep(max(0.0, start + (tick + 1) * gap - time.perf_counter()))
+        if tick % round(burst_gap / gap) == 0:
+            flood_send.sendall(chunk)
+        sent.append(time.perf_counter())
+        os.write(slow_master, telemetry_line)
+    time.sleep(0.2)  # the last lines
+    delays = sorted(pushed - written for written, pushed in zip(sent, readers[1].outlet.times))
+    pushed = readers[0].outlet.samples / (int(seconds / burst_gap) * (burst // len(telemetry_line)))
+
+    poller.stop()
+    time.sleep(2 * poll_wait)
+    flood_send.close()
+    flood_receive.close()
+    slow_port.close()
+    os.close(slow_master)
+    return delays, pushed
+
+
+def bench_fair():
+    print("one leg sending 128 kB bursts every 50 ms, the other a line every 10 ms")
+    print("  parsing per pass        slow leg: median latency   max latency   lines pushed    bursting leg: pushed")
+    for name, budget in (("everything", None), ("%d B shared" % drain_budget, drain_budget)):
+        delays, pushed = time_fair(budget)
+        print("  %-18s %21.3f ms %10.3f ms %14d %22.1f%%" % (name, 1000 * delays[len(delays) // 2], 1000 * delays[-1],
+                                                             len(delays), 100 * pushed))
+
+
+# ============================ real-time mode: arrival jitter ==============================================================
+def write_paced(master, n_lines, period):
+    """Stands in for the Teensy in its own process: one line every 'period' seconds, with the real-time settings if
+    allowed (both runs alike), so the timing of the sending doesn't blur the timing of the receiving."""
+    set_realtime()
+    start = time.perf_counter()
+    for i in range(n_lines):
+        time.sleep(max(0.0, start + i * period - time.perf_counter()))
+        os.write(master, telemetry_line)
+
+
+def spin(seconds):
+    """Keeps a core busy, like the GUI and everything else running during a trial."""
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def time_jitter(realtime, seconds=3.0, period=0.001):
+    """OUTPUT: the times between the samples pushed (seconds), with every core kept busy meanwhile."""
+    master, port = open_fake_port(serial_wait)
+    reader = LegReader('L', lambda: read_available(port), port.write, TimingOutlet())
+    reader.arm('save')
+    poller = Poller(realtime=realtime)
+    poller.add(reader, port)
+    poller.start()
+    time.sleep(0.1)  # the real-time settings are printed
+    load = [multiprocessing.Process(target=spin, args=(seconds + 0.5,)) for _ in range(os.cpu_count() or 1)]
+    for process in load:
+        process.start()
+    writer = multiprocessing.Process(target=write_paced, args=(master, int(seconds / period), period))
+    writer.start()
+    writer.join()
+    time.sleep(0.2)  # the last lines
+    for process in load:
+        process.join()
+    poller.stop()
+    time.sleep(2 * poll_wait)
+    port.close()
+    os.close(master)
+    return np.diff(reader.outlet.times)
+
+
+def bench_jitter():
+    print("one line every 1 ms for 3 s, every core busy, times between the samples pushed")
+    results = [("off", time_jitter(False)), ("on", time_jitter(True))]
+    print("  real-time mode    median       std     99th pct       max")
+    for name, gaps in results:
+        print("  %-12s %8.3f ms %6.3f ms %9.3f ms %7.3f ms" % (name, 1000 * np.median(gaps), 1000 * np.std(gaps),
+                                                              1000 * np.percentile(gaps, 99), 1000 * gaps.max()))
+
+
+# ============================ raw byte capture overhead ==================================================================
+def time_capture(capture, n_lines=64 * 2000):
+    """Writes n_lines into a pty as fast as possible, read by a Poller. OUTPUT: lines/s pushed."""
+    master, port = open_fake_port(serial_wait)
+    reader = LegReader('L', lambda: read_available(port), port.write, CountingOutlet())
+    reader.arm('save')
+    raw_capture = None
+    if capture:
+        raw_capture = RawCapture(['L'], tempfile.mkdtemp())
+        reader.capture = raw_capture
+    poller = Poller()
+    poller.add(reader, port)
+    poller.start()
+    writer = threading.Thread(target=write_lines, args=(master, n_lines), daemon=True)
+    start = time.perf_counter()
+    writer.start()
+    while reader.outlet.samples < n_lines and time.perf_counter() < start + 30:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    poller.stop()
+    if raw_capture is not None:
+        raw_capture.close()
+        shutil.rmtree(os.path.dirname(raw_capture.paths['L']))
+    time.sleep(2 * poll_wait)
+    port.close()
+    os.close(master)
+    return reader.outlet.samples / elapsed
+
+
+def bench_capture(runs=7):
+    print("lines pushed per second, %d byte lines written into a pty as fast as possible (median of %d runs each, "
+          "taken in turns)" % (len(telemetry_line), runs))
+    rates = {False: [], True: []}
+    for _ in range(runs):
+        for capture in (False, True):
+            rates[capture].append(time_capture(capture))
+    off, on = (sorted(rates[capture])[runs // 2] for capture in (False, True))
+    print("  no capture:    %10.0f lines/s" % off)
+    print("  raw capture:   %10.0f lines/s  (%.1f%%)" % (on, 100 * (on / off - 1)))
+
+
+# ============================ timestamps: stamped when pushed versus from the device clock ================================
+def write_timed(master, n_lines, period, start):
+    """Stands in for the Teensy in its own process: line i is sent at LSL time start + i * period, with i * period in
+    its Time channel (ms)."""
+    clock = lsl_clock()
+    for i in range(n_lines):
+        time.sleep(max(0.0, start + i * period - clock()))
+        os.write(master, b"%d\t12.34\t-1.234\t512\t0.75\t2\t5.00\t30.00\n" % round(1000 * i * period))
+
+
+def bench_timestamps(seconds=3.0, period=0.01):
+    """The main thread keeps the interpreter busy 30 ms out of every 50 (like Tkinter redrawing), delaying the reader.
+    Compares when the lines were sent with the time they were pushed (what LSL stamps by default) and with the
+    timestamps passed to the outlet."""
+    clock = lsl_clock()
+    master, port = open_fake_port(serial_wait)
+    reader = LegReader('L', lambda: read_available(port), port.write, TimingOutlet(clock))
+    reader.arm('save')
+    poller = Poller()
+    poller.add(reader, port)
+    poller.start()
+    n_lines = int(seconds / period)
+    start = clock() + 0.1
+    writer = multiprocessing.Process(target=write_timed, args=(master, n_lines, period, start))
+    writer.start()
+    while writer.is_alive():
+        busy_until = time.perf_counter() + 0.03
+        while time.perf_counter() < busy_until:
+            pass
+        time.sleep(0.02)
+    time.sleep(0.1)  # the last lines
+    poller.stop()
+    time.sleep(2 * poll_wait)
+    port.close()
+    os.close(master)
+
+    sent = start + period * np.arange(n_lines)
+    print("a line every 10 ms for 3 s, the interpreter busy 60% of the time; error against the time each was sent")
+    print("                      median      max    std of the spacing")
+    for name, stamps in (("stamped when pushed", reader.outlet.times), ("explicit timestamps", reader.outlet.stamps)):
+        error = np.abs(np.array(stamps[:n_lines]) - sent[:len(stamps)])
+        print("  %-19s %6.2f ms %6.2f ms %10.3f ms" % (name, 1000 * np.median(error), 1000 * error.max(),
+                                                       1000 * np.std(np.diff(stamps))))
+
+
+# ============================ clock drift: quickest read so far versus a running fit ======================================
+class OldDeviceClock(DeviceClock):
+    """DeviceClock as it was: the quickest read so far sets the offset, drift isn't followed."""
+    def stamp_many(self, device_times, arrival):
+        seconds = device_times * device_time_scale
+        if self.lowest is None or arrival - seconds[-1] < self.lowest:
+            self.lowest = arrival - seconds[-1]
+        return seconds + self.lowest
+
+
+def time_drift(clock, ppm, stall=0.0, minutes=10, period=0.001, read_every=10):
+    """A device whose clock runs 'ppm' fast (negative: slow) sends a sample every 'period' seconds, read 'read_every'
+    at a time, 1-4 ms late (and held up by up to 'stall' seconds for a while, in the first minute). OUTPUT: the largest
+    timestamp error (seconds) in the last minute"""
+    rng = np.random.default_rng(0)
+    reads = int(minutes * 60 / period / read_every)
+    errors = []
+    for i in range(reads):
+        device_times = 1000 * period * np.arange(i * read_every, (i + 1) * read_every)  # ms
+        sent = 1000.0 + device_times / 1000 / (1 + ppm * 1e-6)  # host time
+        delay = 0.001 + rng.exponential(0.003)
+        stalled = i - reads // (2 * minutes)  # from half a minute in
+        if 0 <= stalled < stall / period / read_every:
+            delay += stalled * period * read_every
+        stamps = clock.stamp_many(device_times, sent[-1] + delay)
+        if i >= reads - 60 / period / read_every:
+            errors.append(np.abs(stamps - sent).max())
+    return max(errors)
+
+
+def bench_drift():
+    print("10 minutes at 1000 samples/s, reads 1-4 ms late; largest timestamp error in the last minute")
+    print("                          quickest read so far   running fit")
+    for name, ppm, stall in (("no drift", 0, 0.0), ("clock 50 ppm fast", 50, 0.0), ("clock 80 ppm slow", -80, 0.0),
+                             ("80 ppm slow, 5 s stall", -80, 5.0)):
+        print("  %-24s %17.2f ms %10.2f ms" % (name, 1000 * time_drift(OldDeviceClock(), ppm, stall),
+                                               1000 * time_drift(DeviceClock(), ppm, stall)))
+    for name, value in (("ms counter after 1 day", 86400e3), ("us counter after 1 hour", 3600e6)):
+        print("  Time channel, %-24s steps of %g as float32, %.1e as float64" % (
+            name, np.spacing(np.float32(value)), np.spacing(np.float64(value))))
+
+
+# ============================ network links: TCP versus UDP, Nagle on versus off ==========================================
+def time_network(protocol, size=None, seconds=2.0, rate=60000):
+    """A SimulatedBridge sends 'rate' samples/s as text lines for 'seconds', read by a LegReader through open_link() (or
+    with read_socket(size) for TCP). OUTPUT: samples/s pushed, and bytes per read."""
+    bridge = SimulatedBridge(protocol, rate=rate)
+    bridge.start()
+    link, read, write = open_link('Net', bridge.address)
+    if size is not None:
+        read = lambda: read_socket(link, size=size)
+    reads = []
+    reader = LegReader('L', lambda: reads.append(read()) or reads[-1], write, CountingOutlet(), link=link)
+    poller = Poller()
+    poller.add(reader, link)
+    poller.start()
+    reader.arm('save')
+    reader.send("1")
+    time.sleep(seconds)
+    pushed = reader.outlet.samples / seconds
+    poller.stop()
+    bridge.stop()
+    time.sleep(2 * poll_wait)
+    link.close()
+    return pushed, sum(len(data) for data in reads) / max(len(reads), 1)
+
+
+def time_commands(nodelay, n=200):
+    """Sends two commands back to back (settings, then another, like send_data() can) to a SimulatedBridge over TCP,
+    with Nagle's algorithm on (nodelay = False) or off. OUTPUT: sorted times until both were answered (seconds)."""
+    bridge = SimulatedBridge('tcp')
+    bridge.start()
+    sock = open_network(bridge.address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        sock.sendall(frame_command("a%d" % i).encode())
+        sock.sendall(frame_command("b%d" % i).encode())
+        received = b''
+        while received.count(b'^') < 2:
+            received += read_socket(sock, size=net_recv_size)
+        times.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    bridge.stop()
+    sock.close()
+    return sorted(times)
+
+
+def bench_network():
+    print("a simulated Wi-Fi bridge on localhost sending 60000 samples/s of text lines")
+    print("                           samples/s pushed   bytes per read")
+    for name, protocol, size in (("TCP, %d B reads" % recv_size, 'tcp', recv_size),
+                                 ("TCP, %d B reads" % net_recv_size, 'tcp', None), ("UDP, all datagrams", 'udp', None)):
+        pushed, per_read = time_network(protocol, size)
+        print("  %-24s %16.0f %16.0f" % (name, pushed, per_read))
+    print("two commands sent back to back over TCP, until both are answered")
+    print("                      median       p99       max")
+    for name, nodelay in (("Nagle on", False), ("Nagle off (NODELAY)", True)):
+        times = time_commands(nodelay)
+        print("  %-19s %6.2f ms %6.2f ms %6.2f ms" % (name, 1000 * times[len(times) // 2],
+                                                      1000 * times[int(0.99 * len(times))], 1000 * times[-1]))
+
+
+benchmarks = {
+    'serial': bench_serial,
+    'lines': bench_lines,
+    'idle': bench_idle,
+    'binary': bench_binary,
+    'parse': bench_parse,
+    'resync': bench_resync,
+    'quarantine': bench_quarantine,
+    'loss': bench_loss,
+    'delta': bench_delta,
+    'schema': bench_schema,
+    'devices': bench_devices,
+    'fair': bench_fair,
+    'jitter': bench_jitter,
+    'capture': bench_capture,
+    'timestamps': bench_timestamps,
+    'drift': bench_drift,
+    'network': bench_network,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
@@ -0,0 +1,2852 @@
+"""
+Data acquisition helpers for the NIH P-Rex GUI (NIHPREX_GUI.py).
+
+Everything in here is independent of Tkinter, so it can be imported (and benchmarked) without starting the GUI.
+NIHPREX_GUI.py imports these helpers for the receive___() functions, and the acquisition process (AcquisitionEngine)
+runs them on its own, away from the GUI.
+
+For an overview of how the exoskeleton communicates with the GUI, visit https://github.com/NIHFAB/PREX-GUI-FAB/wiki ,
+2. Receive and Parse Data (Python)
+"""
+
+import atexit
+import binascii
+import collections
+import io
+import multiprocessing
+import os
+import queue
+import re
+import select
+import selectors
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+from numpy.lib import recfunctions
+
+# ============================ important string info ==================================================================
+# important characters for interfacing with GUI (NIHPREX_GUI.py imports these from here)
+prompt_char = "^"  # end of menu communication
+trial_start_char = "$"  # Teensy is ready to start a trial
+trial_stop_char = "@"  # Teensy has stopped the trial
+end_string = '\n'  # end of a line
+end_byte = b'\n'
+
+
+# ============================ opening the connections ================================================================
+default_baud = 115200
+bauds = (57600, 115200, 230400, 460800, 921600, 1000000, 2000000)  # choices in the Wire setup window
+connect_timeout = 10.0  # seconds a leg gets to connect (a bluetooth .connect() can take several)
+sim_address = "sim"  # address of a SimulatedExo (see open_link())
+net_port = 23  # port of a serial-to-Wi-Fi bridge if the address doesn't say (23 = telnet, e.g. ESP-Link)
+net_buffer = 1 << 20  # bytes the OS may hold for a network link before it's read (SO_RCVBUF)
+monitored_types = ('BLE', 'Net')  # comTypes whose links are recorded to LSL (see 'link monitor')
+
+
+def open_serial(address, baud=default_baud):
+    """Opens the serial port of one leg's Teensy (wire via usb), e.g. address = 'COM5'.
+    Over the Teensy's USB serial the baud rate is ignored (USB CDC always runs at full USB speed); it only matters
+    through a USB-UART adapter. probe() shows what a link really carries."""
+    import serial
+    return serial.Serial(address, baud, timeout=serial_wait, bytesize=8, stopbits=1, parity='N')
+
+
+def open_rfcomm(address):
+    """Connects to one leg's bluetooth module by mac address, e.g. address = '00:06:66:84:86:32'.
+    pybluez is only loaded here, so it's only needed if Bluetooth is used."""
+    import bluetooth
+    sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+    sock.settimeout(connect_timeout)  # time until Bluetooth .connect() stops trying to connect
+    sock.connect((address, 1))  # establish connection
+    sock.setblocking(0)  # make socket non-blocking; otherwise, if receives 0 bytes, will stall whole program
+    return sock
+
+
+def parse_net_address(address):
+    """INPUT: the address of a serial-to-Wi-Fi bridge: 'host', 'host:port', 'tcp://host:port' or 'udp://host:port'
+    OUTPUT: (protocol, host, port), protocol = 'tcp' or 'udp'. ValueError if it can't be read."""
+    protocol, _, rest = address.strip().rpartition('://')
+    protocol = protocol.lower() or 'tcp'
+    if protocol not in ('tcp', 'udp'):
+        raise ValueError("expected tcp:// or udp://, got '" + protocol + "://'")
+    host, _, port = rest.rpartition(':')
+    if not host:  # no port
+        host, port = port, ''
+    if not host or not (port.isdigit() or not port):
+        raise ValueError("expected host:port, got '" + address + "'")
+    return protocol, host, int(port) if port else net_port
+
+
+def open_network(address):
+    """Connects to one device's serial-to-Wi-Fi bridge, e.g. address = '192.168.4.1:23' (TCP) or
+    'udp://192.168.4.1:5000' (see parse_net_address()). The bridge passes the bytes through to the Teensy's serial port
+    and back, so the framing and control characters are the same as on a wire.
+    TCP: Nagle's algorithm is turned off (TCP_NODELAY), so a command goes out at once instead of waiting for the
+    previous one to be acknowledged. UDP: connect() only sets where the datagrams go (and which are taken in); the
+    bridge learns where to send to from the first command."""
+    protocol, host, port = parse_net_address(address)
+    if protocol == 'tcp':
+        sock = socket.create_connection((host, port), timeout=connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, net_buffer)
+    sock.setblocking(0)
+    return sock
+
+
+def open_link(comType, address, baud=default_baud, realtime=False):
+    """Opens one device's serial port (comType = 'Ser'), bluetooth socket ('BLE') or network socket to a
+    serial-to-Wi-Fi bridge ('Net', see open_network()). realtime = True asks the serial port for low latency (see
+    'real-time mode'). The address 'sim' (or 'sim:<bytes/s>', for a link that only carries that many bytes/s) opens a
+    SimulatedExo instead, to try the GUI out without an exoskeleton.
+    OUTPUT: (link, read, write) = the open port or socket, a function that waits briefly for its data and returns it
+    (see 'reading from a port'), and a function that sends bytes to it."""
+    if address == sim_address or address.startswith(sim_address + ':'):
+        link_rate = address[len(sim_address) + 1:]
+        sim = SimulatedExo(link_rate=int(link_rate), throttle=True) if link_rate else SimulatedExo()
+        return sim, sim.read, sim.write
+    if comType == 'Ser':
+        port = open_serial(address, baud)
+        if realtime:
+            print_realtime(address, [("low latency", set_low_latency(port))])
+        return port, lambda: read_available(port), port.write
+    if comType == 'Net':
+        sock = open_network(address)
+        if sock.type == socket.SOCK_DGRAM:
+            return sock, lambda: read_datagrams(sock), sock.send
+        return sock, lambda: read_socket(sock, size=net_recv_size), sock.sendall
+    sock = open_rfcomm(address)
+    return sock, lambda: read_socket(sock), sock.send
+
+
+class LinkOpener:
+    """Opens the links of several devices at once, each in its own thread, so a slow bluetooth .connect() holds up
+    neither the other legs nor the GUI: connecting takes as long as the slowest device, not all of them added up.
+
+    INPUTS: comType = 'Ser', 'BLE' or 'Net', addresses = {name: port, mac or network address}, bauds = {name: baud
+    rate} (serial only), realtime = True for low latency serial ports (see open_link())
+    poll() is called (from the GUI's after() timer, or the acquisition process) until done() is True; then links holds
+    (link, read, write) of every device that connected (see open_link()), and errors says why the rest didn't."""
+    def __init__(self, comType, addresses, bauds=None, timeout=connect_timeout, realtime=False):
+        self.comType = comType
+        self.addresses = dict(addresses)
+        self.bauds = bauds or {}
+        self.realtime = realtime
+        self.results = queue.Queue()
+        self.links = {}
+        self.errors = {}
+        self.pending = set(addresses)
+        self.cancelled = False
+        self.deadline = time.monotonic() + timeout + 1  # a socket's own timeout comes first, with its error message
+        for name in addresses:
+            threading.Thread(target=self.open, args=(name,), name="LinkOpener " + name, daemon=True).start()
+
+    def reopen(self, name):
+        """Opens device 'name' again (blocking), e.g. after its link was lost. OUTPUT: (link, read, write)"""
+        return open_link(self.comType, self.addresses[name], self.bauds.get(name, default_baud), self.realtime)
+
+    def open(self, name):
+        try:
+            link = self.reopen(name)
+        except Exception as err:  # serial.SerialException, bluetooth.BluetoothError, ImportError, ...
+            self.results.put((name, None, str(err) or type(err).__name__))
+            return
+        if self.cancelled:
+            link[0].close()
+        else:
+            self.results.put((name, link, None))
+
+    def poll(self):
+        """OUTPUT: [(name, error), ...] for the devices that finished since the last poll(); error is None if it
+        connected. Devices that haven't finished by the timeout come back as timed out (and are closed if they do
+        connect later on)."""
+        finished = []
+        while True:
+            try:
+                name, link, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if name not in self.pending:  # connected after timing out
+                if link is not None:
+                    link[0].close()
+                continue
+            self.pending.discard(name)
+            if link is not None:
+                self.links[name] = link
+            else:
+                self.errors[name] = error
+            finished.append((name, error))
+        if self.pending and time.monotonic() > self.deadline:
+            for name in sorted(self.pending):
+                self.errors[name] = "timed out"
+                finished.append((name, "timed out"))
+            self.pending.clear()
+        return finished
+
+    def done(self):
+        return not self.pending
+
+    def close(self):
+        for link, _, _ in self.links.values():
+            link.close()
+        self.links = {}
+
+    def cancel(self):
+        """Gives up on connecting: closes what has connected, and what still does."""
+        self.cancelled = True
+        self.poll()
+        self.close()
+        self.pending.clear()
+
+
+# ============================ finding the legs ========================================================================
+rn42_prefix = "00:06:66"  # mac addresses of Roving Networks (RN-42) bluetooth modules, like the legs'
+teensy_vid = 0x16C0  # USB vendor id of the Teensy (PJRC)
+scan_seconds = 8  # how long a bluetooth scan listens for modules
+
+
+def find_serial_ports():
+    """OUTPUT: [(port, description), ...] of the serial ports on this computer, Teensys first."""
+    from serial.tools import list_ports
+    ports = sorted(list_ports.comports(), key=lambda port: (port.vid != teensy_vid, port.device))
+    return [(port.device, port.description + (" (Teensy)" if port.vid == teensy_vid else "")) for port in ports]
+
+
+def find_rn42():
+    """OUTPUT: [(mac address, name), ...] of the RN-42 bluetooth modules in range (takes scan_seconds)."""
+    import bluetooth
+    found = bluetooth.discover_devices(duration=scan_seconds, lookup_names=True)
+    return [(address, name) for address, name in found if address.upper().startswith(rn42_prefix)]
+
+
+class Discovery(threading.Thread):
+    """Looks for the legs in the background: serial ports (comType = 'Ser', see find_serial_ports()) or RN-42 modules
+    ('BLE', see find_rn42()). When done is set, found holds [(address, description), ...], or error why not."""
+    def __init__(self, comType):
+        threading.Thread.__init__(self, name="Discovery", daemon=True)
+        self.comType = comType
+        self.found = []
+        self.error = None
+        self.done = False
+
+    def run(self):
+        try:
+            self.found = find_serial_ports() if self.comType == 'Ser' else find_rn42()
+        except Exception as err:  # no pyserial/pybluez, no bluetooth adapter, ...
+            self.error = str(err) or type(err).__name__
+        self.done = True
+
+
+# ============================ devices =================================================================================
+"""Besides the two legs, other instrumented devices (hip units, extra IMUs) can be read in the same session. Every
+device gets its own LegReader (port or socket, buffer, parsing and LSL outlet), kept in a dict by name: 'L' and 'R' for
+the legs, any other name for the rest. Other devices send the same tab separated lines of 8 values as the legs, into
+an LSL stream of their own name. Only the legs get the commands from send_data() and decide when a trial starts and
+stops; the other devices are saved along with them."""
+exo_legs = ('L', 'R')
+
+
+def device_title(name):
+    return {'L': "Left Leg", 'R': "Right Leg"}.get(name, name)
+
+
+def sends_to(leg, name):
+    """True if a command for leg ('L', 'R' or 'B' = both legs, see send_data()) goes to the device called name."""
+    return leg == name or (leg == 'B' and name in exo_legs)
+
+
+def parse_devices(text):
+    """INPUT: the 'Other devices' field of the setup windows, e.g. 'HIP=COM7, IMU=COM8'
+    OUTPUT: [(name, address), ...], e.g. [('HIP', 'COM7'), ('IMU', 'COM8')]. ValueError if it can't be read."""
+    devices = []
+    for entry in text.split(','):
+        if not entry.strip():
+            continue
+        name, _, address = entry.partition('=')
+        name = name.strip()
+        address = address.strip()
+        if not name or not address:
+            raise ValueError("expected name=address, got '" + entry.strip() + "'")
+        if name in exo_legs or name in [device[0] for device in devices]:
+            raise ValueError("device name '" + name + "' is already used")
+        devices.append((name, address))
+    return devices
+
+
+# ============================ LabStreamingLayer (LSL) outlets =========================================================
+stream_names = {'L': 'LeftLeg', 'R': 'RightLeg'}
+channel_labels = {'L': ["TimeLL", "AngleLL", "TorqueLL", "FSR LL", "CurrentLL", "FSM StateLL", "Torque SetpointLL",
+                        "Position SetpointLL"],
+                  'R': ["TimeRL", "AngleRL", "TorqueRL", "FSR RL", "CurrentRL", "FSM StateRL", "Torque SetpointRL",
+                        "Position SetpointRL"]}
+n_channels = 8
+
+
+def create_outlet(leg, rate=None, decimation=1, schema=None):
+    """Creates the LSL stream (and outlet) for one leg, 'L' or 'R', or another device (named after it), with the
+    channels of its schema (default_schema() if None, see 'channel schema'). rate = samples/s the device sends (the
+    schema's rate, or default_rate, if not known yet), decimation = it sends every n-th sample (see 'sample rate
+    (decimation)'). pylsl is only loaded here, so everything else in this file works without it."""
+    from pylsl import StreamInfo, StreamOutlet
+    schema = schema or default_schema(leg)
+    info = StreamInfo(stream_names.get(leg, leg), 'Exoskeleton', schema.n, rate or schema.rate or default_rate,
+                      'double64', 'YourComp')  # double64: the Time channel of a long run doesn't fit in a float32
+
+    # append some meta-data
+    info.desc().append_child_value("decimation", str(decimation))
+    info.desc().append_child_value("clock_stream", stream_names.get(leg, leg) + 'Clock')  # see 'sample timestamps'
+    channels = info.desc().append_child("channels")
+    for c, kind in zip(schema.names, schema.types):
+        channels.append_child("channel") \
+            .append_child_value("label", c) \
+            .append_child_value("format", kind)  # as the device sends it, see schema_types
+
+    return StreamOutlet(info)
+
+
+# ============================ channel schema ==========================================================================
+"""What a device sends in each sample (how many channels, their names and types) and how fast is described by one
+ChannelSchema, and everything that depends on it is built from that: the text line parser (how many values make a
+sample), the binary frame and sample packet layouts, the delta packets' channel count, the LSL StreamInfo (channel
+count, labels, formats and rate) and the link's bytes per sample (max_sample_rate()). A Teensy that sends more
+channels needs no change here.
+
+When connecting, LegReader.negotiate() first asks the Teensy to describe its channels (schema_command). It answers
+with one text line:
+
+    #SCHEMA<tab><samples/s><tab><name>:<type><tab><name>:<type>...
+
+type is how the channel is sent in binary frames and sample packets, one of schema_types (numpy's little-endian type
+codes). The first channel is the Time channel (ms) that the timestamps and the loss count go by. A Teensy that
+doesn't answer within negotiate_timeout gets default_schema(): the 8 float32 channels of channel_labels. The '#SCHEMA'
+line is received like any other text, so a raw byte capture (see 'raw byte capture') has it in front of the samples
+it describes.
+
+The line is checked once, when it arrives (parse_schema()). After that a sample is checked the way it always was, by
+the parser that reads it (a text line has the schema's number of values, a frame or packet its size), not value by
+value."""
+schema_command = "H/1"
+schema_ack = "#SCHEMA"
+schema_types = ('f4', 'f8', 'i1', 'u1', 'i2', 'u2', 'i4', 'u4')
+
+
+class ChannelSchema:
+    """INPUTS: names = the channel names (the LSL labels), types = how each one is sent (schema_types, all 'f4' if
+    None), rate = samples/s the device sends (None if it didn't say)
+
+    sample_dtype is one sample as sent in a binary frame or sample packet: (n,) values of one type, or a structured
+    type if the types differ. sample_size is its size in bytes, frame_dtype/frame_size the same with the sync word in
+    front (see 'binary telemetry frames')."""
+    def __init__(self, names, types=None, rate=None):
+        self.names = list(names)
+        self.n = len(self.names)
+        self.types = list(types) if types is not None else ['f4'] * self.n
+        self.rate = rate
+        if len(set(self.types)) == 1:
+            self.sample_dtype = np.dtype(('<' + self.types[0], (self.n,)))
+        else:
+            self.sample_dtype = np.dtype([('c%d' % i, '<' + kind) for i, kind in enumerate(self.types)])
+        self.sample_size = self.sample_dtype.itemsize
+        self.frame_dtype = np.dtype([('sync', 'u1', (2,)), ('values', self.sample_dtype)])
+        self.frame_size = self.frame_dtype.itemsize
+
+    def __eq__(self, other):
+        return isinstance(other, ChannelSchema) and (self.names, self.types, self.rate) == (other.names, other.types,
+                                                                                           other.rate)
+
+    def decode(self, values):
+        """INPUT: samples as sent (an array of sample_dtype, e.g. the 'values' of frames)
+        OUTPUT: an (n, channels) float64 array of them (a copy)"""
+        if values.dtype.names:
+            return recfunctions.structured_to_unstructured(values, dtype=np.float64, copy=True)
+        return values.astype(np.float64).reshape(-1, self.n)
+
+    def encode(self, samples):
+        """OUTPUT: samples ((n, channels) array of floats) as sent, an array of sample_dtype (tobytes() gives the
+        bytes). Used by SimulatedExo, and handy for testing."""
+        samples = np.asarray(samples).reshape(-1, self.n)
+        if self.sample_dtype.names:
+            return recfunctions.unstructured_to_structured(samples, dtype=self.sample_dtype)
+        return samples.astype(self.sample_dtype.base)
+
+    def bytes_per_sample(self, wire):
+        """OUTPUT: about how many bytes one sample takes on the link with the given telemetry (LegReader.wire)."""
+        return {'ascii': 6 * self.n,  # a typical text line: 8 channels take ~48 (acquisition_benchmarks.py binary)
+                'binary': self.frame_size,
+                'cobs': 1 + 1 + self.sample_size + 1,  # COBS code + type + values + 0x00, +2 with the CRC
+                'delta': self.n}[wire]  # depends on the data: SimulatedExo's take ~4 (acquisition_benchmarks.py delta)
+
+    def line(self):
+        """OUTPUT: the '#SCHEMA' line describing this schema (what the Teensy sends)."""
+        return "\t".join([schema_ack, "%g" % (self.rate or 0)] +
+                         [name + ":" + kind for name, kind in zip(self.names, self.types)]) + "\n"
+
+
+def parse_schema(line):
+    """OUTPUT: the ChannelSchema a '#SCHEMA' line describes, or None if line isn't one (or is damaged)."""
+    fields = line.strip().split("\t")
+    if len(fields) < 3 or fields[0] != schema_ack:
+        return None
+    try:
+        rate = float(fields[1])
+    except ValueError:
+        return None
+    names = []
+    types = []
+    for field in fields[2:]:
+        name, _, kind = field.rpartition(":")
+        if not name or kind not in schema_types:
+            return None
+        names.append(name)
+        types.append(kind)
+    return ChannelSchema(names, types, rate if rate > 0 else None)
+
+
+def default_schema(leg=None):
+    """The schema of a device that doesn't describe its channels: the 8 float32 channels of channel_labels."""
+    return ChannelSchema(channel_labels.get(leg, [str(leg or "Channel") + " " + str(i + 1) for i in range(n_channels)]))
+
+
+# ============================ sample timestamps =======================================================================
+"""Samples are pushed to LSL with explicit timestamps, not stamped by LSL when they're pushed (after whatever delay
+the parsing, or a busy GUI, added). Each read is stamped with local_clock() as it returns (LegReader.arrival). A
+DeviceClock turns each sample's Time channel (ms on the Teensy's own clock) into LSL time: a sample can only arrive
+after it was sent, so the smallest (arrival - device time) seen is the best estimate of the offset between the two
+clocks (the reads with the least delay). The timestamps keep the Teensy's own spacing of the samples. If the Time
+channel goes back (the Teensy restarted), the offset is estimated again.
+
+The Teensy's crystal doesn't run at exactly the host's rate, so the offset drifts (tens of ppm: a few ms per minute).
+The quickest read of every drift_block seconds of device time is a point of a running linear fit of the offset
+against device time, over the last drift_memory seconds: the line under all the points that's closest to them
+(DeviceClock.fit_drift()), so it follows the quickest reads and a stalled link (reads held up for seconds) doesn't
+tilt it. Its slope is the drift. Timestamps follow the fitted line (or the quickest read of the current block, if
+that is lower), and every new fit is pushed to the device's clock stream (create_clock_outlet(), e.g. 'LeftLegClock':
+device time, offset and drift, > 0 if the Teensy's clock is slow), so the recording has the mapping that was used.
+
+The Time channel is a counter that wraps around after device_time_wrap units (a 32-bit millis() after 49 days,
+micros() after 71 minutes). The reader unwraps it (DeviceClock.unwrap()): a step back by more than half the range is
+a wrap, not a restart, and the range is added from there on. The samples are float64 from the parsing on, and the
+legs' LSL streams are double64, so a large Time channel keeps its precision (text and delta packets carry it exactly;
+binary frames and sample packets are float32 on the wire already)."""
+device_time_scale = 0.001  # seconds per unit of the Time channel (ms)
+device_time_wrap = 2.0 ** 32  # units of the Time channel before it wraps around (a 32-bit counter)
+drift_block = 1.0  # seconds of device time per point of the drift fit (the quickest read in each)
+drift_memory = 300.0  # seconds of device time the drift fit goes by
+max_drift = 500e-6  # steeper fits are thrown away (s/s): the reads were held up, not the clock (crystals: < 100 ppm)
+clock_labels = ["device time s", "offset s", "drift ppm"]  # channels of the clock streams
+
+
+def lsl_clock():
+    """OUTPUT: the clock LSL timestamps are in: pylsl.local_clock(), or time.monotonic() without pylsl (the same
+    steady clock on Linux)."""
+    try:
+        from pylsl import local_clock
+    except ImportError:
+        return time.monotonic
+    return local_clock
+
+
+class DeviceClock:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forgets the offset, drift and wraps (a new trial, or the link was lost: the Teensy's clock may have
+        restarted)."""
+        self.offset = None  # LSL time - device time (seconds) of the quickest read of the current block
+        self.lowest = None  # ... of the quickest read so far
+        self.last_time = None  # Time channel of the newest sample (unwrapped)
+        self.last_raw = None  # the same, as received
+        self.wraps = 0  # times the Time channel has wrapped around
+        self.block = None  # drift block (device time // drift_block) of the current offset
+        self.block_time = None  # device time (seconds) of the current offset
+        self.points = collections.deque(maxlen=int(drift_memory / drift_block))  # (device time, offset) per block
+        self.fit = None  # (device time, offset there, drift) of the line the timestamps follow
+        self.new_fit = None  # a fit not handed out by take_fit() yet
+
+    def unwrap(self, device_times):
+        """INPUT: Time channels as received (numpy array) OUTPUT: the same unwrapped, as float64"""
+        times = device_times.astype(np.float64)
+        finite = np.isfinite(times)
+        values = times[finite]
+        if not len(values):
+            return times
+        previous = np.concatenate(([values[0] if self.last_raw is None else self.last_raw], values[:-1]))
+        wraps = self.wraps + np.cumsum(values - previous < -device_time_wrap / 2)
+        self.last_raw = float(values[-1])
+        self.wraps = int(wraps[-1])
+        times[finite] = values + wraps * device_time_wrap
+        return times
+
+    def unwrap_one(self, device_time):
+        """unwrap() for one Time channel (a float)."""
+        if device_time != device_time:  # NaN
+            return device_time
+        if self.last_raw is not None and device_time - self.last_raw < -device_time_wrap / 2:
+            self.wraps += 1
+        self.last_raw = device_time
+        return device_time + self.wraps * device_time_wrap
+
+    def update(self, last_time, arrival):
+        """last_time = Time channel of the newest sample that came in by 'arrival' (LSL time of the read)."""
+        seconds = last_time * device_time_scale
+        offset = arrival - seconds
+        if self.last_time is not None and last_time < self.last_time:  # the Teensy restarted
+            self.points.clear()
+            self.fit = None
+            self.offset = None
+            self.lowest = None
+        block = seconds // drift_block
+        if self.offset is not None and block != self.block:  # the block's quickest read is a point of the fit
+            self.points.append((self.block_time, self.offset))
+            self.fit_drift()
+            self.offset = None
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+            self.block_time = seconds
+        if self.lowest is None or offset < self.lowest:
+            self.lowest = offset
+        self.block = block
+        self.last_time = last_time
+
+    def fit_drift(self):
+        """Fits the line under the points that is closest to them overall (slope = drift): the edge of their lower
+        convex hull that spans their mean device time. Points held up by slow reads lie above it and don't pull it
+        off, as they would a least squares line."""
+        if len(self.points) < 2:
+            return
+        hull = []  # lower convex hull of the points, left to right
+        for point in self.points:
+            while len(hull) >= 2 and (hull[-1][0] - hull[-2][0]) * (point[1] - hull[-2][1]) <= \
+                    (hull[-1][1] - hull[-2][1]) * (point[0] - hull[-2][0]):
+                hull.pop()  # on or above the line from the point before it to this one
+            hull.append(point)
+        mean = sum(point[0] for point in self.points) / len(self.points)
+        edge = 0
+        while edge < len(hull) - 2 and hull[edge + 1][0] < mean:
+            edge += 1
+        (time_a, offset_a), (time_b, offset_b) = hull[edge], hull[edge + 1]
+        drift = (offset_b - offset_a) / (time_b - time_a)
+        if abs(drift) > max_drift:
+            return
+        newest = self.points[-1][0]
+        self.fit = (newest, offset_a + drift * (newest - time_a), drift)
+        self.new_fit = self.fit
+
+    def take_fit(self):
+        """OUTPUT: the newest fit (device time in seconds, offset there, drift in s/s), or None if there's been no
+        new one since the last call."""
+        fit, self.new_fit = self.new_fit, None
+        return fit
+
+    def offsets(self, seconds):
+        """OUTPUT: LSL time - device time at device times 'seconds' (float or numpy array)"""
+        if self.fit is None:
+            return self.lowest
+        fit_time, fit_offset, drift = self.fit
+        return np.minimum(fit_offset + drift * (seconds - fit_time), self.offset)
+
+    def time_of(self, device_time):
+        """OUTPUT: LSL time of an (unwrapped) Time channel, or None before the first sample."""
+        if self.offset is None:
+            return None
+        seconds = device_time * device_time_scale
+        return float(seconds + self.offsets(seconds))
+
+    def stamp(self, device_time, arrival):
+        """OUTPUT: LSL timestamp of one sample (arrival if its Time channel isn't a number)."""
+        if device_time != device_time:  # NaN
+            return arrival
+        self.update(device_time, arrival)
+        seconds = device_time * device_time_scale
+        if self.fit is None:
+            return seconds + self.lowest
+        return float(seconds + self.offsets(seconds))
+
+    def stamp_many(self, device_times, arrival):
+        """OUTPUT: LSL timestamps (numpy float64) of samples with the (unwrapped) Time channels device_times (numpy
+        array)."""
+        seconds = device_times.astype(np.float64) * device_time_scale
+        if np.isfinite(seconds[-1]):
+            self.update(float(device_times[-1]), arrival)
+        if self.offset is None:
+            return np.full(len(seconds), arrival)
+        stamps = seconds + self.offsets(seconds)
+        return np.where(np.isfinite(stamps), stamps, arrival)
+
+
+def create_clock_outlet(leg):
+    """Creates the stream (and outlet) of the fits of one device's DeviceClock, e.g. 'LeftLegClock'."""
+    from pylsl import StreamInfo, StreamOutlet, IRREGULAR_RATE
+    info = StreamInfo(stream_names.get(leg, leg) + 'Clock', 'DeviceClock', len(clock_labels), IRREGULAR_RATE,
+                      'double64', 'YourComp')
+    info.desc().append_child_value("stream", stream_names.get(leg, leg))
+    channels = info.desc().append_child("channels")
+    for c in clock_labels:
+        channels.append_child("channel") \
+            .append_child_value("label", c)
+    return StreamOutlet(info)
+
+
+# ============================ sample loss =============================================================================
+"""The Time channel also says whether samples went missing between the Teensy and LSL (lost or damaged on the link,
+quarantined, lost while reconnecting): the samples of a trial should be one sample period apart. A LossCounter learns
+the period from the first loss_warmup samples of each trial (the mean step, leaving out the steps more than 1.5 times
+the median), then counts round(step / period) - 1 samples missing at every bigger step. A step back (the Teensy
+restarted) isn't a loss. A Time channel that doesn't move with every sample (faster than its resolution) can't tell,
+nothing is counted then. LossCounter(period) takes a known period instead, e.g. 1 for a sequence number that goes up
+by one per sample.
+
+Each gap is pushed to the leg's marker stream (create_loss_outlet(), e.g. 'LeftLegLoss') as a text marker, with the
+LSL timestamp of the first sample after it, so the recording says where samples are missing. The link monitor has
+the share of samples missing in each interval ('loss %'), the console titles show it for the trial so far, and the
+totals are printed at the end of the trial."""
+loss_warmup = 50  # samples the sample period is learned from
+
+
+class LossCounter:
+    def __init__(self, period=None):
+        self.known_period = period  # steps of the counter per sample, if known beforehand
+        self.reset()
+
+    def reset(self):
+        """Starts counting again (a new trial: the Teensy's rate may have changed)."""
+        self.period = self.known_period
+        self.last = None  # counter of the newest sample
+        self.warmup = []  # counters received before the period was known
+        self.received = 0
+        self.missing = 0
+
+    def check(self, values):
+        """INPUT: the counters (Time channel) of the samples just received, in order (numpy array)
+        OUTPUT: [(counter before the gap, counter after it, samples missing), ...]"""
+        values = values[np.isfinite(values)].astype(np.float64)
+        self.received += len(values)
+        if self.period is None:
+            self.warmup.extend(values.tolist())
+            values = self.learn()
+        return self.find_gaps(values)
+
+    def learn(self):
+        """Works out the period once there are loss_warmup steps. OUTPUT: the counters to check (numpy array), none
+        until then"""
+        if len(self.warmup) <= loss_warmup:
+            return np.zeros(0)
+        values = np.array(self.warmup)
+        steps = np.diff(values)
+        steps = steps[steps >= 0]
+        if 2 * np.count_nonzero(steps) <= len(steps):  # the counter doesn't move every sample (or went back): try
+            del self.warmup[:-1]                       # again with the next ones
+            return np.zeros(0)
+        self.period = float(steps[steps <= 1.5 * np.median(steps)].mean())
+        self.warmup = []
+        return values
+
+    def find_gaps(self, values):
+        if not len(values):
+            return []
+        if self.last is not None:
+            values = np.concatenate(([self.last], values))
+        self.last = float(values[-1])
+        missing = np.round(np.diff(values) / self.period) - 1
+        gaps = [(float(values[i]), float(values[i + 1]), int(missing[i])) for i in np.flatnonzero(missing > 0)]
+        self.missing += sum(gap[2] for gap in gaps)
+        return gaps
+
+    def check_one(self, value):
+        """check() for a single sample's counter (a float), without the numpy overhead."""
+        if value != value:  # NaN
+            return []
+        self.received += 1
+        if self.period is None:
+            self.warmup.append(value)
+            return self.find_gaps(self.learn()) if len(self.warmup) > loss_warmup else []
+        if self.last is None:
+            self.last = value
+            return []
+        before = self.last
+        self.last = value
+        missing = round((value - before) / self.period) - 1
+        if missing <= 0:
+            return []
+        self.missing += missing
+        return [(before, value, missing)]
+
+    def loss(self):
+        """OUTPUT: samples missing, as a % of the samples that should have arrived"""
+        expected = self.received + self.missing
+        return 100.0 * self.missing / expected if expected else 0.0
+
+
+def create_loss_outlet(leg):
+    """Creates the marker stream (and outlet) of the samples missing from one device's stream, e.g. 'LeftLegLoss'."""
+    from pylsl import StreamInfo, StreamOutlet, IRREGULAR_RATE
+    info = StreamInfo(stream_names.get(leg, leg) + 'Loss', 'Markers', 1, IRREGULAR_RATE, 'string', 'YourComp')
+    info.desc().append_child_value("stream", stream_names.get(leg, leg))
+    return StreamOutlet(info)
+
+
+# ============================ reading from a port =====================================================================
+"""The read functions wait (sleeping in the OS, not spinning) until data arrives or a short time has passed. When the
+exo is idle the reader threads use next to no CPU, data is picked up as soon as it arrives, and a reader can still be
+stopped within serial_wait/socket_wait seconds."""
+recv_size = 4096  # max bytes taken from a bluetooth socket per .recv()
+net_recv_size = 65536  # max bytes taken from a network link per read (it can be much faster than bluetooth)
+serial_wait = 0.05  # seconds read_available() waits for data (the serial port's timeout, set by open_serial())
+socket_wait = 0.05  # seconds read_socket() waits for data
+
+
+def frame_command(data):
+    """Adds the length prefix the Teensy expects for settings/commands: 'data' -> 'len~data>' (see send_data())."""
+    return str(len(data)) + '~' + data + '>'
+
+
+def read_available(port):
+    """INPUT: an open serial.Serial port (timeout=serial_wait, as set up by open_serial())
+    OUTPUT: every byte waiting on the port, or b'' if nothing arrived in time
+
+    Reads everything the OS has buffered in one call, instead of one byte per call. If nothing is waiting yet, a
+    single byte read waits for data (up to the port's timeout), so the call returns as soon as data arrives."""
+    waiting = port.in_waiting
+    return port.read(waiting if waiting else 1)
+
+
+def read_socket(sock, timeout=socket_wait, size=recv_size):
+    """INPUT: a non-blocking bluetooth or TCP socket (as set up by open_rfcomm() or open_network()), and how long to
+    wait for data (seconds)
+    OUTPUT: everything received on the socket (up to size bytes), or b'' if nothing arrived in time
+
+    Waits with select() until the socket has data, so .recv() is only called when there is something to receive
+    (a non-blocking .recv() with nothing to receive raises an OSError). The lines are put back together by the leg's
+    LineBuffer, so it doesn't matter how the bluetooth module splits the data up."""
+    readable, _, _ = select.select([sock], [], [], timeout)
+    if not readable:
+        return b''
+    try:
+        data = sock.recv(size)
+    except (BlockingIOError, InterruptedError):
+        return b''
+    if not data:  # readable, but nothing to receive: the other end has closed the connection
+        raise ConnectionError("connection closed")
+    return data
+
+
+def read_datagrams(sock, timeout=socket_wait):
+    """Like read_socket(), for a UDP socket (open_network()): waits for data, then takes every datagram waiting (up
+    to net_recv_size bytes) in one go, so a bridge sending many small datagrams doesn't cost a pass each."""
+    readable, _, _ = select.select([sock], [], [], timeout)
+    if not readable:
+        return b''
+    data = bytearray()
+    while len(data) < net_recv_size:
+        try:
+            data += sock.recv(net_recv_size)
+        except (BlockingIOError, InterruptedError):
+            break
+    return bytes(data)
+
+
+# ============================ line buffer (one per leg) ===============================================================
+class LineBuffer:
+    """Holds the bytes received from one leg until a complete line ('\\n' terminated) is available.
+
+    feed() adds raw bytes from the port, next_line() hands back one complete line at a time (decoded, with the '\\n'
+    still on the end, the same way received_data_L/received_data_R used to look). Incomplete lines stay in the buffer
+    until the rest of the line arrives, so nothing is lost if a receive loop ends part way through a chunk.
+
+    scanned remembers how far the search for the next '\\n' has got, so a line that comes in many small reads (or
+    garbage without any '\\n', from a wrong baud rate) is only searched once, not again after every read.
+    next_lines_view() hands out every complete line at once, as a memoryview of the buffer (nothing copied), for
+    parsing a whole batch of lines in one go.
+
+    schema is the ChannelSchema the samples are read with (see 'channel schema'), the previous buffer's if there is
+    one (default_schema() otherwise).
+    """
+    def __init__(self, previous=None, schema=None):
+        self.buffer = bytearray()
+        self.scanned = 0  # there's no '\n' in buffer[:scanned]
+        self.view = None  # the memoryview last handed out by next_lines_view()
+        self.schema = schema or (previous.schema if previous is not None else default_schema())
+        if previous is not None:  # keeps the bytes already received by another buffer
+            previous.release()
+            self.buffer += previous.buffer
+
+    def feed(self, data):
+        if data:
+            if self.view is not None:
+                self.release()
+            self.buffer += data
+
+    def next_line(self):
+        """Returns the next complete line as a str, or None if a full line has not been received yet."""
+        if self.view is not None:
+            self.release()
+        end = self.buffer.find(end_byte, self.scanned)
+        if end < 0:
+            self.scanned = len(self.buffer)
+            return None
+        line = self.buffer[:end + 1]
+        del self.buffer[:end + 1]  # (cheap: a bytearray just moves its start)
+        self.scanned = 0
+        return line.decode('utf-8', errors='replace')
+
+    def next_lines_view(self, limit=None):
+        """Returns every complete line in the buffer (each with its '\\n') as one memoryview of the buffer, or None if
+        there isn't a complete line yet; with a limit, only the lines in the first 'limit' bytes (at least one line).
+        Nothing is copied: the view is only good until the next call on the buffer, which takes the lines off it."""
+        self.release()
+        end = self.buffer.rfind(end_byte, self.scanned) if limit is None else self.buffer.rfind(end_byte, 0, limit)
+        if end < 0:
+            end = self.buffer.find(end_byte, self.scanned)
+        if end < 0:
+            self.scanned = len(self.buffer)
+            return None
+        self.view = memoryview(self.buffer)[:end + 1]
+        return self.view
+
+    def release(self, used=None):
+        """Takes the lines handed out by next_lines_view() off the buffer (releasing the view), or only the first 'used'
+        bytes of them: the rest are handed out again."""
+        if self.view is not None:
+            taken = len(self.view) if used is None else used
+            self.view.release()
+            self.view = None
+            del self.buffer[:taken]
+            self.scanned = 0
+
+    def next_frames(self):
+        """Text only: there are never binary frames in a LineBuffer (see FrameBuffer)."""
+        return None
+
+    def clear(self):
+        self.release()
+        del self.buffer[:]
+        self.scanned = 0
+
+    def __len__(self):
+        return len(self.buffer) - (len(self.view) if self.view is not None else 0)
+
+
+# ============================ batch parsing of text lines ===========================================================
+"""During a trial, a leg's text lines are parsed a whole buffer at a time instead of one by one (LegReader.
+handle_save_batch()): the lines with a value per channel, tab separated, go through numpy.loadtxt's C parser in one
+call, and the rest (menu text, '@', '^') are split off to be handled one by one, in their place between the
+samples."""
+tab_byte = ord('\t')
+
+
+def parse_lines(data, channels=n_channels):
+    """INPUT: a batch of complete text lines (bytes-like, each ending in '\\n', see LineBuffer.next_lines_view()),
+    channels = values per sample (the leg's ChannelSchema.n)
+    OUTPUT: (samples, others) = an (n, channels) float64 array of the telemetry lines, and [(row, end, line), ...] for
+    every other line: the number of samples before it, the offset just past it in data, and the line (str)"""
+    codes = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(codes == end_byte[0]) + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    tabs = np.concatenate(([0], np.cumsum(codes == tab_byte)))
+    numeric = tabs[ends] - tabs[starts] == channels - 1
+    del codes, tabs
+    data = memoryview(data)
+    samples = np.zeros((0, channels))
+    if numeric.any():
+        text = data if numeric.all() else b"".join(data[start:end]
+                                                   for start, end in zip(starts[numeric], ends[numeric]))
+        try:
+            samples = np.loadtxt(io.BytesIO(text), delimiter='\t', dtype=np.float64, comments=None, ndmin=2)
+        except ValueError:  # a line with a field per channel that aren't all numbers: one line at a time
+            rows = []
+            for i in np.flatnonzero(numeric):
+                try:
+                    rows.append([float(value) for value in bytes(data[starts[i]:ends[i]]).split(b'\t')])
+                except ValueError:
+                    numeric[i] = False
+            samples = np.array(rows, dtype=np.float64).reshape(-1, channels)
+    rows_before = np.cumsum(numeric) - numeric
+    others = [(int(rows_before[i]), int(ends[i]), str(data[starts[i]:ends[i]], 'utf-8', 'replace'))
+              for i in np.flatnonzero(~numeric)]
+    data.release()
+    return samples.reshape(-1, channels), others
+
+
+# ============================ binary telemetry frames (optional) =====================================================
+"""Instead of a tab separated text line, the Teensy can send each sample as a binary frame: the sync word followed by
+the channels, laid out as the leg's ChannelSchema says (by default the 8 channels TimeLL, AngleLL, TorqueLL, FSR,
+Current, FSM State, Torque Setpoint, Position Setpoint as little-endian float32, see 'channel schema'). That's 34 bytes
+per sample instead of ~40-60 bytes of text, and a whole batch of frames is turned into floats by a single
+numpy.frombuffer() instead of a split() and 8 float() calls per line.
+
+Menu text, '^', '$' and '@' are still sent as text lines in between the frames. The sync word can't be mistaken for
+text, since 0xA5 is not an ASCII character.
+
+Binary frames are asked for when connecting (LegReader.negotiate(), 'Binary telemetry' in the setup windows): the GUI
+sends binary_command, and the Teensy answers with a line containing binary_ack. A leg that doesn't answer within
+negotiate_timeout stays on text (ASCII) telemetry.
+"""
+sync_word = b'\xa5\x5a'
+frame_dtype = default_schema().frame_dtype  # the default 8 float32 channels (ChannelSchema.frame_dtype)
+frame_size = frame_dtype.itemsize  # 34 bytes
+binary_command = "B/1"  # sent to the Teensy like any other setting (with the length prefix, see frame_command())
+binary_ack = "#BIN"  # the Teensy's answer when it switches to binary frames
+negotiate_timeout = 2.0  # seconds to wait for binary_ack
+
+
+def encode_frames(samples, schema=None):
+    """INPUT: samples, an (n, channels) array (or list of lists) of floats, schema = their ChannelSchema
+    (default_schema() if None)
+    OUTPUT: the bytes the Teensy sends for them in binary mode. Used by SimulatedExo, and handy for testing."""
+    schema = schema or default_schema()
+    values = schema.encode(samples)
+    frames = np.empty(len(values), dtype=schema.frame_dtype)
+    frames['sync'] = np.frombuffer(sync_word, dtype=np.uint8)
+    frames['values'] = values
+    return frames.tobytes()
+
+
+class FrameBuffer(LineBuffer):
+    """LineBuffer for a leg that sends binary frames: next_frames() hands back every complete frame at the start of
+    the buffer (one numpy array), next_line() the text lines in between.
+
+    A damaged frame is skipped up to the next sync word (resyncs counts how often), but damage can still turn frames
+    into a garbage text line (quarantined by the LegReader): for a link that really recovers, see the COBS packets
+    below."""
+    def __init__(self, previous=None, schema=None):
+        LineBuffer.__init__(self, previous, schema)
+        self.resyncs = 0
+
+    def next_line(self):
+        if self.buffer[:1] == sync_word[:1]:  # a frame comes first
+            return None
+        return LineBuffer.next_line(self)
+
+    def next_frames(self):
+        """Returns an (n, channels) float64 array of the frames at the start of the buffer, or None if there isn't a
+        complete frame there."""
+        if self.buffer[:2] != sync_word:
+            self.skip_damage()
+        size = self.schema.frame_size
+        n = len(self.buffer) // size
+        if n == 0 or self.buffer[:2] != sync_word:
+            return None
+        # count the frames in a row: every frame_size bytes there has to be a sync word
+        starts = np.frombuffer(self.buffer, dtype=np.uint8, count=n * size).reshape(n, size)[:, :2]
+        bad = np.flatnonzero((starts[:, 0] != sync_word[0]) | (starts[:, 1] != sync_word[1]))
+        if len(bad):
+            n = bad[0]
+        samples = self.schema.decode(np.frombuffer(self.buffer, dtype=self.schema.frame_dtype, count=n)['values'])
+        del starts
+        del self.buffer[:n * size]
+        self.scanned = 0
+        return samples
+
+    def skip_damage(self):
+        """Throws away the start of the buffer up to the next sync word, if it's a damaged frame (or garbage that no
+        text line could be: no '\n' before the sync word)."""
+        start = self.buffer.find(sync_word, 1)
+        if start < 0:
+            return
+        if self.buffer[:1] != sync_word[:1] and 0 <= self.buffer.find(end_byte, 0, start):
+            return  # a text line comes first
+        del self.buffer[:start]
+        self.scanned = 0
+        self.resyncs += 1
+
+
+# ============================ COBS framed link (optional) ============================================================
+"""With text lines or binary frames, one corrupted or lost byte can glue two lines together or hide a '^'/'@', and
+the trial ends early. In the COBS mode everything the Teensy sends (and everything the GUI sends to it) is a packet:
+
+    COBS(type byte + payload [+ CRC-16]) + 0x00
+
+COBS (Consistent Overhead Byte Stuffing) encodes the packet so it never contains a 0x00 byte, which makes 0x00 a
+delimiter that can't appear anywhere else. A damaged packet is thrown away, and the next 0x00 starts a fresh one: the
+link is back in sync after at most one packet, however the packet was damaged. With the checksum on ('C/2'), every
+packet also ends with a CRC-16 (CCITT) of type + payload, so damage that COBS can't see is caught too.
+
+Packet types: 'T' = text (a menu line, '^', '$', '@', or a command from the GUI), 'S' = sample (laid out like the
+values of a binary frame: the leg's ChannelSchema.sample_dtype), 'D' = a block of samples, delta encoded (see 'delta
+packets')
+
+Asked for like binary frames (LegReader.negotiate()): cobs_command ('C/1', or 'C/2' with the checksum), answered by a
+text line containing cobs_ack, after which both directions are COBS packets.
+"""
+cobs_command = {False: "C/1", True: "C/2"}  # without/with checksum
+cobs_ack = "#COBS"
+text_packet = b'T'
+sample_packet = b'S'
+
+
+def cobs_encode(data):
+    """OUTPUT: data COBS encoded (no 0x00 bytes in it), without the 0x00 delimiter."""
+    out = bytearray()
+    for part in bytes(data).split(b'\x00'):
+        while len(part) >= 254:  # longest block: code 0xFF + 254 bytes, no 0x00 after it
+            out.append(255)
+            out += part[:254]
+            part = part[254:]
+        out.append(len(part) + 1)
+        out += part
+    return bytes(out)
+
+
+def cobs_decode(packet):
+    """Undoes cobs_encode(). Raises ValueError if the packet can't be a COBS packet (damaged)."""
+    out = bytearray()
+    i = 0
+    n = len(packet)
+    while i < n:
+        code = packet[i]
+        if code == 0 or i + code > n:
+            raise ValueError("damaged COBS packet")
+        out += packet[i + 1:i + code]
+        i += code
+        if i < n and code < 255:
+            out.append(0)
+    return bytes(out)
+
+
+def encode_packet(packet_type, payload, checksum=False):
+    """OUTPUT: a complete packet (type + payload [+ CRC-16], COBS encoded, 0x00 at the end)."""
+    data = packet_type + bytes(payload)
+    if checksum:
+        data += binascii.crc_hqx(data, 0xFFFF).to_bytes(2, 'big')
+    return cobs_encode(data) + b'\x00'
+
+
+class CobsBuffer(LineBuffer):
+    """LineBuffer for a leg on the COBS framed link: next_line() hands back text packets, next_frames() sample and
+    delta packets (as one array for every such packet in a row), in the order they were received.
+
+    frames_ok, frames_dropped (wrong checksum, length or type) and resyncs (damaged packets, skipped up to the next
+    0x00) count what happened on the link since the buffer was made; delta_bytes and delta_samples what came in delta
+    packets."""
+    def __init__(self, previous=None, checksum=False, schema=None):
+        LineBuffer.__init__(self, previous, schema)
+        self.checksum = checksum
+        # decoded packets: str (text), bytes (one sample's values) or bytearray (a delta packet's payload)
+        self.packets = collections.deque()
+        self.packet_bytes = 0  # their length, so len() counts bytes for them as for the buffer (characters for text)
+        self.frames_ok = 0
+        self.frames_dropped = 0
+        self.resyncs = 0
+        self.delta_bytes = 0  # sent on the link, 0x00 included
+        self.delta_samples = 0
+
+    def feed(self, data):
+        LineBuffer.feed(self, data)
+        end = self.buffer.rfind(b'\x00')
+        if end < 0:
+            return
+        packets = bytes(self.buffer[:end]).split(b'\x00')
+        del self.buffer[:end + 1]
+        for packet in packets:
+            if packet:
+                self.decode(packet)
+
+    def decode(self, packet):
+        try:
+            data = cobs_decode(packet)
+        except ValueError:
+            self.resyncs += 1
+            return
+        if self.checksum:
+            if len(data) < 3 or binascii.crc_hqx(data[:-2], 0xFFFF) != int.from_bytes(data[-2:], 'big'):
+                self.frames_dropped += 1
+                return
+            data = data[:-2]
+        packet_type = data[:1]
+        if packet_type == text_packet:
+            self.packets.append(data[1:].decode('utf-8', errors='replace'))
+        elif packet_type == sample_packet and len(data) == 1 + self.schema.sample_size:
+            self.packets.append(data[1:])
+        elif packet_type == delta_packet and len(data) > 1:
+            self.packets.append(bytearray(data[1:]))
+            self.delta_bytes += len(packet) + 1
+        else:
+            self.frames_dropped += 1
+            return
+        self.packet_bytes += len(self.packets[-1])
+        self.frames_ok += 1
+
+    def next_line(self):
+        if self.packets and isinstance(self.packets[0], str):
+            return self.take()
+        return None
+
+    def take(self):
+        """OUTPUT: the next packet, no longer counted by len()"""
+        packet = self.packets.popleft()
+        self.packet_bytes -= len(packet)
+        return packet
+
+    def next_frames(self):
+        if not self.packets or isinstance(self.packets[0], str):
+            return None
+        if isinstance(self.packets[0], bytearray):  # delta packets, decoded together
+            payloads = []
+            while self.packets and isinstance(self.packets[0], bytearray):
+                payloads.append(bytes(self.take()))
+            samples, bad = decode_delta(payloads, self.schema.n)
+            self.frames_ok -= bad
+            self.frames_dropped += bad
+            self.delta_samples += len(samples)
+            return samples if len(samples) else self.next_frames()
+        samples = bytearray()
+        while self.packets and type(self.packets[0]) is bytes:
+            samples += self.take()
+        return self.schema.decode(np.frombuffer(samples, dtype=self.schema.sample_dtype))
+
+    def compression(self):
+        """OUTPUT: how many times fewer bytes the delta packets took than the same samples in sample packets, or None
+        before any arrived."""
+        if not self.delta_samples:
+            return None
+        size = self.schema.bytes_per_sample('cobs') + (2 if self.checksum else 0)
+        return self.delta_samples * size / self.delta_bytes
+
+    def clear(self):
+        LineBuffer.clear(self)
+        self.packets.clear()
+        self.packet_bytes = 0
+
+    def __len__(self):
+        """OUTPUT: bytes waiting, in the buffer (not decoded yet) and in packets decoded but not handed back yet"""
+        return len(self.buffer) + self.packet_bytes
+
+
+# ============================ delta packets (optional) ================================================================
+"""Most channels hardly change from one sample to the next (FSM state, setpoints), yet every sample packet sends all
+the values in full. Delta packets (type 'D', on the COBS link) send a block of samples much smaller:
+
+    varint(n) + for each channel (of the leg's ChannelSchema), the tokens of its n values:
+        literal: varint(zigzag(delta) << 1)       the value changed by delta (from the previous one, or from 0)
+        run:     varint(k << 1 | 1)              the next k values changed by the same delta as the last literal
+                                                 (by 0 if there is none yet): an unchanged channel, or a steady time
+
+Values are sent as whole multiples of 1/delta_scale (0.01, the resolution of the text lines). zigzag folds signed
+numbers into unsigned ones (0, -1, 1, -2, ... -> 0, 1, 2, 3, ...) so that small changes either way take one byte; a
+varint sends 7 bits per byte, the high bit set on every byte but the last. Each packet starts from 0, so a lost
+packet loses only its own samples.
+
+Asked for like COBS packets (LegReader.negotiate()): delta_command ('C/3', or 'C/4' with the checksum), answered by a
+text line containing delta_ack. decode_delta() decodes any number of packets at once with numpy (no Python loop per
+value), and CobsBuffer.compression() says how much smaller than sample packets they were."""
+delta_command = {False: "C/3", True: "C/4"}  # without/with checksum
+delta_ack = "#DELTA"
+delta_packet = b'D'
+delta_scale = 100  # values are sent in units of 1/delta_scale
+delta_block = 10  # samples per packet the Teensy (SimulatedExo) sends
+cobs_wires = ('cobs', 'delta')  # LegReader.wire of the legs on the COBS link
+
+
+def varints(numbers):
+    """OUTPUT: the non-negative ints 'numbers' as varints (bytes)."""
+    out = bytearray()
+    for number in numbers:
+        number = int(number)
+        while number >= 0x80:
+            out.append(number & 0x7F | 0x80)
+            number >>= 7
+        out.append(number)
+    return bytes(out)
+
+
+def encode_delta(samples):
+    """OUTPUT: the payload of one delta packet holding samples ((n, channels) array, n >= 1)."""
+    values = np.round(np.asarray(samples, dtype=np.float64) * delta_scale).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=0)
+    tokens = [len(values)]
+    for column in deltas.T:
+        last = 0
+        i = 0
+        while i < len(column):
+            run = 0
+            while i + run < len(column) and column[i + run] == last:
+                run += 1
+            if run:
+                tokens.append(run << 1 | 1)
+                i += run
+            else:
+                last = int(column[i])
+                tokens.append((last << 1 ^ last >> 63) << 1)  # zigzag, literal
+                i += 1
+    return varints(tokens)
+
+
+def decode_delta(payloads, channels=n_channels):
+    """Decodes the payloads of delta packets, all at once (channels = values per sample, the leg's ChannelSchema.n).
+    OUTPUT: (samples, bad) = an (n, channels) float64 array of their samples in order, and the number of packets
+    thrown away because they didn't add up to whole blocks of 'channels' values (damaged)."""
+    count = len(payloads)
+    data = np.frombuffer(b"".join(payloads), dtype=np.uint8)
+    sizes = np.array([len(payload) for payload in payloads], dtype=np.int64)
+    packet_starts = np.cumsum(sizes) - sizes
+
+    # every varint: where it starts and ends, its packet and its value. A payload's last byte always ends one, so an
+    # unfinished varint (a damaged packet) can't run into the next packet
+    filled = np.flatnonzero(sizes > 0)
+    last = packet_starts[filled] + sizes[filled] - 1
+    is_end = data < 0x80
+    good = np.ones(count, dtype=bool)
+    good[filled[~is_end[last]]] = False  # ends in an unfinished varint
+    is_end[last] = True
+    ends = np.flatnonzero(is_end)
+    if len(ends) == 0:
+        return np.zeros((0, channels)), count
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shift = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((data & 0x7F).astype(np.uint64) << (7 * shift).astype(np.uint64), starts)
+    packet = np.searchsorted(packet_starts, starts, 'right') - 1
+
+    # the first varint of each packet is its number of samples, the rest are tokens
+    first = np.concatenate(([True], packet[1:] != packet[:-1]))
+    n = np.zeros(count, dtype=np.int64)
+    n[packet[first]] = np.minimum(values[first], 1 << 20).astype(np.int64)
+    tokens = values[~first]
+    token_packet = packet[~first]
+    is_run = (tokens & np.uint64(1)).astype(bool)
+    argument = np.minimum(tokens >> np.uint64(1), np.uint64(1 << 40)).astype(np.int64)
+    lengths = np.where(is_run, argument, 1)
+    literal = (argument >> 1) ^ -(argument & 1)  # zigzag back to signed
+    good &= (n > 0) & (np.bincount(token_packet, weights=lengths, minlength=count) == channels * n)
+    keep = good[token_packet]
+    token_packet, is_run, lengths, literal = token_packet[keep], is_run[keep], lengths[keep], literal[keep]
+    n = n * good
+
+    # the channel of each token, and the delta each run repeats (the channel's last literal, or 0)
+    block_start = np.cumsum(channels * n) - channels * n  # values before each packet
+    before = np.cumsum(lengths) - lengths - block_start[token_packet]  # values before the token, in its packet
+    channel = token_packet * channels + before // np.maximum(n[token_packet], 1)
+    last_literal = np.maximum(np.maximum.accumulate(np.where(is_run, -1, np.arange(len(literal)))), 0)
+    carried = (channel[last_literal] == channel) & ~is_run[last_literal]
+    delta = np.where(is_run, np.where(carried, literal[last_literal], 0), literal)
+
+    # one row per sample, then the deltas added up within each packet
+    deltas = np.repeat(delta, lengths)
+    row_start = np.cumsum(n) - n
+    value_packet = np.repeat(np.arange(count), channels * n)
+    offset = np.arange(len(deltas)) - block_start[value_packet]
+    samples = np.zeros((int(n.sum()), channels), dtype=np.int64)
+    samples[row_start[value_packet] + offset % n[value_packet], offset // n[value_packet]] = deltas
+    sums = np.cumsum(samples, axis=0)
+    sums_before = np.concatenate((np.zeros((1, channels), dtype=np.int64), sums))[row_start]  # per packet
+    samples = sums - np.repeat(sums_before, n, axis=0)
+    return samples / delta_scale, int(np.count_nonzero(~good))
+
+
+# ============================ link speed probe ========================================================================
+"""To find out what a leg's link really carries, the GUI sends probe_command + the probe length in ms ('P/3000'). The
+Teensy answers with test pattern lines, as fast as it can, for that long:
+
+    #P<tab><line number><tab><pattern>
+
+followed by '#PEND<tab><lines sent>'. The leg's LegReader counts the bytes and lines that arrive, and which line numbers
+never did (LinkProbe). The result says how many samples/s the link can take (max_sample_rate()), before a trial is
+started at a sample rate the link can't keep up with.
+"""
+probe_command = "P/"
+probe_line = "#P\t"
+probe_end = "#PEND"
+probe_pattern = "0123456789ABCDEF0123456789ABCDEF"  # about as long as a telemetry line
+probe_seconds = 3.0
+bytes_per_sample = {wire: default_schema().bytes_per_sample(wire)  # of the default 8 channels
+                    for wire in ('ascii', 'binary', 'cobs', 'delta')}
+
+
+class LinkProbe:
+    """Counts what arrives from one leg during a probe. count_bytes() gets every chunk read, line() every line; line()
+    returns False for lines that aren't part of the probe. finished is set by the '#PEND' line."""
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+        self.last_number = -1
+        self.sent = None  # lines the Teensy says it sent
+        self.first_time = None
+        self.last_time = None
+        self.finished = False
+
+    def count_bytes(self, n):
+        now = time.perf_counter()
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        self.bytes += n
+
+    def line(self, line):
+        if line.startswith(probe_end):
+            try:
+                self.sent = int(line.split("\t")[1])
+            except (IndexError, ValueError):
+                pass
+            self.finished = True
+        elif line.startswith(probe_line):
+            try:
+                self.last_number = max(self.last_number, int(line.split("\t")[1]))
+            except (IndexError, ValueError):
+                pass
+            self.lines += 1
+        else:
+            return False
+        return True
+
+    def result(self):
+        """OUTPUT: {'bytes/s', 'lines/s', 'loss %'}, or None if nothing arrived."""
+        if self.first_time is None or self.last_time <= self.first_time:
+            return None
+        seconds = self.last_time - self.first_time
+        sent = self.sent if self.sent is not None else self.last_number + 1
+        lost = max(sent - self.lines, 0)
+        return {'bytes/s': self.bytes / seconds,
+                'lines/s': self.lines / seconds,
+                'loss %': 100.0 * lost / sent if sent else 0.0}
+
+
+def max_sample_rate(bytes_per_second, wire='ascii', checksum=False, margin=0.8, schema=None):
+    """OUTPUT: the highest sample rate (samples/s) a link that carries bytes_per_second can take with the given
+    telemetry and ChannelSchema (the default 8 channels if None), leaving 'margin' of the link for everything else."""
+    size = (schema or default_schema()).bytes_per_sample(wire) + (2 if checksum else 0)
+    return int(margin * bytes_per_second / size)
+
+
+# ============================ sample rate (decimation) ================================================================
+"""A link that can't carry every sample (bluetooth, mostly) gets every n-th one instead. After probing the link, the
+GUI sends rate_command + the most samples/s the link can take ('R/180', see max_sample_rate()). The Teensy picks the
+smallest n that fits and answers with
+
+    #RATE<tab><n><tab><samples/s it will send>
+
+It keeps the new rate for the whole of the next trial: a rate asked for during a trial only starts with the next one.
+The leg's LSL stream is made again with the new rate in its StreamInfo (nominal rate, and 'decimation' in its
+description), so the recording says what was really sent. A Teensy that doesn't answer keeps sending every sample."""
+rate_command = "R/"
+rate_ack = "#RATE"
+default_rate = 100  # nominal rate (samples/s) of a leg's LSL stream until the Teensy says otherwise
+
+
+# ============================ link monitor ============================================================================
+"""Every reader keeps a LinkMonitor, to see whether a link (bluetooth especially) keeps up. Over each monitor_interval
+it counts the bytes, lines (or frames) and reads, and times the gaps between the reads that brought data. At the end
+of each interval, LegReader.link_stats() has (monitor_labels):
+'bytes/s', 'lines/s' - what came in
+'jitter ms' - spread (standard deviation) of the time between reads with data
+'empty reads %' - reads that returned nothing (readers with a thread of their own wait in read()); for the readers
+                  the Poller reads, its waits for data that ended without any from that device
+'backlog' - bytes received but not parsed yet
+'lag ms' - how much later than the quickest the newest sample arrived (see DeviceClock): it grows when the link can't
+           keep up and samples pile up on the way (NaN outside of trials)
+'loss %' - samples missing, as a share of the samples that should have arrived (see 'sample loss')
+The Bluetooth and Wi-Fi setup windows show them, and with bluetooth or Wi-Fi (monitored_types) they're also pushed to a
+low-rate LSL stream of each device (create_monitor_outlet()), so they end up in the recording."""
+monitor_interval = 1.0  # seconds per LinkMonitor update
+monitor_labels = ["bytes/s", "lines/s", "jitter ms", "empty reads %", "backlog", "lag ms", "loss %"]
+
+
+def create_monitor_outlet(leg):
+    """Creates the LSL stream (and outlet) of one device's LinkMonitor, e.g. 'LeftLegLink'."""
+    from pylsl import StreamInfo, StreamOutlet
+    info = StreamInfo(stream_names.get(leg, leg) + 'Link', 'LinkQuality', len(monitor_labels), 1 / monitor_interval,
+                      'float32', 'YourComp')
+    channels = info.desc().append_child("channels")
+    for c in monitor_labels:
+        channels.append_child("channel") \
+            .append_child_value("label", c)
+    return StreamOutlet(info)
+
+
+class LinkMonitor:
+    def __init__(self):
+        self.stats = {}  # of the last complete interval, see monitor_labels
+        self.start = time.monotonic()
+        self.last_read = None  # when the last read with data returned
+        self.clear()
+
+    def clear(self):
+        self.bytes = 0
+        self.lines = 0
+        self.reads = 0
+        self.empty = 0
+        self.missing = 0  # samples missing (see LossCounter)
+        self.gaps = 0  # gaps between reads with data, their sum and sum of squares (seconds)
+        self.gap_sum = 0.0
+        self.gap_squares = 0.0
+
+    def count_read(self, n_bytes, now):
+        self.reads += 1
+        if not n_bytes:
+            self.empty += 1
+            return
+        self.bytes += n_bytes
+        if self.last_read is not None:
+            gap = now - self.last_read
+            self.gaps += 1
+            self.gap_sum += gap
+            self.gap_squares += gap * gap
+        self.last_read = now
+
+    def update(self, now, backlog, lag):
+        """Ends the interval if it's over. OUTPUT: the new stats, or None if the interval isn't over yet."""
+        elapsed = now - self.start
+        if elapsed < monitor_interval:
+            return None
+        jitter = 0.0
+        if self.gaps > 1:
+            mean = self.gap_sum / self.gaps
+            jitter = max(self.gap_squares / self.gaps - mean * mean, 0.0) ** 0.5
+        expected = self.lines + self.missing
+        self.stats = dict(zip(monitor_labels, (self.bytes / elapsed, self.lines / elapsed, 1000 * jitter,
+                                               100 * self.empty / self.reads if self.reads else 0.0, backlog,
+                                               1000 * lag, 100 * self.missing / expected if expected else 0.0)))
+        self.start = now
+        self.clear()
+        return self.stats
+
+
+# ============================ raw byte capture (optional) =============================================================
+"""To see what the Teensy really sent, the bytes each reader receives can be appended, as they are, to a file per
+device ('Capture raw bytes' in the setup windows). The file starts with one text line (b"PREXRAW 1 <name> <date>\n"),
+then one record per read: the host's time.monotonic() (float64), the number of bytes (uint32), both little-endian,
+then the bytes. read_capture() reads a file back.
+
+The readers only append to a deque (no file access, no locks); a RawCapture thread writes whatever has piled up every
+capture_interval seconds, gathered into one system call per file (os.writev(), where there is one) instead of copied
+into one large buffer first, so capturing takes as little as it can from the receiving."""
+capture_dir = "captures"  # where the capture files go
+capture_interval = 0.25  # seconds between the RawCapture thread's writes
+capture_iov = 1024  # most pieces per os.writev() (IOV_MAX on Linux and macOS)
+capture_record = struct.Struct('<dI')  # host monotonic time (s), number of bytes that follow
+
+
+class RawCapture(threading.Thread):
+    """INPUTS: names = the devices captured, directory = where their files go (made if needed)
+    write(name, data) is what the readers call (LegReader.capture), close() writes the rest and closes the files."""
+    def __init__(self, names, directory=capture_dir):
+        threading.Thread.__init__(self, name="RawCapture", daemon=True)
+        os.makedirs(directory, exist_ok=True)
+        started = time.strftime("%Y%m%d-%H%M%S")
+        self.paths = {name: os.path.join(directory, "prex_raw_%s_%s.bin" % (name, started)) for name in names}
+        self.files = {}
+        for name, path in self.paths.items():
+            self.files[name] = open(path, 'wb', buffering=0)  # see write_gathered()
+            self.files[name].write(("PREXRAW 1 %s %s\n" % (name, started)).encode())
+        self.pending = collections.deque()  # (name, time, data) not written yet
+        self.bytes = dict.fromkeys(names, 0)  # bytes captured per device
+        self.running = True
+        self.start()
+        atexit.register(self.close)  # the GUI was closed while capturing
+
+    def write(self, name, data):
+        self.pending.append((name, time.monotonic(), data))
+
+    def run(self):
+        while self.running:
+            time.sleep(capture_interval)
+            self.write_pending()
+
+    def write_pending(self):
+        chunks = {name: [] for name in self.files}
+        while self.pending:
+            name, read_time, data = self.pending.popleft()
+            if name in chunks:
+                chunks[name] += [capture_record.pack(read_time, len(data)), data]
+                self.bytes[name] += len(data)
+        for name, chunk in chunks.items():
+            if chunk:
+                write_gathered(self.files[name], chunk)
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.join()
+        atexit.unregister(self.close)
+        self.write_pending()
+        for f in self.files.values():
+            f.close()
+        print("Raw capture: " + ", ".join("%s %d bytes (%s)" % (name, self.bytes[name], path)
+                                          for name, path in self.paths.items()))
+
+
+def write_gathered(f, parts):
+    """Writes the bytes objects 'parts' to the unbuffered file f, capture_iov of them per system call, without joining
+    them into one buffer first (where there's no os.writev(), they are joined)."""
+    if not hasattr(os, 'writev'):  # Windows
+        f.write(b"".join(parts))
+        return
+    for i in range(0, len(parts), capture_iov):
+        batch = parts[i:i + capture_iov]
+        written = os.writev(f.fileno(), batch)
+        if written < sum(len(part) for part in batch):  # a short write: the rest the slow way
+            rest = memoryview(b"".join(batch))[written:]
+            while len(rest):
+                rest = rest[f.write(rest):]
+
+
+def read_capture(path):
+    """Reads a RawCapture file. OUTPUT: (header line, [(host monotonic time, bytes), ...])"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    end = data.index(b'\n') + 1
+    header = data[:end].decode()
+    records = []
+    while end < len(data):
+        read_time, size = capture_record.unpack_from(data, end)
+        end += capture_record.size
+        records.append((read_time, data[end:end + size]))
+        end += size
+    return header, records
+
+
+# ============================ readers (one per device) ================================================================
+"""Each leg (or other device) gets its own LegReader, read by the Poller thread (or a thread of its own), so data keeps
+being read (and pushed to LSL) no matter what Tkinter is doing. The reader never touches Tkinter: it hands text lines
+to the GUI through a bounded queue, and flags the control characters ('^', '$', '@') through attributes that the GUI
+checks on an after() timer (see poll_receive() in NIHPREX_GUI.py).
+
+A reader is in one of these modes:
+'hold' - bytes are still read from the port into the leg's buffer, but no lines are taken out of it
+         (this is what used to happen between calls to the receive___() functions)
+'menu' - lines are handed to the GUI to print in the consoles (receive_data())
+'save' - lines (or binary frames) are converted to floats and pushed to the leg's LSL outlet (receive_and_save_data())
+'negotiate' - waiting for the Teensy to answer schema_command and binary_command (negotiate())
+'probe' - counting the test pattern lines the Teensy streams (probe())
+'rate' - waiting for the Teensy to answer rate_command (fit_rate())
+
+When a leg's link is lost (the read fails, or no data arrives for stall_timeout seconds during a trial), only that
+leg is reconnected, in the background, with the reopen function it was given; the other legs carry on. A gap marker
+sample (all NaN) is pushed to the leg's LSL stream where the gap starts, and once data arrives again the console shows
+how long reconnecting took and how many samples were lost (from the Teensy's Time channel).
+
+During a trial, a line that isn't a sample (a bit error in a digit or a tab, two lines run together, garbage from a
+damaged binary frame) no longer ends the trial: it goes to the leg's quarantine and the samples after it are saved as
+usual. Only the Teensy's own control lines end a trial: '@' or '^' as plain ASCII text (is_control_line()), which a
+damaged sample line is very unlikely to turn into. The number of lines quarantined is shown at the end of the
+trial with the other link counts.
+"""
+queue_size = 1000  # max lines waiting for the GUI; extra lines are counted in LegReader.dropped instead
+quarantine_size = 100  # malformed lines kept per leg (LegReader.quarantine), the ones after that are only counted
+stall_timeout = 2.0  # seconds without data, during a trial, before a leg's link counts as lost
+reconnect_wait = 1.0  # seconds between attempts to reconnect a lost link
+
+
+def is_control_line(line, char):
+    """True if line is the Teensy sending the control character 'char' ('@', '^', ...) rather than a damaged
+    telemetry line that happens to contain it: plain printable ASCII, without tabs (or with 'char' at the end, after a
+    sample line that lost its '\\n')."""
+    text = line.strip()
+    if char not in text or ("\t" in text and not text.endswith(char)):
+        return False
+    return text.isascii() and text.replace("\t", "").isprintable()
+
+
+class LegReader(threading.Thread):
+    """Reads and parses the data from one leg.
+
+    INPUTS: leg = 'L' or 'R', read = function that waits briefly for data on the leg's port or socket and returns it
+    (b'' if nothing arrived, OSError if the connection is lost), write = function sending bytes to the leg,
+    outlet = the leg's LSL StreamOutlet, ring = SampleRing to also copy each sample to (optional),
+    link = the port or socket read/write use, reopen = function opening it again, returning (link, read, write) like
+    open_link() (optional: without it a lost link stays lost)
+    """
+    def __init__(self, leg, read, write, outlet, ring=None, link=None, reopen=None):
+        threading.Thread.__init__(self, name="LegReader " + leg, daemon=True)
+        self.leg = leg
+        self.read = read
+        self.write = write
+        self.outlet = outlet
+        self.ring = ring
+        self.link = link
+        self.reopen = reopen
+        self.schema = default_schema(leg)  # the channels the leg sends, see 'channel schema' (set by negotiate())
+        self.buffer = LineBuffer(schema=self.schema)
+        self.lines = queue.Queue(queue_size)  # lines for the GUI consoles
+        self.dropped = 0  # lines the GUI didn't take in time
+        self.quarantine = collections.deque(maxlen=quarantine_size)  # the latest malformed lines of the trial
+        self.quarantined = 0  # malformed lines since arm('save')
+        self.trial_counts = None  # counts() when the last trial ended, see set_mode()
+        self.error = None  # why the connection was lost, if it was
+        self.mode = 'hold'
+        self.running = True
+        self.wire = 'ascii'  # 'ascii' (text lines), 'binary' (binary frames) or 'cobs' (COBS packets), see negotiate()
+        self.checksum = False  # COBS packets carry a CRC-16
+        self.asking_for = None  # (wire, checksum) asked for by negotiate(), until the Teensy answers
+        self.asking_schema = False  # negotiate() is waiting for the Teensy to describe its channels
+        self.negotiate_deadline = 0
+        self.link_probe = LinkProbe()
+        self.probe_deadline = 0
+        self.probe_result = None  # LinkProbe.result() of the last probe()
+        self.last_data = time.monotonic()  # when data last arrived
+        self.max_backlog = 0  # most bytes waiting to be parsed since arm('save') (see Poller.drain())
+        self.lost_at = 0
+        self.gap = False  # the link was lost, and no sample has arrived since
+        self.time_before_gap = None  # Time channel of the last sample before the link was lost
+        self.last_time = None  # Time channel of the last sample saved
+        self.sample_period = None  # Time channel difference between samples
+        self.reconnects = []  # (seconds to reconnect, samples lost or None) of each time the link was lost
+        self.capture = None  # RawCapture the bytes received are also written to
+        self.clock = lsl_clock()
+        self.arrival = self.clock()  # LSL time the last bytes were read
+        self.device_clock = DeviceClock()  # turns the Time channel into LSL timestamps
+        self.lag = float('nan')  # arrival time - timestamp of the newest sample saved (seconds)
+        self.monitor = LinkMonitor()
+        self.monitor_outlet = None  # LSL outlet the LinkMonitor's stats are pushed to (see create_monitor_outlet())
+        self.loss = LossCounter()  # samples missing from the Time channel since arm('save')
+        self.loss_outlet = None  # LSL marker outlet the gaps are pushed to (see create_loss_outlet())
+        self.clock_outlet = None  # LSL outlet the DeviceClock's fits are pushed to (see create_clock_outlet())
+
+        # set by the thread, checked (and reset by arm()) from the GUI
+        self.fin = False  # prompt character received
+        self.trial_start = False  # trial start character received
+        self.trial_stop = False  # trial stop (or prompt) character received, or a sample couldn't be pushed to LSL
+        self.negotiated = False  # the Teensy has answered negotiate(), or negotiate_timeout has passed
+        self.probed = False  # the probe has finished (or timed out), see probe_result
+        self.rate_set = False  # the Teensy has answered rate_command (or negotiate_timeout has passed)
+        self.decimation = 1  # the Teensy sends every n-th sample
+        self.sample_rate = None  # samples/s the Teensy sends, once it has said so
+        self.new_outlet = None  # function(rate, decimation, schema) making the leg's outlet again (optional)
+
+    def arm(self, mode):
+        """Starts taking lines out of the buffer again, in 'menu' or 'save' mode. The trial's counts (quarantine, loss,
+        clock, backlog) only start over with a new trial, 'save': Stop Trial arms 'menu' before the '@' arrives."""
+        self.fin = False
+        self.trial_start = False
+        self.trial_stop = False
+        self.last_data = time.monotonic()
+        if mode == 'save':
+            self.max_backlog = 0
+            self.quarantine.clear()
+            self.quarantined = 0
+            self.loss.reset()
+            self.device_clock.reset()
+        self.lag = float('nan')
+        self.set_mode(mode)
+
+    def hold(self):
+        self.set_mode('hold')
+
+    def set_mode(self, mode):
+        """Leaving the 'save' mode (however the trial ended) keeps the trial's counts() in trial_counts."""
+        if self.mode == 'save' and mode != 'save':
+            self.trial_counts = self.counts()
+        self.mode = mode
+
+    def negotiate(self, wire='binary', checksum=False):
+        """Asks the Teensy to describe its channels (see 'channel schema'), and for binary telemetry frames (wire =
+        'binary'), COBS packets (wire = 'cobs', with a CRC-16 if checksum is True) or COBS packets with the samples in
+        delta packets (wire = 'delta'); wire = 'ascii' stays on text lines. When it has answered (or doesn't, within
+        negotiate_timeout), negotiated is set and the reader holds; schema and wire say what the leg ended up with."""
+        self.negotiated = False
+        self.asking_for = (wire, checksum) if wire != 'ascii' else None
+        self.asking_schema = True
+        self.negotiate_deadline = time.monotonic() + negotiate_timeout
+        self.mode = 'negotiate'
+        self.send(frame_command(schema_command))  # answered in text, before the wire changes
+        if wire != 'ascii':
+            command = binary_command if wire == 'binary' else (delta_command if wire == 'delta' else cobs_command)
+            self.send(frame_command(command if wire == 'binary' else command[checksum]))
+
+    def probe(self, seconds=probe_seconds):
+        """Has the Teensy stream a test pattern for 'seconds' (see 'link speed probe'). When it's done (or the pattern
+        stops for negotiate_timeout), probed is set, probe_result holds the result and the reader holds."""
+        self.probed = False
+        self.probe_result = None
+        self.link_probe = LinkProbe()
+        self.probe_deadline = time.monotonic() + seconds + negotiate_timeout
+        self.mode = 'probe'
+        self.send(frame_command(probe_command + str(int(1000 * seconds))))
+
+    def fit_rate(self, max_rate):
+        """Asks the Teensy to send at most max_rate samples/s (see 'sample rate (decimation)'). When it answers (or
+        doesn't, within negotiate_timeout), rate_set is set and the reader holds; decimation and sample_rate say what
+        the leg ended up with."""
+        self.rate_set = False
+        self.negotiate_deadline = time.monotonic() + negotiate_timeout
+        self.mode = 'rate'
+        self.send(frame_command(rate_command + str(int(max_rate))))
+
+    def send(self, data):
+        """Sends a str (as built by send_data()) to the leg, as a COBS text packet if the link is COBS framed. A link
+        that is lost (or still reconnecting) only gets a line in the leg's console, so the other legs are still sent
+        the command."""
+        data = bytes(data, encoding='utf-8')
+        if self.wire in cobs_wires:
+            data = encode_packet(text_packet, data, self.checksum)
+        try:
+            self.write(data)
+        except OSError as err:  # includes serial.SerialException and socket errors
+            self.post("*** " + repr(data.decode('utf-8', errors='replace')) + " not sent: link lost (" + str(err) +
+                      ")\n")
+
+    def link_stats(self):
+        """The LinkMonitor's stats of the last monitor_interval, for the GUI."""
+        return self.monitor.stats
+
+    def counts(self):
+        """What happened on the link so far, for the GUI."""
+        counts = {'lines dropped': self.dropped, 'lines quarantined': self.quarantined, 'max backlog': self.max_backlog,
+                  'samples missing': self.loss.missing, 'loss %': round(self.loss.loss(), 2)}
+        if self.device_clock.fit is not None:
+            counts['clock drift ppm'] = round(1e6 * self.device_clock.fit[2], 1)
+        if self.reconnects:
+            counts['reconnects'] = len(self.reconnects)
+            counts['samples lost'] = sum(lost for _, lost in self.reconnects if lost is not None)
+        if self.wire == 'binary':
+            counts['resyncs'] = self.buffer.resyncs
+        elif self.wire in cobs_wires:
+            counts['frames'] = self.buffer.frames_ok
+            counts['frames dropped'] = self.buffer.frames_dropped
+            counts['resyncs'] = self.buffer.resyncs
+            if self.buffer.compression() is not None:
+                counts['compression'] = round(self.buffer.compression(), 1)
+        return counts
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        """The reader's own thread, for a device a Poller can't wait on."""
+        while self.running:
+            try:
+                data = self.read()  # waits for data, see 'reading from a port'
+            except OSError as err:  # includes serial.SerialException
+                self.lost(err)
+                if self.reconnect():
+                    continue
+                break
+            self.receive(data)
+            if self.stalled():
+                self.lost("no data for %g s" % stall_timeout)
+                if not self.reconnect():
+                    break
+
+    def stalled(self):
+        """True if the leg should be sending (a trial is running and the Teensy hasn't ended it) but nothing has
+        arrived for stall_timeout."""
+        return self.mode == 'save' and not self.trial_stop and time.monotonic() - self.last_data > stall_timeout
+
+    def lost(self, err):
+        self.error = str(err)
+        print("Lost connection to " + device_title(self.leg) + ": " + self.error)
+        if not self.gap:  # not still waiting for data after an earlier loss
+            self.lost_at = time.monotonic()
+            self.gap = True
+            self.time_before_gap = self.last_time
+            if self.mode == 'save':
+                self.outlet.push_sample([float('nan')] * self.schema.n)  # marks where the gap starts
+        self.post("*** link lost (" + self.error + ")" + (", reconnecting...\n" if self.reopen else "\n"))
+
+    def reconnect(self):
+        """Opens the lost link again with reopen(), every reconnect_wait seconds until it works or the reader is
+        stopped. OUTPUT: True if it's back."""
+        if self.reopen is None:
+            return False
+        try:
+            self.link.close()
+        except Exception:  # already closed, or never was a port
+            pass
+        while self.running:
+            try:
+                self.link, self.read, self.write = self.reopen()
+                break
+            except Exception:  # still out of range, unplugged, ...
+                time.sleep(reconnect_wait)
+        if not self.running:
+            return False
+        self.buffer.clear()  # the line the link was lost in won't be finished
+        self.error = None
+        self.last_data = time.monotonic()
+        if self.mode != 'save':  # no samples to lose
+            self.end_gap(None)
+        return True
+
+    def end_gap(self, first_time):
+        """Called with the Time channel of the first sample after reconnecting: reports how long the link was lost
+        and how many samples went missing."""
+        seconds = time.monotonic() - self.lost_at if first_time is None else self.last_data - self.lost_at
+        lost = None
+        if first_time is not None and self.time_before_gap is not None and self.sample_period:
+            lost = max(int(round((first_time - self.time_before_gap) / self.sample_period)) - 1, 0)
+        self.reconnects.append((seconds, lost))
+        self.gap = False
+        self.last_time = None  # the gap isn't a sample period
+        self.device_clock.reset()
+        self.post("*** reconnected after %.1f s, %s samples lost\n" % (seconds, "?" if lost is None else lost))
+
+    def note_time(self, first, last, n):
+        """Keeps track of the Time channel of the samples saved: the last one, and the time between samples."""
+        if n > 1:
+            self.sample_period = (last - first) / (n - 1)
+        elif self.last_time is not None and first > self.last_time:
+            self.sample_period = first - self.last_time
+        self.last_time = last
+
+    def receive(self, data):
+        """Handles the bytes just read (or b'', to handle what's already in the buffer and check the timeouts)."""
+        self.feed(data)
+        if self.mode != 'hold':
+            self.handle_lines()
+        self.check_timeouts()
+
+    def feed(self, data):
+        """Adds the bytes just read to the buffer, without parsing them yet."""
+        self.monitor.count_read(len(data), time.monotonic())
+        if data:
+            self.arrival = self.clock()
+            self.last_data = time.monotonic()
+            if self.capture is not None:
+                self.capture.write(self.leg, data)
+            self.buffer.feed(data)
+            self.max_backlog = max(self.max_backlog, len(self.buffer))
+            if self.mode == 'probe':
+                self.link_probe.count_bytes(len(data))
+
+    def backlog(self):
+        """Bytes received but not parsed yet (the leg's queue depth)."""
+        return len(self.buffer)
+
+    def check_timeouts(self):
+        stats = self.monitor.update(time.monotonic(), self.backlog(), self.lag if self.mode == 'save' else float('nan'))
+        if stats is not None and self.monitor_outlet is not None:
+            self.monitor_outlet.push_sample(list(stats.values()))
+        if self.mode == 'negotiate' and time.monotonic() > self.negotiate_deadline:
+            if self.asking_for is not None:
+                print(device_title(self.leg) + " didn't answer, staying on text telemetry")
+            if self.asking_schema:
+                print(device_title(self.leg) + " didn't describe its channels, expecting %d" % self.schema.n)
+            self.asking_for = None
+            self.asking_schema = False
+            self.negotiated = True
+            self.mode = 'hold'
+        if self.mode == 'probe' and time.monotonic() > self.probe_deadline:
+            print(device_title(self.leg) + " didn't finish the probe")
+            self.finish_probe()
+        if self.mode == 'rate' and time.monotonic() > self.negotiate_deadline:
+            print(device_title(self.leg) + " didn't answer, sending every sample")
+            self.rate_set = True
+            self.mode = 'hold'
+
+    def handle_lines(self, budget=None):
+        """Parses the complete lines (and frames) in the buffer, or only about 'budget' bytes of them.
+        OUTPUT: True if the budget ran out before the lines did."""
+        start = len(self.buffer)
+        while self.mode != 'hold':
+            if budget is not None and start - len(self.buffer) >= budget:
+                return True
+            frames = self.buffer.next_frames()
+            if frames is not None:
+                self.monitor.lines += len(frames)
+                if self.mode == 'save':
+                    self.handle_save_frames(frames)
+                continue  # frames outside of a trial are thrown away
+            if self.mode == 'save' and type(self.buffer) is LineBuffer:  # text lines during a trial: all at once
+                if not self.handle_save_batch(None if budget is None else budget - (start - len(self.buffer))):
+                    break  # no complete line yet
+                continue
+            line = self.buffer.next_line()
+            if line is None:  # no complete line yet
+                break
+            self.monitor.lines += 1
+            if self.mode == 'menu':
+                self.handle_menu_line(line)
+            elif self.mode == 'save':
+                self.handle_save_line(line)
+            elif self.mode == 'probe':
+                self.handle_probe_line(line)
+            elif self.mode == 'rate':
+                self.handle_rate_line(line)
+            else:
+                self.handle_negotiate_line(line)
+        return False
+
+    def handle_menu_line(self, line):
+        self.post(line)
+        if trial_start_char in line:
+            self.trial_start = True
+        if prompt_char in line:  # end of menu communication
+            self.fin = True
+            self.mode = 'hold'
+
+    def handle_save_line(self, line):
+        try:
+            sample = [float(i) for i in line.split("\t")]  # splits line into the schema's channels
+        except ValueError:
+            sample = None
+        if sample is None or len(sample) != self.schema.n:
+            if is_control_line(line, trial_stop_char) or is_control_line(line, prompt_char):
+                self.trial_stop = True
+                if prompt_char in line:
+                    self.fin = True
+                    self.set_mode('hold')
+            elif self.trial_stop:  # the Teensy's text after its '@', e.g. the trial's summary
+                self.post(line)
+            else:  # damaged on the way: set aside, the trial goes on
+                self.quarantine_line(line)
+            return
+        try:  # pushes samples to LSL
+            sample[0] = self.device_clock.unwrap_one(sample[0])
+            if self.gap and self.error is None:
+                self.end_gap(sample[0])
+            timestamp = self.device_clock.stamp(sample[0], self.arrival)
+            self.outlet.push_sample(sample, timestamp)
+            self.lag = self.arrival - timestamp
+            if self.ring is not None:
+                self.ring.write(self.leg, sample)
+            self.note_time(sample[0], sample[0], 1)
+            self.mark_gaps(self.loss.check_one(sample[0]))
+            self.push_clock_fit()
+        except Exception:
+            self.trial_stop = True
+            print("Ending trial, couldn't push to LSL... (" + self.leg + ")")
+
+    def quarantine_line(self, line):
+        if not self.quarantined:  # the first one of the trial, the rest are counted
+            print("Malformed line from " + device_title(self.leg) + " quarantined: " + repr(line))
+        self.quarantined += 1
+        self.quarantine.append(line)
+
+    def handle_save_batch(self, limit=None):
+        """Parses the complete lines in the buffer (about the first 'limit' bytes of them) in one go, see 'batch parsing
+        of text lines': the samples are pushed like binary frames, the other lines go through handle_save_line() in
+        their place. OUTPUT: False if there wasn't a complete line."""
+        view = self.buffer.next_lines_view(limit)
+        if view is None:
+            return False
+        samples, others = parse_lines(view, self.schema.n)
+        row = 0
+        for next_row, end, line in others + [(len(samples), None, None)]:
+            if next_row > row:
+                self.handle_save_frames(samples[row:next_row])
+                self.monitor.lines += next_row - row
+                row = next_row
+            if line is None:
+                break
+            self.monitor.lines += 1
+            self.handle_save_line(line)
+            if self.mode != 'save':  # '^': the lines after it wait for the next mode
+                self.buffer.release(end)
+                return True
+        self.buffer.release()
+        return True
+
+    def handle_save_frames(self, samples):
+        samples = samples.astype(np.float64, copy=not samples.flags.writeable)  # read-only, or not float64
+        try:  # pushes samples to LSL
+            samples[:, 0] = self.device_clock.unwrap(samples[:, 0])
+            if self.gap and self.error is None:
+                self.end_gap(float(samples[0, 0]))
+            timestamps = self.device_clock.stamp_many(samples[:, 0], self.arrival)
+            self.outlet.push_chunk(samples, timestamps.tolist())
+            self.lag = self.arrival - float(timestamps[-1])
+            if self.ring is not None:
+                self.ring.write_many(self.leg, samples)
+            self.note_time(float(samples[0, 0]), float(samples[-1, 0]), len(samples))
+            self.mark_gaps(self.loss.check(samples[:, 0]))
+            self.push_clock_fit()
+        except Exception:
+            self.trial_stop = True
+            print("Ending trial, couldn't push to LSL... (" + self.leg + ")")
+
+    def mark_gaps(self, gaps):
+        """Counts the samples missing before the ones just saved (LossCounter.check()), see 'sample loss', and pushes
+        a marker for each gap."""
+        for before, after, missing in gaps:
+            self.monitor.missing += missing
+            if self.loss_outlet is not None:
+                timestamp = self.device_clock.time_of(after)
+                self.loss_outlet.push_sample(["%d samples missing (Time %g to %g)" % (missing, before, after)],
+                                             self.arrival if timestamp is None else timestamp)
+
+    def push_clock_fit(self):
+        """Pushes the DeviceClock's newest fit (if there's a new one) to the clock stream, see 'sample timestamps'."""
+        fit = self.device_clock.take_fit()
+        if fit is not None and self.clock_outlet is not None:
+            fit_time, offset, drift = fit
+            self.clock_outlet.push_sample([fit_time, offset, 1e6 * drift], fit_time + offset)
+
+    def handle_negotiate_line(self, line):
+        wire, checksum = self.asking_for or (None, False)
+        schema = parse_schema(line) if self.asking_schema else None
+        if schema is not None:
+            self.set_schema(schema)
+            self.asking_schema = False
+        elif wire == 'binary' and binary_ack in line:  # from here on the Teensy sends binary frames
+            self.buffer = FrameBuffer(self.buffer)
+            self.wire = wire
+            self.asking_for = None
+        elif wire in cobs_wires and (delta_ack if wire == 'delta' else cobs_ack) in line:  # everything is COBS packets
+            self.buffer = CobsBuffer(self.buffer, checksum)
+            self.buffer.feed(b'')  # packets already received
+            self.checksum = checksum
+            self.wire = wire
+            self.asking_for = None
+        else:
+            self.post(line)
+            return
+        if self.asking_for is None and not self.asking_schema:
+            self.negotiated = True
+            self.mode = 'hold'
+
+    def set_schema(self, schema):
+        """Reads the leg's samples with 'schema' from now on, and makes its LSL stream again if the channels changed
+        (see 'channel schema')."""
+        if schema != self.schema and self.new_outlet is not None:
+            self.outlet = self.new_outlet(self.sample_rate or schema.rate, self.decimation, schema)
+        self.schema = schema
+        self.buffer.schema = schema
+
+    def handle_probe_line(self, line):
+        if not self.link_probe.line(line):
+            self.post(line)
+        elif self.link_probe.finished:
+            self.finish_probe()
+
+    def finish_probe(self):
+        self.probe_result = self.link_probe.result()
+        self.probed = True
+        self.mode = 'hold'
+
+    def handle_rate_line(self, line):
+        try:  # '#RATE<tab>n<tab>samples/s'
+            ack, decimation, rate = line.strip().split("\t")
+            decimation, rate = int(decimation), float(rate)
+        except ValueError:
+            ack = None
+        if ack != rate_ack:
+            self.post(line)
+            return
+        if (decimation, rate) != (self.decimation, self.sample_rate) and self.new_outlet is not None:
+            self.outlet = self.new_outlet(rate, decimation, self.schema)
+        self.decimation = decimation
+        self.sample_rate = rate
+        self.rate_set = True
+        self.mode = 'hold'
+
+    def post(self, line):
+        try:
+            self.lines.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def get_lines(self, limit):
+        """Called from the GUI: returns up to 'limit' lines waiting to be printed."""
+        lines = []
+        while len(lines) < limit:
+            try:
+                lines.append(self.lines.get_nowait())
+            except queue.Empty:
+                break
+        return lines
+
+
+# ============================ one poller for every device =============================================================
+"""Instead of a thread per device, one Poller thread waits on every device's port or socket at once (selectors: epoll
+on Linux, kqueue on macOS) and only reads the ones that have data. An idle device costs nothing, and a busy one costs
+the same however many other devices there are. A port that can't be waited on this way (serial ports on Windows,
+where select() only takes sockets, or a SimulatedExo) gets its reader's own thread instead, as before.
+
+Reading is cheap, parsing isn't. So each pass the poller first reads every device that has data, then parses
+(drain()) at most drain_budget bytes in total, shared out in proportion to how far behind each reader is (but at
+least min_share each). A leg catching up on a burst gets most of the pass, without the other leg's lines waiting
+behind the whole burst. What's left is parsed in the next pass, straight away. LegReader.max_backlog shows which leg
+fell furthest behind (the one limiting throughput).
+
+With realtime = True, the thread runs with the real-time settings (see 'real-time mode')."""
+poll_wait = 0.05  # seconds between checks of every reader (timeouts, lines left in a buffer after hold)
+drain_budget = 16384  # bytes parsed per pass, for all the readers together
+min_share = 1024  # bytes per pass any reader with a backlog gets at least
+
+
+class Poller(threading.Thread):
+    def __init__(self, budget=drain_budget, realtime=False):
+        threading.Thread.__init__(self, name="Poller", daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.readers = {}  # LegReader -> port or socket, for the readers this thread reads
+        self.budget = budget  # None = parse everything every pass
+        self.realtime = realtime
+        self.behind = set()  # readers with data to parse
+        self.lock = threading.Lock()
+        self.running = True
+
+    def add(self, reader, link):
+        """Reads reader's device (link = its port or socket, see open_link()) from this thread if it can, else starts
+        the reader's own thread."""
+        try:
+            with self.lock:
+                self.selector.register(link, selectors.EVENT_READ, reader)
+                self.readers[reader] = link
+        except (ValueError, OSError):  # no fileno() that select() takes
+            reader.start()
+
+    def remove(self, reader):
+        with self.lock:
+            link = self.readers.pop(reader, None)
+            if link is not None:
+                try:
+                    self.selector.unregister(link)
+                except (KeyError, ValueError, OSError):
+                    pass
+
+    def stop(self):
+        self.running = False
+        for reader in list(self.readers):
+            reader.stop()
+
+    def run(self):
+        if self.realtime:
+            print_realtime("Poller", set_realtime())
+        check_due = time.monotonic()
+        while self.running:
+            waited = not self.behind
+            try:
+                # waits for any device to have data, unless there's parsing left over from the last pass
+                events = self.selector.select(0 if self.behind else poll_wait)
+            except OSError:  # a port was closed while waiting
+                events = []
+            if waited:
+                self.count_empty(events)
+            for key, _ in events:
+                reader = key.data
+                try:
+                    data = reader.read()  # returns at once, there's data waiting
+                except OSError as err:
+                    self.drop(reader, err)
+                    continue
+                reader.feed(data)
+                self.behind.add(reader)
+            self.drain()
+            if time.monotonic() > check_due:
+                check_due = time.monotonic() + poll_wait
+                with self.lock:
+                    readers = list(self.readers)
+                for reader in readers:
+                    if not reader.running:
+                        self.remove(reader)
+                    elif reader.stalled():
+                        self.drop(reader, "no data for %g s" % stall_timeout)
+                    else:
+                        reader.check_timeouts()
+                        if reader.backlog():  # e.g. lines that waited while the reader held
+                            self.behind.add(reader)
+        self.selector.close()
+
+    def count_empty(self, events):
+        """Counts an empty read (see LinkMonitor) for each reader that had no data when select() returned from
+        waiting, as its own thread's read() would have."""
+        ready = set(key.data for key, _ in events)
+        now = time.monotonic()
+        with self.lock:
+            readers = [reader for reader in self.readers if reader not in ready]
+        for reader in readers:
+            reader.monitor.count_read(0, now)
+
+    def drain(self):
+        """Parses what the readers behind have buffered, sharing the budget between them in proportion to their
+        backlog."""
+        backlogs = [(reader, reader.backlog()) for reader in self.behind
+                    if reader.mode != 'hold' and reader in self.readers]
+        total = sum(backlog for _, backlog in backlogs)
+        self.behind = set()
+        for reader, backlog in backlogs:
+            if self.budget is None:
+                reader.handle_lines()
+            elif backlog and reader.handle_lines(max(min_share, self.budget * backlog // total)):
+                self.behind.add(reader)  # more to parse next pass
+
+    def drop(self, reader, err):
+        """reader's link is lost: it's reconnected in the background, while this thread carries on with the rest."""
+        self.remove(reader)
+        reader.lost(err)
+        threading.Thread(target=self.reconnect, args=(reader,), name="Reconnect " + reader.leg, daemon=True).start()
+
+    def reconnect(self, reader):
+        if reader.reconnect() and self.running:
+            self.add(reader, reader.link)
+
+
+# ============================ real-time mode (optional, Linux) ========================================================
+"""For high-rate trials on a Linux acquisition computer ('Real-time mode' in the setup windows). The thread reading
+the devices (the Poller, in the GUI or in the acquisition process) asks for real-time scheduling (SCHED_FIFO, or
+failing that a lower nice value), a core of its own, and its memory locked in RAM (no page faults mid-trial). Each
+serial port is asked to hand bytes over as they arrive (ASYNC_LOW_LATENCY) instead of batching them for a few ms.
+These usually need privileges (root, CAP_SYS_NICE / CAP_IPC_LOCK, or rtprio / memlock limits in
+/etc/security/limits.conf). Whatever isn't allowed is skipped, and what took effect is printed. On Windows and
+macOS nothing changes."""
+rt_priority = 50  # SCHED_FIFO priority (1-99), below the kernel's own interrupt threads
+rt_nice = -10  # nice value asked for instead if SCHED_FIFO isn't allowed
+rt_cpu = -1  # core the reading thread is pinned to (-1 = the last one; the OS and the GUI tend to use the first)
+
+
+def set_realtime(cpu=rt_cpu):
+    """Applies the real-time settings to the calling thread (memory locking: the whole process).
+    OUTPUT: [(setting, error), ...]; error is None if the setting took effect, or else why it didn't."""
+    results = []
+
+    def attempt(setting, apply):
+        try:
+            apply()
+        except (AttributeError, ImportError, OSError, ValueError) as err:  # not Linux, not allowed, ...
+            results.append((setting, str(err) or type(err).__name__))
+            return False
+        results.append((setting, None))
+        return True
+
+    thread_id = threading.get_native_id()
+    if not attempt("SCHED_FIFO priority %d" % rt_priority,
+                   lambda: os.sched_setscheduler(thread_id, os.SCHED_FIFO, os.sched_param(rt_priority))):
+        attempt("nice %d" % rt_nice, lambda: os.setpriority(os.PRIO_PROCESS, thread_id, rt_nice))  # per thread on Linux
+    if hasattr(os, 'sched_getaffinity'):
+        cpu = sorted(os.sched_getaffinity(0))[cpu] if cpu < 0 else cpu
+    attempt("pinned to CPU %d" % cpu, lambda: os.sched_setaffinity(thread_id, {cpu}))
+    attempt("memory locked", lock_memory)
+    return results
+
+
+def lock_memory():
+    """Locks the process's memory (now and later) in RAM. Only done when the memlock limit can't be hit: with a limit,
+    later allocations (numpy arrays, say) would fail once it's reached."""
+    import ctypes
+    import resource
+    limit = resource.getrlimit(resource.RLIMIT_MEMLOCK)[0]
+    if os.geteuid() != 0 and limit != resource.RLIM_INFINITY:
+        raise OSError("the memlock limit is %d kB, it needs to be unlimited" % (limit // 1024))
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlockall(1 | 2) != 0:  # MCL_CURRENT | MCL_FUTURE
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def set_low_latency(port):
+    """Asks a serial port's driver to pass each byte on as it arrives (Linux ASYNC_LOW_LATENCY; USB-UART adapters
+    otherwise hold bytes back for up to 16 ms). OUTPUT: None if it did, or else why not."""
+    try:
+        port.set_low_latency_mode(True)
+    except (AttributeError, OSError, ValueError) as err:  # not Linux, or a port without the flag (Teensy, pty)
+        return str(err) or type(err).__name__
+    return None
+
+
+def print_realtime(title, results):
+    """Prints which real-time settings took effect, e.g. from set_realtime()."""
+    print(title + " real-time mode: " + "; ".join(setting + (": on" if error is None else ": no (" + error + ")")
+                                                  for setting, error in results))
+
+
+# ============================ acquisition process (optional) =========================================================
+"""Instead of running the LegReader threads in the GUI's process, they can be run in a separate process (the
+acquisition engine), which then owns both connections, the parsing and the LSL outlets. The engine gets its own core
+and its own Python interpreter, so nothing the GUI does (or how long it holds the GIL) can slow the saving down.
+
+GUI -> engine: commands over a multiprocessing Pipe ('arm', 'hold', 'send', 'stop')
+engine -> GUI: connection status, printed lines and the '^'/'$'/'@' flags over the same Pipe, and every saved sample
+               in a SampleRing (shared memory), which the GUI can look at without copying for display.
+
+In the GUI, AcquisitionEngine.legs stand in for the LegReader threads, so the rest of the GUI doesn't need to know
+which way the data is being received.
+"""
+ring_slots = 4096  # samples kept per leg in the SampleRing
+engine_interval = 0.01  # seconds the engine waits for a command before forwarding lines/flags to the GUI
+counts_interval = 0.5  # seconds between updates of the link counts (LegReader.counts()) sent to the GUI
+leg_index = {'L': 0, 'R': 1}
+
+
+class SampleRing:
+    """Ring buffer of the last ring_slots samples of each leg, in shared memory (multiprocessing.shared_memory).
+
+    counts[leg] is the number of samples written so far for that leg, samples[leg, n % ring_slots] is sample n.
+    There is one writer per leg (its LegReader), which writes the sample before counting it. The ring is made before
+    the legs describe their channels (see 'channel schema'): it keeps the first 'channels' of each sample, and a
+    narrower sample is padded with NaN.
+    name = None creates the shared memory, otherwise the ring with that name is opened.
+    """
+    def __init__(self, name=None, slots=ring_slots, channels=n_channels):
+        from multiprocessing import shared_memory  # Python 3.8+
+        self.slots = slots
+        self.channels = channels
+        size = 8 * len(leg_index) + 4 * len(leg_index) * slots * channels
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name = self.shm.name
+        self.owner = name is None
+        self.counts = np.ndarray((len(leg_index),), dtype=np.int64, buffer=self.shm.buf)
+        self.samples = np.ndarray((len(leg_index), slots, channels), dtype=np.float32, buffer=self.shm.buf,
+                                  offset=8 * len(leg_index))
+        if self.owner:
+            self.counts[:] = 0
+
+    def write(self, leg, sample):
+        i = leg_index[leg]
+        n = self.counts[i]
+        self.samples[i, n % self.slots] = sample if len(sample) == self.channels else self.fit(sample)
+        self.counts[i] = n + 1
+
+    def write_many(self, leg, samples):
+        """Writes an (n, channels) array of samples (only the newest 'slots' of them if there are more)."""
+        i = leg_index[leg]
+        n = self.counts[i] + len(samples)  # count after writing
+        samples = samples[-self.slots:]
+        if samples.shape[1] != self.channels:
+            samples = self.fit(samples)
+        rows = (n - len(samples) + np.arange(len(samples))) % self.slots
+        self.samples[i, rows] = samples
+        self.counts[i] = n
+
+    def fit(self, samples):
+        """OUTPUT: samples (one, or an array of them) cut or padded with NaN to the ring's channels."""
+        samples = np.asarray(samples, dtype=np.float64)
+        width = samples.shape[-1]
+        if width > self.channels:
+            return samples[..., :self.channels]
+        fitted = np.full(samples.shape[:-1] + (self.channels,), np.nan)
+        fitted[..., :width] = samples
+        return fitted
+
+    def count(self, leg):
+        return int(self.counts[leg_index[leg]])
+
+    def latest(self, leg):
+        """OUTPUT: the newest sample of the leg (a view into shared memory, not a copy), or None before the first."""
+        i = leg_index[leg]
+        n = self.counts[i]
+        if n == 0:
+            return None
+        return self.samples[i, (n - 1) % self.slots]
+
+    def close(self):
+        # views into the shared memory have to go before it can be closed
+        del self.counts
+        del self.samples
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def engine_main(comType, address1, address2, conn, ring_name, baud1=default_baud, baud2=default_baud, others=(),
+                realtime=False, capture=False):
+    """Runs in the acquisition process: connects to both legs (and the other devices), then reads them all with one
+    Poller (pushing to LSL, and the legs to the SampleRing) and answers the GUI's commands until told to stop."""
+    addresses = {'L': address1, 'R': address2}
+    addresses.update(others)
+    opener = LinkOpener(comType, addresses, {'L': baud1, 'R': baud2}, realtime=realtime)  # all of them at once
+    while not opener.done():
+        time.sleep(engine_interval)
+        for leg, error in opener.poll():
+            conn.send(('connected', leg) if error is None else ('failed', leg, error))
+    if any(leg in opener.errors for leg in exo_legs):
+        opener.close()
+        return
+    links = opener.links
+
+    ring = SampleRing(ring_name)
+    poller = Poller(realtime=realtime)
+    raw_capture = RawCapture(links) if capture else None
+    readers = {}
+    for leg, (link, read, write) in links.items():
+        readers[leg] = LegReader(leg, read, write, create_outlet(leg), ring if leg in leg_index else None, link,
+                                 (lambda leg: lambda: opener.reopen(leg))(leg))
+        readers[leg].capture = raw_capture
+        readers[leg].new_outlet = (lambda leg: lambda rate, decimation, schema:
+                                   create_outlet(leg, rate, decimation, schema))(leg)
+        if comType in monitored_types:
+            readers[leg].monitor_outlet = create_monitor_outlet(leg)
+        readers[leg].loss_outlet = create_loss_outlet(leg)
+        readers[leg].clock_outlet = create_clock_outlet(leg)
+        poller.add(readers[leg], link)
+    poller.start()
+
+    arm_ids = dict.fromkeys(readers, 0)  # which arm command the flags belong to (see EngineLeg.arm())
+    flags = dict.fromkeys(readers)
+    counts = dict.fromkeys(readers)
+    trial_counts = dict.fromkeys(readers)
+    link_stats = dict.fromkeys(readers)
+    counts_due = time.monotonic()
+    running = True
+    while running:
+        try:
+            while conn.poll(engine_interval):  # waits for commands
+                command = conn.recv()
+                if command[0] in ('arm', 'hold', 'negotiate', 'probe', 'fit_rate') and command[1] not in readers:
+                    continue  # a device that couldn't be opened: nothing to do
+                if command[0] == 'arm':
+                    leg, mode, arm_ids[command[1]] = command[1:]
+                    readers[leg].arm(mode)
+                elif command[0] == 'hold':
+                    readers[command[1]].hold()
+                elif command[0] == 'negotiate':
+                    leg, arm_ids[command[1]], wire, checksum = command[1:]
+                    readers[leg].negotiate(wire, checksum)
+                elif command[0] == 'probe':
+                    leg, arm_ids[command[1]], seconds = command[1:]
+                    readers[leg].probe(seconds)
+                elif command[0] == 'fit_rate':
+                    leg, arm_ids[command[1]], max_rate = command[1:]
+                    readers[leg].fit_rate(max_rate)
+                elif command[0] == 'send':
+                    data, leg = command[1:]
+                    for name, reader in readers.items():
+                        if sends_to(leg, name):
+                            reader.send(data)
+                elif command[0] == 'stop':
+                    running = False
+                    break
+
+            # forward what the readers received to the GUI
+            for leg, reader in readers.items():
+                lines = reader.get_lines(queue_size)
+                if lines:
+                    conn.send(('lines', leg, lines))
+                state = (reader.fin, reader.trial_start, reader.trial_stop, reader.negotiated, reader.wire,
+                         reader.checksum, reader.probed, reader.probe_result, reader.rate_set, reader.decimation,
+                         reader.sample_rate, reader.schema)
+                if state != flags[leg]:
+                    flags[leg] = state
+                    conn.send(('flags', leg, arm_ids[leg]) + state)
+                if reader.trial_counts is not trial_counts[leg]:  # a trial has ended
+                    trial_counts[leg] = reader.trial_counts
+                    conn.send(('trial counts', leg, trial_counts[leg]))
+            if time.monotonic() > counts_due:
+                counts_due = time.monotonic() + counts_interval
+                for leg, reader in readers.items():
+                    if reader.counts() != counts[leg]:
+                        counts[leg] = reader.counts()
+                        conn.send(('counts', leg, counts[leg]))
+                    if reader.link_stats() is not link_stats[leg]:  # a new LinkMonitor interval
+                        link_stats[leg] = reader.link_stats()
+                        conn.send(('link stats', leg, link_stats[leg]))
+        except (EOFError, OSError):  # GUI is gone
+            running = False
+
+    poller.stop()
+    poller.join(1)
+    for link, _, _ in links.values():
+        link.close()
+    if raw_capture is not None:
+        raw_capture.close()
+    ring.close()
+
+
+class EngineLeg:
+    """Stands in for a LegReader in the GUI while the acquisition process is doing the reading. Same attributes and
+    functions (arm(), hold(), negotiate(), probe(), fit_rate(), send(), counts(), link_stats(), get_lines(), fin/
+    trial_start/trial_stop/negotiated/wire/checksum/probed/probe_result/rate_set/decimation/sample_rate/schema/
+    trial_counts), kept up to date by AcquisitionEngine.poll()."""
+    def __init__(self, engine, leg):
+        self.engine = engine
+        self.leg = leg
+        self.lines = collections.deque(maxlen=queue_size)
+        self.arm_id = 0
+        self.fin = False
+        self.trial_start = False
+        self.trial_stop = False
+        self.negotiated = False
+        self.wire = 'ascii'
+        self.checksum = False
+        self.probed = False
+        self.probe_result = None
+        self.rate_set = False
+        self.decimation = 1
+        self.sample_rate = None
+        self.schema = default_schema(leg)
+        self.trial_counts = None
+        self.link_counts = {}
+        self.monitor_stats = {}
+
+    def arm(self, mode):
+        # flags sent by the engine for an earlier arm() are ignored, they may still be in the Pipe
+        self.arm_id += 1
+        self.fin = False
+        self.trial_start = False
+        self.trial_stop = False
+        self.engine.command('arm', self.leg, mode, self.arm_id)
+
+    def hold(self):
+        self.engine.command('hold', self.leg)
+
+    def negotiate(self, wire='binary', checksum=False):
+        self.arm_id += 1
+        self.negotiated = False
+        self.engine.command('negotiate', self.leg, self.arm_id, wire, checksum)
+
+    def probe(self, seconds=probe_seconds):
+        self.arm_id += 1
+        self.probed = False
+        self.engine.command('probe', self.leg, self.arm_id, seconds)
+
+    def fit_rate(self, max_rate):
+        self.arm_id += 1
+        self.rate_set = False
+        self.engine.command('fit_rate', self.leg, self.arm_id, max_rate)
+
+    def send(self, data):
+        self.engine.command('send', data, self.leg)
+
+    def counts(self):
+        return self.link_counts
+
+    def link_stats(self):
+        return self.monitor_stats
+
+    def stop(self):
+        self.engine.stop()
+
+    def get_lines(self, limit):
+        lines = []
+        while self.lines and len(lines) < limit:
+            lines.append(self.lines.popleft())
+        return lines
+
+
+class AcquisitionEngine:
+    """GUI side of the acquisition process. Starts the process, sends it commands, and collects what it sends back.
+
+    INPUTS: same as connect_to_exo(): comType = 'Ser', 'BLE' or 'Net', address1/address2 = left/right leg address,
+    baud1/baud2 = left/right leg baud rate (serial only), others = [(name, address), ...] of the other devices,
+    realtime = True to run the reading with the real-time settings (see 'real-time mode'), capture = True to write the
+    bytes received to files (see 'raw byte capture')
+    """
+    def __init__(self, comType, address1, address2, baud1=default_baud, baud2=default_baud, others=(),
+                 realtime=False, capture=False):
+        self.ring = SampleRing()
+        self.conn, engine_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=engine_main, name="AcquisitionEngine",
+                                               args=(comType, address1, address2, engine_conn, self.ring.name, baud1,
+                                                     baud2, tuple(others), realtime, capture),
+                                               daemon=True)
+        self.process.start()
+        self.legs = {name: EngineLeg(self, name) for name in exo_legs + tuple(name for name, _ in others)}
+        self.running = True
+
+    def command(self, *command):
+        if self.running:
+            self.conn.send(command)
+
+    def poll(self):
+        """Called from the GUI: takes in everything the engine has sent. OUTPUT: list of status messages to show
+        (connections, errors)."""
+        messages = []
+        try:
+            while self.running and self.conn.poll():
+                message = self.conn.recv()
+                if message[0] == 'lines':
+                    self.legs[message[1]].lines.extend(message[2])
+                elif message[0] == 'flags':
+                    leg = self.legs[message[1]]
+                    if message[2] == leg.arm_id:
+                        (leg.fin, leg.trial_start, leg.trial_stop, leg.negotiated, leg.wire, leg.checksum,
+                         leg.probed, leg.probe_result, leg.rate_set, leg.decimation, leg.sample_rate,
+                         leg.schema) = message[3:]
+                elif message[0] == 'counts':
+                    self.legs[message[1]].link_counts = message[2]
+                elif message[0] == 'trial counts':
+                    self.legs[message[1]].trial_counts = message[2]
+                elif message[0] == 'link stats':
+                    self.legs[message[1]].monitor_stats = message[2]
+                elif message[0] == 'connected':
+                    messages.append(device_title(message[1]) + " Connected!")
+                elif message[0] == 'failed':
+                    del self.legs[message[1]]
+                    messages.append(device_title(message[1]) + ": couldn't connect (" + message[2] + ")")
+        except (EOFError, OSError):
+            messages.append("Acquisition process stopped")
+            self.stop()
+        return messages
+
+    def latest(self, leg):
+        return self.ring.latest(leg)
+
+    def count(self, leg):
+        return self.ring.count(leg)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        try:
+            self.conn.send(('stop',))
+        except (EOFError, OSError):
+            pass
+        self.process.join(1)
+        self.ring.close()
+
+
+# ============================ simulated exo (testing without hardware) ================================================
+sim_channels = ["Time", "Angle", "Torque", "FSR", "Current", "FSM State", "Torque Setpoint", "Position Setpoint"]
+
+
+class SimulatedExo:
+    """Behaves like one leg's Teensy, for testing the receiving side without an exoskeleton. Use read/write in place of
+    a port's, e.g. LegReader('L', sim.read, sim.write, outlet).
+
+    - a settings string ('len~data>') is answered with a menu line and the prompt character
+    - schema_command is answered with the '#SCHEMA' line of 'schema' (a ChannelSchema, the 8 float32 sim_channels if
+      None), and the samples have its channels: the first 8 as below, any more a constant each (the channel's number)
+    - binary_command/cobs_command/delta_command are answered with binary_ack/cobs_ack/delta_ack, after which samples
+      are sent as binary frames, or everything is sent (and expected) as COBS packets, the samples in blocks of
+      delta_block as delta packets with delta_command
+    - a trial number (digits, no length prefix) starts a trial: samples are sent at 'rate' samples/s
+    - ',' stops the trial, answered with the trial stop character
+    - probe_command streams the probe's test pattern at link_rate bytes/s
+    - rate_command is answered with rate_ack; from the next trial on only every n-th sample is sent
+    - drop_link() loses the link for a while, like a bluetooth module going out of range (use reopen() to reconnect)
+
+    corrupt = fraction of the bytes sent that get a bit flipped, to test how the GUI copes with a bad link.
+    throttle = True: the link only carries link_rate bytes/s, what doesn't fit waits (like in a bluetooth module's
+    buffer), so a link that can't keep up can be tried out. open_link() opens one for the address 'sim:<bytes/s>'.
+    """
+    def __init__(self, rate=1000, corrupt=0.0, seed=0, link_rate=11520, throttle=False, schema=None):
+        self.rate = rate
+        schema = schema or ChannelSchema(sim_channels)
+        self.schema = ChannelSchema(schema.names, schema.types, rate)
+        self.corrupt = corrupt
+        self.link_rate = link_rate  # 115200 baud ~ 11520 bytes/s
+        self.throttle = throttle
+        self.held = bytearray()  # bytes waiting for the throttled link
+        self.credit = 0.0  # bytes the throttled link can take now
+        self.credit_time = time.monotonic()
+        self.decimation = 1  # every n-th sample is sent
+        self.next_decimation = 1  # asked for with rate_command, used from the next trial on
+        self.probe_start = None
+        self.probe_end = 0
+        self.probe_lines = 0
+        self.down_until = 0  # see drop_link()
+        self.random = np.random.default_rng(seed)
+        self.wire = 'ascii'
+        self.checksum = False
+        self.inbox = CobsBuffer()  # commands received while in COBS mode
+        self.streaming = False
+        self.sample_number = 0
+        self.start = time.monotonic()
+        self.outbox = bytearray()  # text waiting to be read
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        data = bytes(data, encoding='utf-8') if isinstance(data, str) else bytes(data)
+        with self.lock:
+            if self.wire in cobs_wires:
+                self.inbox.feed(data)
+                while True:
+                    text = self.inbox.next_line()
+                    if text is None:
+                        break
+                    self.command(text)
+            else:  # commands sent back to back can arrive in one piece (over TCP, say)
+                for command in re.findall(r"\d+~[^>]*>|,|\d+", data.decode('utf-8')):
+                    self.command(command)
+
+    def command(self, text):
+        if '~' in text and text.endswith('>'):
+            command = text[text.index('~') + 1:-1]
+            if command == schema_command:
+                self.reply(self.schema.line())
+            elif command == binary_command:
+                self.reply(binary_ack + " binary telemetry on\n")
+                self.wire = 'binary'
+            elif command in cobs_command.values():
+                self.reply(cobs_ack + " COBS packets on\n")
+                self.wire = 'cobs'
+                self.checksum = command == cobs_command[True]
+                self.inbox = CobsBuffer(checksum=self.checksum)
+            elif command in delta_command.values():
+                self.reply(delta_ack + " delta packets on\n")
+                self.wire = 'delta'
+                self.checksum = command == delta_command[True]
+                self.inbox = CobsBuffer(checksum=self.checksum)
+            elif command.startswith(probe_command):
+                self.probe_start = time.monotonic()
+                self.probe_end = self.probe_start + int(command[len(probe_command):]) / 1000.0
+                self.probe_lines = 0
+            elif command.startswith(rate_command):
+                self.next_decimation = max(1, int(np.ceil(self.rate / float(command[len(rate_command):]))))
+                if not self.streaming:
+                    self.decimation = self.next_decimation
+                self.reply("%s\t%d\t%g\n" % (rate_ack, self.next_decimation, self.rate / self.next_decimation))
+            else:
+                self.reply("Received settings: " + command + "\n")
+                self.reply(prompt_char + "\n")
+        elif text == ',':
+            self.streaming = False
+            self.reply(trial_stop_char + "\n")
+        elif text.isdigit():
+            self.streaming = True
+            self.start = time.monotonic()
+            self.sample_number = 0
+            self.decimation = self.next_decimation
+
+    def reply(self, text):
+        data = bytes(text, encoding='utf-8')
+        if self.wire in cobs_wires:
+            data = encode_packet(text_packet, data, self.checksum)
+        self.outbox += data
+
+    def samples(self, n):
+        """The next n samples: time (ms), a sine wave angle and torque, the rest constant."""
+        k = self.sample_number + np.arange(n)
+        t = 1000.0 * k * self.decimation / self.rate
+        samples = np.zeros((n, max(self.schema.n, n_channels)), dtype=np.float32)
+        samples[:, 0] = t
+        samples[:, 1] = 30 * np.sin(2 * np.pi * t / 1000)  # angle
+        samples[:, 2] = 5 * np.cos(2 * np.pi * t / 1000)  # torque
+        samples[:, 3] = 512  # FSR
+        samples[:, 5] = 1  # FSM state
+        samples[:, n_channels:] = np.arange(n_channels, self.schema.n)
+        self.sample_number += n
+        return samples[:, :self.schema.n]
+
+    def encode(self, samples):
+        if self.wire == 'binary':
+            return encode_frames(samples, self.schema)
+        if self.wire == 'cobs':
+            samples = self.schema.encode(samples)
+            return b''.join(encode_packet(sample_packet, sample.tobytes(), self.checksum) for sample in samples)
+        if self.wire == 'delta':
+            return b''.join(encode_packet(delta_packet, encode_delta(samples[i:i + delta_block]), self.checksum)
+                            for i in range(0, len(samples), delta_block))
+        return "".join("\t".join("%.2f" % value for value in sample) + "\n" for sample in samples).encode('utf-8')
+
+    def damage(self, data):
+        data = np.frombuffer(data, dtype=np.uint8).copy()
+        hit = self.random.random(len(data)) < self.corrupt
+        data[hit] ^= 0x10  # flips one bit
+        return data.tobytes()
+
+    def probe_pattern(self):
+        """The probe lines due since the last read (called with the lock held)."""
+        now = min(time.monotonic(), self.probe_end)
+        line_size = len(probe_line) + 7 + len(probe_pattern)
+        due = int((now - self.probe_start) * self.link_rate / line_size) - self.probe_lines
+        start = len(self.outbox)
+        for number in range(self.probe_lines, self.probe_lines + max(due, 0)):
+            self.reply("%s%d\t%s\n" % (probe_line, number, probe_pattern))
+        self.probe_lines += max(due, 0)
+        if now >= self.probe_end:
+            self.reply("%s\t%d\n" % (probe_end, self.probe_lines))
+            self.probe_start = None
+        data = bytes(self.outbox[start:])
+        del self.outbox[start:]
+        return data
+
+    def through_link(self, data):
+        """What of data (and what was held back before) a throttled link lets through now (called with the lock
+        held)."""
+        now = time.monotonic()
+        self.credit = min(self.credit + (now - self.credit_time) * self.link_rate, 0.05 * self.link_rate)
+        self.credit_time = now
+        self.held += data
+        n = min(len(self.held), int(self.credit))
+        self.credit -= n
+        data = bytes(self.held[:n])
+        del self.held[:n]
+        return data
+
+    def drop_link(self, seconds):
+        """Loses the link for 'seconds': reads fail (ConnectionError), and what's sent meanwhile never arrives."""
+        self.down_until = time.monotonic() + seconds
+
+    def reopen(self):
+        """For LegReader(reopen=...): fails while the link is down, else returns (link, read, write)."""
+        if time.monotonic() < self.down_until:
+            raise ConnectionError("out of range")
+        self.skip_lost()
+        return self, self.read, self.write
+
+    def skip_lost(self):
+        with self.lock:
+            del self.outbox[:]
+            del self.held[:]
+            if self.streaming:
+                self.sample_number = int((time.monotonic() - self.start) * self.rate / self.decimation)
+
+    def close(self):
+        pass
+
+    def read(self, wait=serial_wait):
+        """Returns what the Teensy would have sent since the last read, waiting up to 'wait' seconds for something."""
+        if time.monotonic() < self.down_until:
+            self.skip_lost()
+            raise ConnectionError("link lost")
+        deadline = time.monotonic() + wait
+        while True:
+            with self.lock:
+                data = bytes(self.outbox)
+                del self.outbox[:]
+                if self.streaming:
+                    due = int((time.monotonic() - self.start) * self.rate / self.decimation) - self.sample_number
+                    if self.wire == 'delta':
+                        due -= due % delta_block  # a packet once a block is full
+                    if due > 0:
+                        data += self.encode(self.samples(due))
+                if self.probe_start is not None:
+                    data += self.probe_pattern()
+                if self.throttle:
+                    data = self.through_link(data)
+            if data or time.monotonic() >= deadline:
+                return self.damage(data) if (data and self.corrupt) else data
+            time.sleep(min(0.001, 1.0 / self.rate))
+
+
+bridge_datagram = 1460  # most bytes a SimulatedBridge sends per UDP datagram (a Wi-Fi bridge sends about a packet's)
+
+
+class SimulatedBridge(threading.Thread):
+    """A serial-to-Wi-Fi bridge on this computer with a SimulatedExo behind it, for trying out network links
+    (comType = 'Net') without an exoskeleton: bridge = SimulatedBridge('udp'); bridge.start(), then connect to
+    bridge.address. stop() closes it. Other keyword arguments go to SimulatedExo().
+
+    TCP: one client at a time, each with a fresh SimulatedExo. UDP: what the exo sends goes to wherever the last
+    datagram came from, in datagrams of at most bridge_datagram bytes."""
+    def __init__(self, protocol='tcp', port=0, **options):
+        threading.Thread.__init__(self, name="SimulatedBridge", daemon=True)
+        self.protocol = protocol
+        self.options = options
+        kind = socket.SOCK_STREAM if protocol == 'tcp' else socket.SOCK_DGRAM
+        self.sock = socket.socket(socket.AF_INET, kind)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        if protocol == 'tcp':
+            self.sock.listen(1)
+        self.address = "%s://127.0.0.1:%d" % (protocol, self.sock.getsockname()[1])
+        self.exo = None
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        try:
+            while self.running:
+                if self.protocol == 'udp':
+                    self.serve_udp()
+                elif select.select([self.sock], [], [], poll_wait)[0]:
+                    connection, _ = self.sock.accept()
+                    with connection:
+                        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                        self.serve_tcp(connection)
+        finally:
+            self.sock.close()
+
+    def serve_tcp(self, connection):
+        self.exo = SimulatedExo(**self.options)
+        while self.running:
+            if select.select([connection], [], [], 0.001)[0]:
+                data = connection.recv(net_recv_size)
+                if not data:  # the client has gone
+                    return
+                self.exo.write(data)
+            data = self.exo.read(0)
+            if data:
+                connection.sendall(data)
+
+    def serve_udp(self):
+        self.exo = SimulatedExo(**self.options)
+        peer = None
+        while self.running:
+            try:
+                if select.select([self.sock], [], [], 0.001)[0]:
+                    data, peer = self.sock.recvfrom(net_recv_size)
+                    self.exo.write(data)
+                data = self.exo.read(0)
+                for i in range(0, len(data) if peer else 0, bridge_datagram):
+                    self.sock.sendto(data[i:i + bridge_datagram], peer)
+            except ConnectionRefusedError:  # the client has gone
+                peer = None
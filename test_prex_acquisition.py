@@ -0,0 +1,87 @@
+"""
+Tests of the acquisition helpers (prex_acquisition.py) that need no exoskeleton and no LSL: run with python -m pytest
+"""
+
+import numpy as np
+
+from prex_acquisition import SimulatedExo, LegReader, encode_delta, decode_delta
+
+
+# ============================ delta packets ===========================================================================
+def delta_packets():
+    """Three delta packets of 10 of SimulatedExo's samples each. OUTPUT: (payloads, samples)"""
+    samples = SimulatedExo().samples(30)
+    return [encode_delta(samples[i:i + 10]) for i in (0, 10, 20)], samples
+
+
+def test_delta_round_trip():
+    payloads, samples = delta_packets()
+    decoded, bad = decode_delta(payloads)
+    assert bad == 0
+    assert np.abs(decoded - samples).max() < 0.006
+
+
+def test_delta_unfinished_varint_loses_only_its_packet():
+    payloads, samples = delta_packets()
+    for damaged in (b'\x85', payloads[1][:-1], payloads[1] + b'\x85'):  # ends part way through a varint
+        decoded, bad = decode_delta([payloads[0], damaged, payloads[2]])
+        assert bad == 1
+        assert np.abs(decoded - np.concatenate((samples[:10], samples[20:]))).max() < 0.006
+
+
+# ============================ end of a trial ==========================================================================
+class ListOutlet:
+    """Stands in for a StreamOutlet, keeping the samples pushed."""
+    def __init__(self):
+        self.samples = []
+
+    def push_sample(self, sample, timestamp=0.0):
+        self.samples.append(list(sample))
+
+    def push_chunk(self, samples, timestamp=0.0):
+        self.samples.extend(list(sample) for sample in samples)
+
+
+def test_stop_trial_keeps_the_trial_counts():
+    """Stop Trial sends ',' and arms 'menu' straight away, before the Teensy's '@' arrives: the counts of the trial
+    have to survive that, to be shown at its end."""
+    sent = []
+    reader = LegReader('L', lambda: b'', sent.append, ListOutlet())
+    reader.arm('save')
+    times = [t for t in range(300) if t not in (120, 200, 201)]  # 3 samples missing
+    lines = ["%d\t1.00\t2.00\t512\t0.00\t1\t0.00\t0.00\n" % t for t in times]
+    lines.insert(150, "12\t1.\x0100\t2.00\n")  # damaged on the way
+    reader.receive("".join(lines).encode())
+    reader.send(",")
+    reader.arm('menu')
+    reader.receive(b"@\n")
+    assert sent == [b","]
+    assert len(reader.outlet.samples) == len(times)
+    assert reader.trial_counts['samples missing'] == 3
+    assert reader.trial_counts['lines quarantined'] == 1
+    assert reader.counts()['samples missing'] == 3  # not reset by arm('menu')
+    assert reader.counts()['lines quarantined'] == 1
+    reader.arm('save')  # the next trial starts over
+    assert reader.counts()['samples missing'] == 0
+    assert reader.counts()['lines quarantined'] == 0
+
+
+def test_text_after_the_trial_is_printed():
+    reader = LegReader('L', lambda: b'', lambda data: None, ListOutlet())
+    reader.arm('save')
+    reader.receive(b"1\t1.00\t2.00\t512\t0.00\t1\t0.00\t0.00\n@\nTrial over: 1 sample\n")
+    assert reader.get_lines(10) == ["Trial over: 1 sample\n"]
+    assert reader.counts()['lines quarantined'] == 0
+
+
+class WrongWidthOutlet(ListOutlet):
+    """An outlet made for more channels than the leg sends: pylsl refuses its samples."""
+    def push_chunk(self, samples, timestamp=0.0):
+        raise ValueError("each sample must have 10 values")
+
+
+def test_refused_push_ends_the_trial():
+    reader = LegReader('L', lambda: b'', lambda data: None, WrongWidthOutlet())
+    reader.arm('save')
+    reader.receive(b"".join(b"%d\t1.00\t2.00\t512\t0.00\t1\t0.00\t0.00\n" % t for t in range(10)))
+    assert reader.trial_stop